@@ -172,9 +172,10 @@ def main():
     print("📚 Setting up psych_metadata embeddings...")
     metadata_embedder = MetadataEmbedder(sandbox)  # same instance passed everywhere
 
-    # 2) Ensure (or refresh) the index once at boot
+    # 2) Ensure (or refresh) the index in the background; searches meanwhile use the partial index
     #    - include_corpus: False by default to avoid embedding patient_raw_data unless you want it
-    result = metadata_embedder.embed_metadata_dirs(
+    #    - progress/readiness: src.utils.metadata_embedder.get_indexing_status()
+    metadata_embedder.start_background_embedding(
         [
             "./src/data/psych_metadata",
             # "./src/data/patient_raw_data"  # include when you want corpus indexed
@@ -183,14 +184,13 @@ def main():
         include_corpus=False,
         verbose=True,
     )
-    print(result)
 
     # Create tools with the same embedder instance
     print("🛠️ Creating tools...")
     tool_factory = ToolFactory(sandbox, metadata_embedder=metadata_embedder)
     tools = tool_factory.create_all_tools()
 
-    # Start Ollama server and pull model
+    # Start Ollama server and pull model (runs while the embedding thread works)
     ollama_process = start_ollama_server_background()
     if not wait_for_ollama_server():
         print("❌ Failed to start Ollama server. Exiting.")
@@ -223,6 +223,7 @@ def main():
         # Cleanup agent resources
         print("🧹 Cleaning up agent resources...")
         agent.cleanup()
+        metadata_embedder.close()  # fold pending agent notes into the compacted store
         if ollama_process:
             ollama_process.terminate()
         print("👋 Goodbye!")
@@ -322,7 +322,7 @@ class ToolFactory:
             self.metadata_embedder = MetadataEmbedder(self.sandbox)
 
         from tools.documentation_tools import DocumentLearningInsights
-        from tools.search_tools import SearchMetadataChunks
+        from tools.search_tools import SearchMetadataChunks, SearchMetadataBatch
         from tools.sql_tools import QuerySQLite, WriteQAtoSQLite
         from tools.graph_tools import WriteCypherForChunk, WriteGraphForChunk
         from tools.csv_tools import WriteCSVForChunk
@@ -338,6 +338,7 @@ class ToolFactory:
 
             # Retrieval over metadata + agent notes
             SearchMetadataChunks(sandbox=self.sandbox),
+            SearchMetadataBatch(sandbox=self.sandbox),
             WriteCSVForChunk(sandbox=self.sandbox),
             WriteGraphForChunk(sandbox=self.sandbox),
             WriteCypherForChunk(sandbox=self.sandbox),
@@ -0,0 +1,220 @@
+# src/utils/ann_index.py
+"""
+IVF-flat approximate nearest-neighbour index for the vector stores.
+
+The normalised rows of a store are clustered with spherical k-means; each row lives in
+the inverted list of its closest centroid. A query scores the centroids, then only the
+rows of the `nprobe` best lists (exact cosine on those rows).
+
+On disk the index sits next to the store as `<base>.ivf.npz`:
+  centroids (nlist, d) float32, order (n,) rows sorted by list, offsets (nlist + 1,),
+  keys (n,) uint64 per-row record keys, trained_rows (rows seen when k-means last ran).
+
+Updates are incremental: rows whose record key is already in the index keep their list,
+only new rows are assigned, and k-means is re-run once the store has grown well past
+the size it was trained on.
+"""
+from __future__ import annotations
+from typing import Any, Dict, Optional, Sequence, Tuple
+import hashlib, io, os
+import numpy as np
+
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "20000"))  # below this, brute force is fast enough
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "0"))          # 0 → IVFIndex.default_nprobe()
+RETRAIN_GROWTH = 2.0                                     # re-run k-means when rows > trained_rows * this
+
+
+def record_key(rec: Dict[str, Any]) -> int:
+    """Stable 64-bit key of a store record (note_id, else chunk hash + source, else content)."""
+    if rec.get("note_id"):
+        raw = f"n:{rec['note_id']}"
+    elif rec.get("chunk_sha256"):
+        raw = f"c:{rec.get('source', '')}:{rec.get('chunk_index', 0)}:{rec['chunk_sha256']}"
+    else:
+        raw = f"t:{rec.get('source', '')}:{rec.get('chunk_index', rec.get('chunk_id', 0))}:{rec.get('content', '')}"
+    return int.from_bytes(hashlib.blake2b(raw.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _nearest(mat: np.ndarray, centroids: np.ndarray, block: int = 65536) -> np.ndarray:
+    """Index of the closest centroid (max dot product) for every row, in blocks."""
+    out = np.empty(mat.shape[0], dtype=np.int32)
+    ct = np.ascontiguousarray(centroids.T)
+    for s in range(0, mat.shape[0], block):
+        out[s:s + block] = np.argmax(np.asarray(mat[s:s + block], dtype=np.float32) @ ct, axis=1)
+    return out
+
+
+def spherical_kmeans(mat: np.ndarray, nlist: int, iters: int = 12, sample: int = 0, seed: int = 0) -> np.ndarray:
+    """Unit-norm centroids for the rows of `mat` (k-means on the sphere, trained on a sample)."""
+    rng = np.random.default_rng(seed)
+    n = mat.shape[0]
+    sample = sample or min(n, max(nlist * 64, 10_000))
+    rows = np.sort(rng.choice(n, size=sample, replace=False)) if sample < n else np.arange(n)
+    x = np.asarray(mat[rows], dtype=np.float32)
+    cent = x[rng.choice(x.shape[0], size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest(x, cent)
+        sums = np.zeros_like(cent)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # re-seed empty lists with random training rows
+            sums[empty] = x[rng.choice(x.shape[0], size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        cent = sums / norms
+    return cent.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted-file index over the rows of one (n, d) normalised matrix."""
+    def __init__(self, centroids: np.ndarray, assign: np.ndarray, keys: np.ndarray, trained_rows: int):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.keys = np.asarray(keys, dtype=np.uint64)
+        self.trained_rows = int(trained_rows)
+        self._set_lists(np.asarray(assign, dtype=np.int32))
+
+    def _set_lists(self, assign: np.ndarray) -> None:
+        self.assign = assign
+        self.order = np.argsort(assign, kind="stable").astype(np.int64)
+        counts = np.bincount(assign, minlength=self.nlist)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    @property
+    def nlist(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @property
+    def dim(self) -> int:
+        return int(self.centroids.shape[1])
+
+    def __len__(self) -> int:
+        return int(self.assign.shape[0])
+
+    def default_nprobe(self) -> int:
+        return ANN_NPROBE or max(4, self.nlist // 16)
+
+    # -------- build / update --------
+    @classmethod
+    def build(cls, mat: np.ndarray, keys: np.ndarray, nlist: int = 0, iters: int = 12, seed: int = 0) -> "IVFIndex":
+        n = mat.shape[0]
+        nlist = nlist or max(1, min(4096, int(np.sqrt(n))))
+        nlist = min(nlist, n)
+        cent = spherical_kmeans(mat, nlist, iters=iters, seed=seed)
+        return cls(cent, _nearest(mat, cent), keys, trained_rows=n)
+
+    def update(self, mat: np.ndarray, keys: np.ndarray) -> "IVFIndex":
+        """
+        Index for a rewritten store: rows with a known key keep their list, new rows are
+        assigned to the nearest centroid; k-means re-runs after RETRAIN_GROWTH× growth.
+        """
+        n = mat.shape[0]
+        if n == 0 or mat.shape[1] != self.dim or n > self.trained_rows * RETRAIN_GROWTH:
+            return IVFIndex.build(mat, keys)
+        keys = np.asarray(keys, dtype=np.uint64)
+        sorter = np.argsort(self.keys, kind="stable")
+        sorted_keys = self.keys[sorter]
+        pos = np.searchsorted(sorted_keys, keys)
+        pos_c = np.minimum(pos, max(len(sorted_keys) - 1, 0))
+        known = (pos < len(sorted_keys)) & (sorted_keys[pos_c] == keys) if len(sorted_keys) else np.zeros(n, bool)
+        assign = np.empty(n, dtype=np.int32)
+        assign[known] = self.assign[sorter[pos_c[known]]]
+        new_rows = np.flatnonzero(~known)
+        if new_rows.size:
+            assign[new_rows] = _nearest(mat[new_rows], self.centroids)
+        return IVFIndex(self.centroids, assign, keys, self.trained_rows)
+
+    # -------- query --------
+    def candidates(self, q: np.ndarray, nprobe: int) -> np.ndarray:
+        """Rows in the `nprobe` lists whose centroids are closest to the (normalised) query."""
+        nprobe = max(1, min(int(nprobe), self.nlist))
+        cs = self.centroids @ q
+        lists = np.argpartition(-cs, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+        parts = [self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    def search(self, mat: np.ndarray, q: np.ndarray, k: int, nprobe: int = 0,
+               row_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate top-k (rows, scores) of `mat` for a normalised query, best first.
+        `row_mask` (bool per row) drops filtered rows from the probed lists before scoring.
+        """
+        from src.utils.vector_store import top_k_indices
+        cand = self.candidates(q, nprobe or self.default_nprobe())
+        if row_mask is not None:
+            cand = cand[row_mask[cand]]
+        if cand.size == 0:
+            return cand, np.empty(0, dtype=np.float32)
+        s = np.asarray(mat[cand], dtype=np.float32) @ q
+        best = top_k_indices(s, k)
+        return cand[best], s[best]
+
+    def recall_at_k(self, mat: np.ndarray, k: int = 10, nprobe: int = 0,
+                    n_queries: int = 200, seed: int = 0) -> float:
+        """
+        Self-check: mean overlap of the IVF top-k with the exact top-k, using perturbed
+        stored rows as queries.
+        """
+        from src.utils.vector_store import l2_normalize, top_k_indices
+        n = mat.shape[0]
+        if n == 0:
+            return 1.0
+        rng = np.random.default_rng(seed)
+        rows = rng.choice(n, size=min(n_queries, n), replace=False)
+        qs = np.asarray(mat[np.sort(rows)], dtype=np.float32)
+        qs = l2_normalize(qs + rng.normal(scale=0.05, size=qs.shape).astype(np.float32) / np.sqrt(qs.shape[1]))
+        hit = 0
+        for q in qs:
+            exact = set(top_k_indices(np.asarray(mat @ q), k).tolist())
+            approx = set(self.search(mat, q, k, nprobe)[0].tolist())
+            hit += len(exact & approx)
+        return hit / float(len(qs) * min(k, n))
+
+    # -------- persistence --------
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        np.savez(buf, centroids=self.centroids, assign=self.assign, keys=self.keys,
+                 trained_rows=np.asarray([self.trained_rows], dtype=np.int64))
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> Optional["IVFIndex"]:
+        try:
+            with np.load(io.BytesIO(raw)) as z:
+                return cls(z["centroids"], z["assign"], z["keys"], int(z["trained_rows"][0]))
+        except Exception:
+            return None
+
+
+def build_or_update(prev: Optional[IVFIndex], mat: np.ndarray, records: Sequence[Dict[str, Any]]) -> IVFIndex:
+    """Index for `mat`, whose row i belongs to records[i]; reuses `prev` assignments when possible."""
+    keys = np.asarray([record_key(r) for r in records], dtype=np.uint64)
+    if prev is not None:
+        return prev.update(mat, keys)
+    return IVFIndex.build(mat, keys)
+
+
+if __name__ == "__main__":
+    import argparse
+    from src.utils.vector_store import VectorStore
+
+    parser = argparse.ArgumentParser(prog="ann_index.py", description="Build an IVF index and check its recall")
+    parser.add_argument("store", help="store base path, e.g. embeddings/corpus_store")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[0])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--build", action="store_true", help="(re)build the index before checking")
+    args = parser.parse_args()
+
+    vs = VectorStore(args.store)
+    mat = vs.load_matrix()
+    idx = vs.load_ann()
+    if args.build or idx is None:
+        idx = vs.build_ann(force=True)
+    if idx is None:
+        raise SystemExit(f"No vectors in {args.store}")
+    for p in args.nprobe:
+        p = p or idx.default_nprobe()
+        r = idx.recall_at_k(mat, k=args.k, nprobe=p, n_queries=args.queries)
+        print(f"nlist={idx.nlist} nprobe={p} recall@{args.k}={r:.3f}")
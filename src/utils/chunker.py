@@ -0,0 +1,176 @@
+# src/utils/chunker.py
+"""
+Splits metadata files and session transcripts into token-bounded chunks, streaming.
+
+Text is read line by line from a file handle and grouped into units: blank-line separated
+paragraphs, or (turns=True) speaker turns such as "Therapist: ...", "Client_345: ..." or
+"T12 ..." / "C12 ..." with their continuation lines. Units are packed into chunks of at
+most `max_tokens` approximate tokens; each chunk starts with the trailing units of the
+previous one, up to `overlap_tokens`. Short units are packed, never dropped, and a unit
+longer than `max_tokens` is split on sentence, then word boundaries. Only the chunk being
+built (plus its overlap) is held in memory.
+"""
+from __future__ import annotations
+from typing import IO, Iterable, Iterator, List, Optional
+import re
+
+CHUNK_MAX_TOKENS = 200
+CHUNK_OVERLAP_TOKENS = 30
+CHUNK_MIN_TOKENS = 8  # a shorter final chunk is folded into the previous one if that stays <= max_tokens
+
+_TURN_RE = re.compile(
+    r"^\s*(?:\*\*)?(?:[TC]\d+\b|(?:Therapist|Client|Patient|Counsell?or|Interviewer|Speaker)"
+    r"(?:[ _]?\w*\d+)?\s*(?:\*\*)?\s*:)",
+    re.IGNORECASE,
+)
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def approx_tokens(text: str) -> int:
+    """Rough sub-word token count (~4 characters per token, at least one per word)."""
+    if not text:
+        return 0
+    return _tokens(len(text.split()), len(text))
+
+
+def _tokens(words: int, chars: int) -> int:
+    return max(words, (chars + 3) // 4)
+
+
+def iter_paragraphs(lines: Iterable[str]) -> Iterator[str]:
+    """Blank-line separated paragraphs."""
+    buf: List[str] = []
+    for line in lines:
+        if line.strip():
+            buf.append(line.rstrip("\r\n"))
+        elif buf:
+            yield "\n".join(buf).strip()
+            buf = []
+    if buf:
+        yield "\n".join(buf).strip()
+
+
+def iter_turns(lines: Iterable[str]) -> Iterator[str]:
+    """Speaker turns: a turn starts at a speaker tag and runs until the next one (blank lines kept out)."""
+    buf: List[str] = []
+    for line in lines:
+        if _TURN_RE.match(line) and buf:
+            yield "\n".join(buf).strip()
+            buf = []
+        if line.strip():
+            buf.append(line.rstrip("\r\n"))
+    if buf:
+        yield "\n".join(buf).strip()
+
+
+class _Packer:
+    """Texts joined by `sep`, with the token estimate of the joined string kept up to date."""
+    def __init__(self, sep: str):
+        self.sep = sep
+        self.items: List[tuple] = []  # (text, words, chars)
+        self.words = 0
+        self.chars = 0
+
+    @staticmethod
+    def measure(text: str) -> tuple:
+        return text, len(text.split()), len(text)
+
+    def tokens_with(self, item: Optional[tuple] = None) -> int:
+        if item is None:
+            return _tokens(self.words, self.chars)
+        sep = len(self.sep) if self.items else 0
+        return _tokens(self.words + item[1], self.chars + sep + item[2])
+
+    def add(self, item: tuple) -> None:
+        self.chars += item[2] + (len(self.sep) if self.items else 0)
+        self.words += item[1]
+        self.items.append(item)
+
+    def text(self) -> str:
+        return self.sep.join(x for x, _, _ in self.items)
+
+
+def _split_long(unit: str, max_tokens: int) -> Iterator[str]:
+    """Pieces of a unit that exceeds max_tokens: whole sentences where possible, else word runs."""
+    piece = _Packer(" ")
+    for sent in _SENTENCE_RE.split(unit):
+        parts = [sent] if approx_tokens(sent) <= max_tokens else sent.split()
+        for part in parts:
+            item = _Packer.measure(part)
+            if piece.items and piece.tokens_with(item) > max_tokens:
+                yield piece.text()
+                piece = _Packer(" ")
+            piece.add(item)
+    if piece.items:
+        yield piece.text()
+
+
+def iter_chunks(units: Iterable[str], max_tokens: int = CHUNK_MAX_TOKENS,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS,
+                sep: str = "\n\n") -> Iterator[str]:
+    """Pack units into chunks of <= max_tokens with `overlap_tokens` of trailing context carried over."""
+    max_tokens = max(1, int(max_tokens))
+    overlap_tokens = max(0, min(int(overlap_tokens), max_tokens // 2))
+    cur = _Packer(sep)
+    fresh = False          # cur holds text that has not been emitted yet
+    carried = 0            # leading items of cur that are overlap from the previous chunk
+    held: Optional[_Packer] = None
+
+    def _pieces() -> Iterator[tuple]:
+        for unit in units:
+            if not unit:
+                continue
+            if approx_tokens(unit) <= max_tokens:
+                yield _Packer.measure(unit)
+            else:
+                for p in _split_long(unit, max_tokens):
+                    yield _Packer.measure(p)
+
+    for item in _pieces():
+        if fresh and cur.tokens_with(item) > max_tokens:
+            if held is not None:
+                yield held.text()
+            held = cur
+            # keep the tail of this chunk as the head of the next one
+            keep = _Packer(sep)
+            for x in reversed(cur.items):
+                trial = _Packer(sep)
+                for y in [x] + keep.items:
+                    trial.add(y)
+                if trial.tokens_with() > overlap_tokens or trial.tokens_with(item) > max_tokens:
+                    break
+                keep = trial
+            cur, fresh, carried = keep, False, len(keep.items)
+        cur.add(item)
+        fresh = True
+
+    if fresh and held is not None:
+        # a short final chunk is folded into the previous one (its overlap is already there),
+        # unless that would take the previous chunk over max_tokens
+        tail = _Packer(sep)
+        for x in cur.items[carried:]:
+            tail.add(x)
+        if tail.tokens_with() < min_tokens:
+            merged = _Packer(sep)
+            for x in held.items + tail.items:
+                merged.add(x)
+            if merged.tokens_with() <= max_tokens:
+                held, fresh = merged, False
+    if held is not None:
+        yield held.text()
+    if fresh:
+        yield cur.text()
+
+
+def stream_chunks(fh: IO[str], max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                  turns: bool = False, min_tokens: int = CHUNK_MIN_TOKENS) -> Iterator[str]:
+    """Chunks of a text file handle; turns=True groups speaker turns (transcripts) instead of paragraphs."""
+    units = iter_turns(fh) if turns else iter_paragraphs(fh)
+    return iter_chunks(units, max_tokens=max_tokens, overlap_tokens=overlap_tokens, min_tokens=min_tokens,
+                       sep="\n" if turns else "\n\n")
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+               turns: bool = False, min_tokens: int = CHUNK_MIN_TOKENS) -> List[str]:
+    """stream_chunks over an in-memory string."""
+    return list(stream_chunks(iter(text.splitlines(True)), max_tokens, overlap_tokens, turns, min_tokens))
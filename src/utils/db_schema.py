@@ -0,0 +1,135 @@
+# src/utils/db_schema.py
+"""The therapy.db schema, defined in one place, and its forward-only migrations.
+
+Each migration is (version, name, steps); steps are SQL strings or callables taking the
+connection. Pending migrations run in version order, each in its own BEGIN IMMEDIATE
+transaction, and are recorded in `schema_version`. SQLiteManager runs migrate() when it
+opens its writer connection, so every tool sees the current schema on first connect.
+Never edit a released migration; append a new one.
+"""
+from __future__ import annotations
+from typing import Callable, List, Tuple, Union
+import sqlite3
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version    INTEGER PRIMARY KEY,
+    name       TEXT NOT NULL,
+    applied_at TEXT DEFAULT (datetime('now'))
+)
+"""
+
+# Turn-level transcript table (PK = one row per session turn)
+QA_PAIRS_DDL = """
+CREATE TABLE IF NOT EXISTS qa_pairs (
+    patient_id   TEXT NOT NULL,
+    session_type TEXT NOT NULL,
+    session_date TEXT NOT NULL,
+    turn_id      INTEGER NOT NULL,
+    speaker      TEXT,
+    text_raw     TEXT,
+    text_clean   TEXT,
+    PRIMARY KEY (patient_id, session_type, session_date, turn_id)
+)
+"""
+
+GRAPH_EVENTS_DDL = """
+CREATE TABLE IF NOT EXISTS graph_events (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id   TEXT,
+    session_date TEXT,
+    kind         TEXT, -- e.g. DISTORTION, EMOTION, STAGE
+    payload      TEXT, -- JSON blob
+    created_at   TEXT DEFAULT (datetime('now'))
+)
+"""
+
+CHUNKS_DDL = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_key TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    session_type TEXT NOT NULL,
+    session_date TEXT NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    created_at TEXT DEFAULT (datetime('now')),
+    UNIQUE(session_key, chunk_id)
+)
+"""
+
+Step = Union[str, Callable[[sqlite3.Connection], None]]
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _unify_qa_pairs(conn: sqlite3.Connection) -> None:
+    """
+    Older databases may hold the q/a/source variant of qa_pairs (id, q, a, source). It is
+    renamed to qa_pairs_legacy (kept, nothing is dropped) and its rows are copied into the
+    turn-level table the way WriteQAtoSQLite maps them: q → text_raw, a → text_clean, id → turn_id.
+    """
+    cols = _columns(conn, "qa_pairs")
+    if cols and "turn_id" not in cols:
+        conn.execute("ALTER TABLE qa_pairs RENAME TO qa_pairs_legacy")
+    conn.execute(QA_PAIRS_DDL)
+    if cols and "turn_id" not in cols and {"q", "a"} <= set(cols):
+        conn.execute("""
+            INSERT OR IGNORE INTO qa_pairs (patient_id, session_type, session_date, turn_id, text_raw, text_clean)
+            SELECT COALESCE(patient_id, 'unknown'), COALESCE(session_type, 'unknown'),
+                   COALESCE(session_date, 'unknown'), id, q, a
+            FROM qa_pairs_legacy
+        """)
+
+
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "base tables", [_unify_qa_pairs, GRAPH_EVENTS_DDL, CHUNKS_DDL]),
+    (2, "covering indexes", [
+        # per-speaker counts / turns of a session: answered from the index alone
+        "CREATE INDEX IF NOT EXISTS idx_qa_pairs_speaker ON qa_pairs (patient_id, session_date, speaker, turn_id)",
+        # cross-patient lookups by date
+        "CREATE INDEX IF NOT EXISTS idx_qa_pairs_date ON qa_pairs (session_date, session_type, patient_id, turn_id)",
+        "CREATE INDEX IF NOT EXISTS idx_graph_events_kind ON graph_events (kind, patient_id, session_date)",
+        "CREATE INDEX IF NOT EXISTS idx_graph_events_session ON graph_events (patient_id, session_date, kind)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    conn.execute(SCHEMA_VERSION_DDL)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return int(row[0] or 0)
+
+
+def migrate(conn: sqlite3.Connection) -> List[int]:
+    """
+    Apply pending migrations on an autocommit (isolation_level=None) connection.
+    Returns the versions applied; a concurrent migrator that got there first is skipped.
+    """
+    applied: List[int] = []
+    if current_version(conn) >= SCHEMA_VERSION:
+        return applied
+    for version, name, steps in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # re-checked under the write lock: another process may have migrated meanwhile
+            if current_version(conn) >= version:
+                conn.execute("COMMIT")
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        applied.append(version)
+    if applied:
+        conn.execute("PRAGMA optimize;")
+    return applied
@@ -1,7 +1,14 @@
 # src/utils/embeddings.py
 from __future__ import annotations
-import os, json, requests
-from typing import List, Sequence, Optional
+import itertools, os, json, time, hashlib, sqlite3, threading, warnings, requests
+import requests.adapters
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Sequence, Optional, Tuple
+import numpy as np
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embeddings/embed_cache.sqlite")
+HASH_IDF_PATH = "embeddings/hash_idf.npy"  # written by the first ingestion; HASH_EMBED_IDF overrides
 
 class BaseEmbedder:
     name: str = "dummy"
@@ -14,38 +21,124 @@ class BaseEmbedder:
     def batch_embed(self, texts: Sequence[str]) -> List[List[float]]:
         return [self.embed(t) for t in texts]
 
+    def warmup(self) -> None:
+        """Open connections ahead of the first real call (no-op by default)."""
+        return None
+
+class _EmbedEndpointMissing(Exception):
+    """The Ollama server has no /api/embed batch endpoint (404); use the single-text API."""
+
 class OllamaEmbedder(BaseEmbedder):
     """
     Uses Ollama local embeddings API.
     Models to try: "nomic-embed-text", "snowflake-arctic-embed", "mxbai-embed-large"
+
+    batch_embed sends whole lists to the batch endpoint (/api/embed, `input: [...]`) over a
+    pooled keep-alive session. The batch size adapts: it halves on errors/timeouts and grows
+    again while batches come back under `target_latency`. Older Ollama builds without
+    /api/embed fall back to bounded concurrent single calls on /api/embeddings.
     """
-    def __init__(self, host: str = "localhost", model: str = "nomic-embed-text", timeout: int = 45):
+    def __init__(self, host: str = "localhost", model: str = "nomic-embed-text", timeout: int = 45,
+                 batch_size: int = 32, max_batch_size: int = 256, concurrency: int = 4,
+                 target_latency: float = 2.0):
         self.host = host
         self.model = model
         self.url = f"http://{host}:11434/api/embeddings"
+        self.batch_url = f"http://{host}:11434/api/embed"
         self.timeout = timeout
         self.name = f"ollama:{model}"
         # we don’t know dim until first call; leave as None then set
         self.dim = 0
+        self.batch_size = max(1, batch_size)
+        self.max_batch_size = max(self.batch_size, max_batch_size)
+        self.concurrency = max(1, concurrency)
+        self.target_latency = target_latency
+        self._batch_supported: Optional[bool] = None  # unknown until the first batch call
+
+        # one keep-alive connection pool shared by every call (and the fallback workers)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _check(self, vec) -> List[float]:
+        if not isinstance(vec, list) or not vec:
+            raise RuntimeError(f"Ollama returned no embedding: {vec}")
+        if not self.dim:
+            self.dim = len(vec)
+        return vec
 
     def _call(self, text: str) -> List[float]:
         payload = {"model": self.model, "prompt": text}
-        r = requests.post(self.url, json=payload, timeout=self.timeout)
+        r = self.session.post(self.url, json=payload, timeout=self.timeout)
         r.raise_for_status()
         data = r.json()
         vec = data.get("embedding") or data.get("embeddings") or []
         if not isinstance(vec, list) or not vec:
             raise RuntimeError(f"Ollama returned no embedding: {data}")
-        if not self.dim:
-            self.dim = len(vec)
-        return vec
+        return self._check(vec)
+
+    def _call_batch(self, texts: Sequence[str]) -> List[List[float]]:
+        r = self.session.post(self.batch_url, json={"model": self.model, "input": list(texts)}, timeout=self.timeout)
+        if r.status_code == 404:
+            # a missing model is a 404 too ({"error": "model ... not found"}): that is not a reason
+            # to give up on batching, the caller has to pull the model
+            body = (getattr(r, "text", "") or "").strip()
+            if "model" in body.lower() and "not found" in body.lower():
+                raise RuntimeError(f"Ollama model {self.model!r} not available: {body}")
+            # pre-0.3 Ollama: no batch endpoint
+            self._batch_supported = False
+            raise _EmbedEndpointMissing("Ollama /api/embed not available")
+        r.raise_for_status()
+        vecs = r.json().get("embeddings") or []
+        if len(vecs) != len(texts):
+            raise RuntimeError(f"Ollama returned {len(vecs)} embeddings for {len(texts)} inputs")
+        self._batch_supported = True
+        return [self._check(v) for v in vecs]
+
+    def _concurrent_single(self, texts: Sequence[str]) -> List[List[float]]:
+        if len(texts) == 1:
+            return [self._call(texts[0])]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(texts))) as pool:
+            return list(pool.map(self._call, texts))
 
     def embed(self, text: str) -> List[float]:
-        return self._call(text)
+        return self.batch_embed([text])[0]
+
+    def warmup(self) -> None:
+        # establishes the keep-alive connection in the session pool
+        self.session.get(f"http://{self.host}:11434/api/version", timeout=5)
 
     def batch_embed(self, texts: Sequence[str]) -> List[List[float]]:
-        # simple loop; Ollama supports one text at a time on most builds
-        return [self._call(t) for t in texts]
+        texts = list(texts)
+        if not texts:
+            return []
+        if self._batch_supported is False:
+            return self._concurrent_single(texts)
+
+        out: List[List[float]] = []
+        i = 0
+        while i < len(texts):
+            batch = texts[i:i + self.batch_size]
+            t0 = time.perf_counter()
+            try:
+                vecs = self._call_batch(batch)
+            except _EmbedEndpointMissing:
+                return out + self._concurrent_single(texts[i:])
+            except (requests.Timeout, requests.ConnectionError, requests.HTTPError):
+                if self.batch_size == 1:
+                    raise
+                # back off: smaller batches are less likely to time out / OOM the runner
+                self.batch_size = max(1, self.batch_size // 2)
+                continue
+            elapsed = time.perf_counter() - t0
+            out.extend(vecs)
+            i += len(batch)
+            if elapsed < self.target_latency / 2 and len(batch) == self.batch_size:
+                self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+            elif elapsed > self.target_latency and self.batch_size > 1:
+                self.batch_size = max(1, self.batch_size // 2)
+        return out
 
 class OpenAIEmbedder(BaseEmbedder):
     def __init__(self, api_key: str, model: str = "text-embedding-3-small"):
@@ -59,11 +152,369 @@ class OpenAIEmbedder(BaseEmbedder):
         resp = self.client.embeddings.create(model=self.model, input=text)
         return resp.data[0].embedding
 
+    def batch_embed(self, texts: Sequence[str], batch_size: int = 256) -> List[List[float]]:
+        # the API caps inputs per request; send in slices
+        texts = list(texts)
+        out: List[List[float]] = []
+        for i in range(0, len(texts), batch_size):
+            resp = self.client.embeddings.create(model=self.model, input=texts[i:i + batch_size])
+            out.extend(d.embedding for d in resp.data)
+        return out
+
+# ---- offline hashing backend ----
+_HASH_P = np.uint64(0x100000001B3)  # odd → invertible mod 2**64
+_HASH_PINV = np.uint64(pow(0x100000001B3, -1, 2 ** 64))
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+def _byte_lut() -> np.ndarray:
+    # ascii letters/digits kept, other ascii → space, utf-8 continuation bytes kept
+    lut = np.full(256, 32, dtype=np.uint8)
+    for c in range(256):
+        ch = chr(c)
+        if c >= 128 or ch.isalnum():
+            lut[c] = c
+    return lut
+
+_LUT = _byte_lut()
+
+_POW_TABLES: Tuple[np.ndarray, np.ndarray] = (np.ones(1, dtype=np.uint64), np.ones(1, dtype=np.uint64))
+
+def _pow_tables(n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(P^i, P^-i) mod 2**64 for i < n; grown geometrically and shared by every batch."""
+    global _POW_TABLES
+    ppow, pinv = _POW_TABLES
+    if ppow.shape[0] < n:
+        size = max(n, 2 * ppow.shape[0], 1 << 16)
+        with np.errstate(over="ignore"):
+            ppow = np.ones(size, dtype=np.uint64)
+            ppow[1:] = np.cumprod(np.full(size - 1, _HASH_P, dtype=np.uint64))
+            pinv = np.ones(size, dtype=np.uint64)
+            pinv[1:] = np.cumprod(np.full(size - 1, _HASH_PINV, dtype=np.uint64))
+        _POW_TABLES = (ppow, pinv)
+    return ppow, pinv
+
+class HashingEmbedder(BaseEmbedder):
+    """
+    Offline embedder: feature-hashed word unigrams/bigrams + character n-grams with
+    sublinear TF (and IDF once `fit` has seen a corpus), L2-normalised to a fixed dim.
+
+    A whole batch is processed as one byte array: character n-gram hashes are rolled
+    forward one byte at a time, word hashes come from a polynomial prefix sum, and features
+    are scattered with a single weighted np.bincount over (row, feature type, col) → ±1
+    pairs — a COO sparse sum without SciPy. A text's vector does not depend on the rest of
+    its batch. Roughly 8-9k ~1 kB chunks/s on one core: every byte feeds three character
+    n-grams plus its word and bigram, so NumPy passes over the bytes bound the throughput.
+    """
+    def __init__(self, dim: int = 1024, char_ngrams: Sequence[int] = (3, 4, 5),
+                 weights: Tuple[float, float, float] = (1.0, 0.7, 0.3),
+                 idf: Optional[np.ndarray] = None, max_batch_bytes: int = 262_144):
+        self.dim = int(dim)
+        self.char_ngrams = tuple(char_ngrams)
+        self.w_word, self.w_bigram, self.w_char = weights
+        self.max_batch_bytes = max_batch_bytes
+        self.idf: Optional[np.ndarray] = None
+        self.name = f"hashing:{self.dim}"
+        if idf is not None:
+            self._set_idf(np.asarray(idf, dtype=np.float32))
+
+    def _set_idf(self, idf: np.ndarray) -> None:
+        self.idf = idf
+        digest = hashlib.sha1(idf.tobytes()).hexdigest()[:8]
+        self.name = f"hashing:{self.dim}+idf{digest}"
+
+    def embed(self, text: str) -> List[float]:
+        return self.batch_embed([text])[0]
+
+    def batch_embed(self, texts: Sequence[str]) -> List[List[float]]:
+        return self.embed_matrix(texts).tolist()
+
+    def embed_matrix(self, texts: Sequence[str]) -> np.ndarray:
+        """(len(texts), dim) float32 matrix; the list-returning API wraps this."""
+        texts = list(texts)
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        i = 0
+        while i < len(texts):
+            j, size = i, 0
+            while j < len(texts) and (j == i or size + len(texts[j]) <= self.max_batch_bytes):
+                size += len(texts[j]) + 1
+                j += 1
+            out[i:j] = self._tf(texts[i:j])
+            i = j
+        if self.idf is not None:
+            out *= self.idf
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+    def fit(self, texts: Iterable[str], batch_size: int = 4096) -> "HashingEmbedder":
+        """
+        Learn per-bucket IDF from a corpus, streamed batch_size texts at a time (changes `name`,
+        so stores built before are flagged). An empty corpus leaves the embedder unchanged.
+        """
+        it = iter(texts)
+        df = np.zeros(self.dim, dtype=np.float64)
+        n = 0
+        while True:
+            batch = list(itertools.islice(it, batch_size))
+            if not batch:
+                break
+            df += np.count_nonzero(self._tf(batch), axis=0)
+            n += len(batch)
+        if n:
+            self._set_idf((np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float32))
+        return self
+
+    def save_idf(self, path: str) -> None:
+        """Persist the fitted IDF (point HASH_EMBED_IDF at it to reuse across runs)."""
+        if self.idf is None:
+            raise ValueError("HashingEmbedder.save_idf: call fit() first")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.save(path, self.idf)
+
+    def _tf(self, texts: List[str]) -> np.ndarray:
+        n_docs = len(texts)
+        dim = self.dim
+        # per doc: 3 feature types (char, word, bigram) × dim signed buckets
+        row_width = 3 * dim
+        # one space-separated byte stream for the whole batch; runs of spaces collapsed
+        blobs = [(" " + t.lower() + " ").encode("utf-8") for t in texts]
+        raw = _LUT[np.frombuffer(b"".join(blobs), dtype=np.uint8)]
+        lengths = np.fromiter((len(x) for x in blobs), dtype=np.int64, count=n_docs)
+        doc_start = np.zeros(raw.shape[0], dtype=bool)
+        doc_start[np.cumsum(lengths)[:-1]] = True
+        keep = np.ones(raw.shape[0], dtype=bool)
+        keep[1:] = (raw[1:] != 32) | (raw[:-1] != 32)
+        keep |= doc_start  # never collapse across a doc boundary
+        b = raw[keep].astype(np.uint64)
+        doc_start = doc_start[keep]
+        n = b.shape[0]
+        if n == 0:
+            return np.zeros((n_docs, dim), dtype=np.float32)
+        starts_of_docs = np.flatnonzero(doc_start)  # docs 1..n_docs-1 (doc 0 starts at 0)
+        row_of = np.repeat(np.arange(n_docs, dtype=np.int64) * row_width,
+                           np.diff(np.concatenate(([0], starts_of_docs, [n]))))
+        shift = np.uint64(32)
+        uwidth = np.uint64(2 * dim)
+        idx_parts: List[np.ndarray] = []
+        sign_parts: List[np.ndarray] = []
+
+        def add(h: np.ndarray, rows: np.ndarray, salt: int, ftype: int, drop: Optional[np.ndarray] = None) -> None:
+            # Fibonacci hashing + multiply-shift range reduction into [0, 2·dim); the upper half is the sign
+            x = (h ^ np.uint64(salt)) * _GOLDEN
+            x >>= shift
+            x *= uwidth
+            x >>= shift
+            v = x.view(np.int64)
+            neg = v >= dim
+            v -= neg * dim
+            v += rows
+            if ftype:
+                v += ftype * dim
+            sign = 1.0 - 2.0 * neg
+            idx_parts.append(v)
+            sign_parts.append(sign)
+            if drop is not None and drop.size:
+                idx_parts.append(v[drop])
+                sign_parts.append(-sign[drop])
+
+        with np.errstate(over="ignore"):
+            # character n-grams over " word word " (spaces mark word edges), within one doc:
+            # h_k[i] = h_{k-1}[i]·P + b[i+k-1]
+            h = b
+            for k in range(2, max(self.char_ngrams) + 1):
+                h = h[:-1] * _HASH_P + b[k - 1:]
+                if k not in self.char_ngrams:
+                    continue
+                cut = (starts_of_docs[:, None] - np.arange(1, k)[None, :]).ravel()
+                # unique: with docs shorter than k-1 bytes one n-gram straddles several boundaries
+                cut = np.unique(cut[(cut >= 0) & (cut < h.shape[0])])
+                # n-grams straddling two docs are counted, then taken back out (negated copies)
+                add(h, row_of[:h.shape[0]], 0x165667B19E3779F9 + k, 0, drop=cut)
+
+            # words: maximal non-space runs, hashed from prefix sums
+            # S[i] = sum_{j<i} b[j]·P^-j  ⇒  hash(b[a:e]) = (S[e] - S[a]) · P^(e-1)
+            is_sp = b == 32
+            starts = np.flatnonzero(~is_sp[1:] & is_sp[:-1]) + 1
+            ends = np.flatnonzero(~is_sp[:-1] & is_sp[1:]) + 1
+            m = min(len(starts), len(ends))
+            if m:
+                starts, ends = starts[:m], ends[:m]
+                ppow, pinv = _pow_tables(n)
+                S = np.zeros(n + 1, dtype=np.uint64)
+                np.cumsum(b * pinv[:n], out=S[1:])
+                wh = (S[ends] - S[starts]) * ppow[ends - 1]
+                wrow = row_of[starts]
+                add(wh, wrow, 0x9E3779B97F4A7C15, 1)
+                same = wrow[1:] == wrow[:-1]
+                if same.any():
+                    nxt = wh[1:][same]
+                    bh = wh[:-1][same] * _HASH_P + (nxt ^ (nxt >> np.uint64(29)))
+                    add(bh, wrow[:-1][same], 0xC2B2AE3D27D4EB4F, 2)
+
+        # ±1 weights sum exactly, so opposite-signed hits cancel to 0 as integer counts did
+        signed = np.bincount(np.concatenate(idx_parts), weights=np.concatenate(sign_parts),
+                             minlength=n_docs * row_width).reshape(n_docs, 3, dim).astype(np.float32)
+        w = np.asarray([self.w_char, self.w_word, self.w_bigram], dtype=np.float32)
+        tf = np.einsum("t,ntd->nd", w, signed)
+        # sublinear TF, sign preserved
+        return np.sign(tf) * np.log1p(np.abs(tf))
+
+class CachedEmbedder(BaseEmbedder):
+    """
+    Content-addressed embedding cache that wraps any BaseEmbedder.
+    Keyed by (embedder.name, embedder.dim, sha256(text)); an in-memory LRU sits in front of a
+    SQLite file, which is trimmed (least recently used first) once it grows past `max_bytes`.
+    A backend that learns its dim on the first call (Ollama) matches rows of any dim until then.
+    """
+    def __init__(self, inner: BaseEmbedder, path: str = EMBED_CACHE_PATH,
+                 max_bytes: int = 512 * 1024 * 1024, lru_size: int = 4096):
+        self.inner = inner
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lru_size = lru_size
+        self._lru: "OrderedDict[Tuple[str, int, str], List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0       # served from memory or disk
+        self.disk_hits = 0  # subset of hits that came from SQLite
+        self.misses = 0     # sent to the wrapped embedder
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embed_cache ("
+            "model TEXT NOT NULL, key TEXT NOT NULL, dim INTEGER, vec BLOB, "
+            "last_used REAL, PRIMARY KEY (model, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embed_cache_last_used ON embed_cache(last_used)")
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embed_cache").fetchone()
+        self._disk_bytes = int(row[0] or 0)
+
+    @property
+    def name(self) -> str:
+        return getattr(self.inner, "name", "unknown")
+
+    @property
+    def dim(self) -> int:
+        return getattr(self.inner, "dim", 0)
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lru_put(self, key: Tuple[str, int, str], vec: List[float]) -> None:
+        self._lru[key] = vec
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def embed(self, text: str) -> List[float]:
+        return self.batch_embed([text])[0]
+
+    def warmup(self) -> None:
+        self.inner.warmup()
+
     def batch_embed(self, texts: Sequence[str]) -> List[List[float]]:
-        resp = self.client.embeddings.create(model=self.model, input=list(texts))
-        return [d.embedding for d in resp.data]
+        texts = list(texts)
+        keys = [self._key(t) for t in texts]
+        found: Dict[str, List[float]] = {}
+        model, dim = self.name, self.dim
+
+        with self._lock:
+            for k in keys:
+                if (model, dim, k) in self._lru:
+                    self._lru.move_to_end((model, dim, k))
+                    found[k] = self._lru[(model, dim, k)]
+            wanted = [k for k in dict.fromkeys(keys) if k not in found]
+            now = time.time()
+            for i in range(0, len(wanted), 500):
+                part = wanted[i:i + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embed_cache WHERE model = ? AND (? = 0 OR dim = ?) AND key IN ({marks})",
+                    [model, dim, dim, *part],
+                ).fetchall()
+                for k, blob in rows:
+                    vec = np.frombuffer(blob, dtype=np.float32).tolist()
+                    found[k] = vec
+                    self._lru_put((model, dim, k), vec)
+                    self.disk_hits += 1
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embed_cache SET last_used = ? WHERE model = ? AND key IN ({','.join('?' * len(rows))})",
+                        [now, model, *[k for k, _ in rows]],
+                    )
+
+        # embed the misses (deduplicated) outside the lock; the backend may be slow
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        if missing:
+            vecs = self.inner.batch_embed(list(missing.values()))
+            with self._lock:
+                rows = []
+                for k, vec in zip(missing, vecs):
+                    vec = [float(x) for x in vec]
+                    found[k] = vec
+                    self._lru_put((model, dim, k), vec)
+                    blob = np.asarray(vec, dtype=np.float32).tobytes()
+                    rows.append((model, k, len(vec), blob, now))
+                    self._disk_bytes += len(blob)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embed_cache (model, key, dim, vec, last_used) VALUES (?, ?, ?, ?, ?)", rows
+                )
+                self._conn.commit()
+                if self._disk_bytes > self.max_bytes:
+                    self._evict()
+        else:
+            with self._lock:
+                self._conn.commit()
 
-def get_embedder_from_env() -> BaseEmbedder:
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - sum(1 for k in keys if k in missing)
+        return [found[k] for k in keys]
+
+    def _evict(self) -> None:
+        """Drop least recently used rows until the file is back under 90% of max_bytes."""
+        target = int(self.max_bytes * 0.9)
+        while self._disk_bytes > target:
+            rows = self._conn.execute(
+                "SELECT model, key, LENGTH(vec) FROM embed_cache ORDER BY last_used ASC LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                break
+            drop = []
+            for model, key, size in rows:
+                drop.append((model, key))
+                self._disk_bytes -= int(size or 0)
+                self.evictions += 1
+                if self._disk_bytes <= target:
+                    break
+            self._conn.executemany("DELETE FROM embed_cache WHERE model = ? AND key = ?", drop)
+        self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate_pct": round(100 * self.hits / total) if total else 0,
+                "lru_items": len(self._lru),
+                "disk_bytes": self._disk_bytes,
+            }
+
+def _uncached_embedder_from_env() -> BaseEmbedder:
+    backend = os.getenv("EMBED_BACKEND", "").lower()
+    if backend == "dummy":
+        return BaseEmbedder()
+    if backend == "hashing":
+        return _hashing_from_env()
     # Prefer Ollama if explicitly enabled
     if os.getenv("USE_OLLAMA_EMBEDDINGS", "false").lower() == "true":
         host = os.getenv("OLLAMA_HOST", "localhost")
@@ -72,5 +523,137 @@ def get_embedder_from_env() -> BaseEmbedder:
     # OpenAI if key present
     if os.getenv("OPENAI_API_KEY"):
         return OpenAIEmbedder(api_key=os.getenv("OPENAI_API_KEY"))
-    # Fallback dummy
-    return BaseEmbedder()
+    # Offline fallback (air-gapped boxes): hashed n-gram TF-IDF
+    return _hashing_from_env()
+
+def _hashing_from_env() -> HashingEmbedder:
+    dim = int(os.getenv("HASH_EMBED_DIM", "1024"))
+    idf_path = os.getenv("HASH_EMBED_IDF", "") or HASH_IDF_PATH
+    idf = None
+    if idf_path and os.path.exists(idf_path):
+        try:
+            idf = np.load(idf_path)
+            if idf.shape != (dim,):
+                raise ValueError(f"IDF has shape {idf.shape}, HASH_EMBED_DIM is {dim}")
+        except Exception as e:
+            idf = None
+            warnings.warn(f"ignoring hashing IDF {idf_path} ({e})", RuntimeWarning, stacklevel=2)
+    return HashingEmbedder(dim=dim, idf=idf)
+
+def get_embedder_from_env(cache: Optional[bool] = None) -> BaseEmbedder:
+    """
+    Embedder for the configured backend, wrapped in a CachedEmbedder by default
+    (EMBED_CACHE=false or cache=False disables it; the local dummy/hashing backends are
+    cheaper to recompute than to look up, so they are never cached).
+    """
+    inner = _uncached_embedder_from_env()
+    if cache is None:
+        cache = os.getenv("EMBED_CACHE", "true").lower() == "true"
+    if not cache or type(inner) is BaseEmbedder or isinstance(inner, HashingEmbedder):
+        return inner
+    try:
+        return CachedEmbedder(inner)
+    except Exception as e:
+        warnings.warn(f"embedding cache disabled ({e})", RuntimeWarning, stacklevel=2)
+        return inner
+
+# ---- process-wide registry ----
+_REGISTRY: Dict[Tuple[str, ...], BaseEmbedder] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+def _idf_identity() -> str:
+    """Path, mtime and size of the hashing IDF file ("" if absent): a fitted or replaced IDF is a new embedder."""
+    path = os.getenv("HASH_EMBED_IDF", "") or HASH_IDF_PATH
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    return f"{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}"
+
+def _registry_key(cache: bool) -> Tuple[str, ...]:
+    backend = os.getenv("EMBED_BACKEND", "").lower()
+    if backend == "dummy":
+        return (backend,)
+    if backend == "hashing":
+        return (backend, os.getenv("HASH_EMBED_DIM", "1024"), _idf_identity())
+    if os.getenv("USE_OLLAMA_EMBEDDINGS", "false").lower() == "true":
+        return ("ollama", os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text"), os.getenv("OLLAMA_HOST", "localhost"), str(cache))
+    if os.getenv("OPENAI_API_KEY"):
+        return ("openai", "text-embedding-3-small", str(cache))
+    return ("hashing", os.getenv("HASH_EMBED_DIM", "1024"), _idf_identity())
+
+def get_shared_embedder(cache: Optional[bool] = None) -> BaseEmbedder:
+    """
+    One embedder per (backend, model) for the whole process, shared by SearchMetadataChunks,
+    MetadataEmbedder and ToolFactory. Connections are warmed in the background on first use.
+    """
+    if cache is None:
+        cache = os.getenv("EMBED_CACHE", "true").lower() == "true"
+    key = _registry_key(cache)
+    with _REGISTRY_LOCK:
+        emb = _REGISTRY.get(key)
+        if emb is None:
+            emb = get_embedder_from_env(cache=cache)
+            _REGISTRY[key] = emb
+            threading.Thread(target=_warm, args=(emb,), name="embedder-warmup", daemon=True).start()
+    return emb
+
+def _warm(emb: BaseEmbedder) -> None:
+    try:
+        emb.warmup()
+    except Exception:
+        pass  # first real call will surface connection problems
+
+class _QueryMemo:
+    """Small LRU of query text → vector per embedder name; repeated agent queries cost nothing."""
+    def __init__(self, size: int = 512):
+        self.size = size
+        self._items: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, embedder: BaseEmbedder, text: str) -> List[float]:
+        key = (getattr(embedder, "name", "unknown"), text)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        vec = embedder.embed(text)
+        self._put(key, vec)
+        return vec
+
+    def get_many(self, embedder: BaseEmbedder, texts: Sequence[str]) -> List[List[float]]:
+        """Memo hits are reused; all misses go to the backend as one batch_embed call."""
+        name = getattr(embedder, "name", "unknown")
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        missing: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, t in enumerate(texts):
+                key = (name, t)
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    out[i] = self._items[key]
+                else:
+                    missing.setdefault(t, []).append(i)
+        if missing:
+            uniq = list(missing)
+            for t, vec in zip(uniq, embedder.batch_embed(uniq)):
+                self._put((name, t), vec)
+                for i in missing[t]:
+                    out[i] = vec
+        return out  # type: ignore[return-value]
+
+    def _put(self, key: Tuple[str, str], vec: List[float]) -> None:
+        with self._lock:
+            self._items[key] = vec
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+_QUERY_MEMO = _QueryMemo()
+
+def embed_query(text: str, embedder: Optional[BaseEmbedder] = None) -> List[float]:
+    """Embed a search query through the shared embedder, memoised in an LRU."""
+    return _QUERY_MEMO.get(embedder or get_shared_embedder(), text)
+
+def embed_queries(texts: Sequence[str], embedder: Optional[BaseEmbedder] = None) -> List[List[float]]:
+    """Embed several queries with one batched backend call (memoised like embed_query)."""
+    return _QUERY_MEMO.get_many(embedder or get_shared_embedder(), list(texts))
@@ -3,7 +3,7 @@ import os, json
 from typing import Any, Dict
 from . import config as C
 from .session_paths import session_paths_for_chunk
-import sqlite3
+from .sqlite_helpers import get_sqlite_manager
 
 """
 This creates the nested directories and files (like './export/{PATIENT_ID}/...' for usage as 'PATIENT_ID / SESSION_TYPE / SESSION_DATE')
@@ -111,10 +111,9 @@ class ExportWriter:
         host_path = self.sqlite_path_host
         os.makedirs(os.path.dirname(host_path), exist_ok=True)
 
-        # Touch DB file if missing on host
+        # Create the DB (WAL mode, tuned PRAGMAs) through the shared manager if missing on host
         if not os.path.exists(host_path):
-            conn = sqlite3.connect(host_path)
-            conn.close()
+            get_sqlite_manager(host_path).write(lambda conn: None)
 
         paths: Dict[str, str] = {"host": host_path}
 
@@ -1,9 +1,11 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from pathlib import Path
-import json, sqlite3
+import json
 import pandas as pd
 from .config import BASE_EXPORT, E2B_MIRROR_DIR, DB_PATH
+from .db_schema import QA_PAIRS_DDL
+from .sqlite_helpers import get_sqlite_manager
 
 @dataclass
 class SessionKey:
@@ -45,37 +47,31 @@ def save_csv(df: pd.DataFrame, sk: SessionKey, chunk_index: int) -> Path:
     return p
 
 # ——— SQLite ———
-QAPAIRS_DDL = (
-    "CREATE TABLE IF NOT EXISTS qa_pairs ("
-    "patient_id TEXT, session_date TEXT, session_type TEXT,"
-    "turn_id INTEGER, speaker TEXT, text_raw TEXT, text_clean TEXT,"
-    "PRIMARY KEY (patient_id, session_date, session_type, turn_id)"
-    ")"
-)
+QAPAIRS_DDL = QA_PAIRS_DDL  # single definition in db_schema.py
 
 def sqlite_upsert_df(df: pd.DataFrame, sk: SessionKey):
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute(QAPAIRS_DDL)
-        # create a temp table then upsert to keep pk intact
-        df_tmp = df.copy()
-        df_tmp.insert(0, "patient_id", sk.patient_id)
-        df_tmp.insert(1, "session_date", sk.session_date)
-        df_tmp.insert(2, "session_type", sk.session_type)
-        df_tmp.to_sql("_qa_pairs_tmp", con, if_exists="replace", index=False)
-        con.execute(
-            """
-            INSERT INTO qa_pairs
-            SELECT * FROM _qa_pairs_tmp
-            ON CONFLICT(patient_id, session_date, session_type, turn_id) DO UPDATE SET
-            speaker=excluded.speaker,
-            text_raw=excluded.text_raw,
-            text_clean=excluded.text_clean
-            """
-        )
-        con.execute("DROP TABLE _qa_pairs_tmp")
+    db = get_sqlite_manager(str(DB_PATH))
+    # upsert on the PK; columns are named, so the DataFrame's column order doesn't matter
+    turns = df[["turn_id", "speaker", "text_raw", "text_clean"]].astype(object)
+    turns = turns.where(turns.notna(), None)  # NaN → NULL
+    rows = (
+        (sk.patient_id, sk.session_type, sk.session_date, int(tid), spk, raw, clean)
+        for tid, spk, raw, clean in turns.itertuples(index=False)
+    )
+    db.bulk_write(
+        """
+        INSERT INTO qa_pairs (patient_id, session_type, session_date, turn_id, speaker, text_raw, text_clean)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(patient_id, session_type, session_date, turn_id) DO UPDATE SET
+        speaker=excluded.speaker,
+        text_raw=excluded.text_raw,
+        text_clean=excluded.text_clean
+        """,
+        rows,
+    )
     # mirror DB file if desired
     try:
+         db.checkpoint()  # WAL → main file before copying it
          _maybe_mirror_write(DB_PATH, DB_PATH.read_bytes())
     except Exception:
         pass
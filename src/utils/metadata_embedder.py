@@ -1,42 +1,22 @@
-from src.utils.embeddings import get_embedder_from_env, BaseEmbedder
+from src.utils.embeddings import HASH_IDF_PATH, HashingEmbedder, get_shared_embedder, BaseEmbedder
+from src.utils.vector_store import VectorStore
+from src.utils.notes_store import NotesLog, AGENT_NOTES_BASE
+from src.utils.shards import ALL_PATIENTS, CORPUS_SHARD, NOTES_SHARD, list_shard_bases, record_shard, shard_base, shard_dir
+from src.utils.config import PATIENT_ID, SESSION_DATE
+from src.utils.chunker import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, chunk_text, stream_chunks
 from dataclasses import dataclass
-import os, json, hashlib
-from typing import Optional, Dict, List, Any
-import argparse
-try:
-    # If you added the helper earlier, prefer it:
-    from src.utils.embeddings import get_embedder_from_env, BaseEmbedder
-except Exception:
-    # Fallback inline minimal embedders (dummy + OpenAI if available)
-    class BaseEmbedder:  # type: ignore
-        name: str = "dummy"
-        dim: int = 10
-        def embed(self, text: str) -> List[float]:
-            v = float(len(text) % 10)
-            return [v] * self.dim
-        def batch_embed(self, texts): return [self.embed(t) for t in texts]
-
-    def get_embedder_from_env():  # type: ignore
-        # Try OpenAI only if key exists
-        if os.getenv("OPENAI_API_KEY"):
-            try:
-                from openai import OpenAI
-                class OpenAIEmbedder(BaseEmbedder):
-                    def __init__(self, api_key: str, model: str = "text-embedding-3-small"):
-                        self.client = OpenAI(api_key=api_key)
-                        self.model = model
-                        self.name = f"openai:{model}"
-                        self.dim = 1536
-                    def embed(self, text: str) -> List[float]:
-                        resp = self.client.embeddings.create(model=self.model, input=text)
-                        return resp.data[0].embedding
-                return OpenAIEmbedder(os.getenv("OPENAI_API_KEY"))
-            except Exception:
-                pass
-        # Dummy fallback
-        return BaseEmbedder()
+import os, json, hashlib, multiprocessing, tempfile, threading, time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Optional, Dict, List, Any, Callable, Iterator, Tuple
 
 SUPPORTED_EXTS = (".md", ".json", ".yaml", ".yml", ".txt")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0"))             # 0 → min(cpu count, 8)
+PARALLEL_MIN_FILES = 8                                             # fewer files are read in-process
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))       # chunks per embedding request
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "2"))       # embedding requests in flight
+CHECKPOINT_SECONDS = float(os.getenv("EMBED_CHECKPOINT_SECONDS", "10"))  # partial-store writes in background runs
+CHUNK_SPILL_BYTES = int(os.getenv("CHUNK_SPILL_BYTES", str(1 << 20)))  # larger files spill their chunks to disk
 
 def _is_supported_file(path: str) -> bool:
     return os.path.splitext(path)[1].lower() in SUPPORTED_EXTS
@@ -44,12 +24,256 @@ def _is_supported_file(path: str) -> bool:
 def _doc_id(source_path: str) -> str:
     return hashlib.sha1(source_path.encode("utf-8")).hexdigest()[:12]
 
+def _chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _walk_files(root: str, skip_dirs: set) -> Iterator[str]:
+    """Files under root, recursively, in a stable order; directories named in skip_dirs are pruned."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in skip_dirs and not d.startswith("."))
+        for name in sorted(filenames):
+            yield os.path.join(dirpath, name)
+
+def _hashed_lines(f, h) -> Iterator[str]:
+    """Decoded lines of a binary file handle, feeding every byte into the hash `h` as it is read."""
+    for raw in f:
+        h.update(raw)
+        yield raw.decode("utf-8")
+
+class _SpilledChunks:
+    """
+    Chunks of a large file, one JSON string per line in a temp file. Iterating streams them
+    back and deletes the file; discard() drops it unread. Only the path crosses processes.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        finally:
+            self.discard()
+
+    def discard(self) -> None:
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def _discard(chunks: Any) -> None:
+    if isinstance(chunks, _SpilledChunks):
+        chunks.discard()
+
+def _read_and_chunk(fpath: str, turns: bool = False, max_tokens: int = CHUNK_MAX_TOKENS,
+                    overlap_tokens: int = CHUNK_OVERLAP_TOKENS, spill_bytes: int = CHUNK_SPILL_BYTES,
+                    ) -> Tuple[Optional[str], Any, Optional[str]]:
+    """
+    (sha256, chunks, error) for one file, streamed line by line; runs in the ingest process pool.
+    Files over spill_bytes hold one chunk at a time: their chunks go to a _SpilledChunks file
+    instead of a list, so neither the worker nor the result grows with the file.
+    """
+    h = hashlib.sha256()
+    spill: Optional[str] = None
+    try:
+        with open(fpath, "rb") as f:
+            chunks_iter = stream_chunks(_hashed_lines(f, h), max_tokens=max_tokens,
+                                        overlap_tokens=overlap_tokens, turns=turns)
+            if os.fstat(f.fileno()).st_size <= spill_bytes:
+                chunks: Any = list(chunks_iter)
+            else:
+                fd, spill = tempfile.mkstemp(prefix="chunks-", suffix=".jsonl")
+                with os.fdopen(fd, "w", encoding="utf-8") as out:
+                    for chunk in chunks_iter:
+                        out.write(json.dumps(chunk) + "\n")
+                chunks = _SpilledChunks(spill)
+    except Exception as e:
+        if spill:
+            _SpilledChunks(spill).discard()
+        return None, None, str(e)
+    return h.hexdigest(), chunks, None
+
+def _read_and_chunk_all(paths: List[str], turns: List[bool], max_tokens: int, overlap_tokens: int,
+                        workers: Optional[int] = None) -> Iterator[tuple]:
+    """
+    _read_and_chunk over paths, in order; a process pool is used once there are enough files.
+    Workers start via forkserver (spawn where unavailable), never fork: ingestion runs on the
+    background embedding thread next to the agent's threads and SQLite/HTTP pools.
+    """
+    workers = workers or INGEST_WORKERS or min(os.cpu_count() or 1, 8)
+    if workers <= 1 or len(paths) < PARALLEL_MIN_FILES:
+        for p, t in zip(paths, turns):
+            yield _read_and_chunk(p, t, max_tokens, overlap_tokens)
+        return
+    n = len(paths)
+    with ProcessPoolExecutor(max_workers=min(workers, n), mp_context=_pool_context()) as pool:
+        yield from pool.map(_read_and_chunk, paths, turns, [max_tokens] * n, [overlap_tokens] * n,
+                            chunksize=max(1, n // (workers * 4)))
+
+def _pool_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+class _EmbedPipeline:
+    """
+    Chunks are buffered into batches of `batch_size` and embedded on `concurrency` threads while
+    the caller keeps reading files; at most 2 × concurrency batches are in flight (add() blocks).
+    """
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], embedder,
+                 batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY):
+        self.embed_batch = embed_batch
+        self.dim = getattr(embedder, "dim", 0)
+        self.batch_size = max(1, int(batch_size))
+        self.concurrency = max(1, int(concurrency))
+        self._slots = threading.BoundedSemaphore(2 * self.concurrency)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._futures: list = []
+        self._buf: List[dict] = []
+        self._lock = threading.Lock()
+        self._t0: Optional[float] = None
+        self.queued = 0
+        self.done = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def add(self, rec: dict) -> None:
+        self._buf.append(rec)
+        self.queued += 1
+        if len(self._buf) >= self.batch_size:
+            self._submit()
+
+    def _submit(self) -> None:
+        batch, self._buf = self._buf, []
+        if not batch:
+            return
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed")
+            self._t0 = time.perf_counter()
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._run, batch))
+
+    def _run(self, batch: List[dict]) -> None:
+        try:
+            vecs = self.embed_batch([rec["content"] for rec in batch])
+            for rec, vec in zip(batch, vecs):
+                rec["embedding"] = vec
+                rec["embedding_dim"] = self.dim or len(vec)
+            with self._lock:
+                self.done += len(batch)
+                self.batches += 1
+        finally:
+            self._slots.release()
+
+    def finish(self, tick: Optional[Callable[[], None]] = None, interval: float = CHECKPOINT_SECONDS) -> None:
+        """
+        Flush the last batch and wait for all of them; re-raises the first embedding error.
+        tick() is called every `interval` seconds while batches are still running.
+        """
+        self._submit()
+        if self._pool is None:
+            return
+        try:
+            pending = set(self._futures)
+            while pending:
+                done, pending = wait(pending, timeout=interval if tick else None, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    fut.result()
+                if pending and tick:
+                    tick()
+        finally:
+            self._pool.shutdown(wait=True)
+            self.elapsed = time.perf_counter() - (self._t0 or time.perf_counter())
+
+class IndexingStatus:
+    """
+    Process-wide readiness of the metadata index: state is idle | running | ready | failed.
+    While running, searches are served from the last written (possibly partial) store.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = "idle"
+        self.message = ""
+        self.files_total = 0
+        self.files_read = 0
+        self.chunks_queued = 0
+        self.chunks_embedded = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._done = threading.Event()
+        self._done.set()
+
+    def start(self) -> None:
+        with self._lock:
+            self.state, self.message = "running", ""
+            self.files_total = self.files_read = self.chunks_queued = self.chunks_embedded = 0
+            self.started_at, self.finished_at = time.time(), None
+            self._done.clear()
+
+    def update(self, **fields: Any) -> None:
+        with self._lock:
+            for k, v in fields.items():
+                setattr(self, k, v)
+
+    def finish(self, ok: bool, message: str) -> None:
+        with self._lock:
+            self.state, self.message = ("ready" if ok else "failed"), message
+            self.finished_at = time.time()
+        self._done.set()
+
+    @property
+    def running(self) -> bool:
+        return self.state == "running"
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until no background run is active; False on timeout."""
+        return self._done.wait(timeout)
+
+    def info(self) -> str:
+        with self._lock:
+            if self.state == "running":
+                return (f"Metadata indexing in progress ({self.files_read}/{self.files_total} files read, "
+                        f"{self.chunks_embedded}/{self.chunks_queued} chunks embedded); "
+                        f"results come from the partial index.")
+            if self.state == "failed":
+                return f"Metadata indexing failed: {self.message}"
+            return ""
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "message": self.message, "files_total": self.files_total,
+                    "files_read": self.files_read, "chunks_queued": self.chunks_queued,
+                    "chunks_embedded": self.chunks_embedded, "started_at": self.started_at,
+                    "finished_at": self.finished_at}
+
+
+_INDEXING_STATUS = IndexingStatus()
+
+
+def get_indexing_status() -> IndexingStatus:
+    return _INDEXING_STATUS
+
+
+def _store_base(rec: dict, global_base: str) -> str:
+    """Corpus chunks live in their patient/session shard, everything else in the global store."""
+    if rec.get("kind") == "corpus":
+        return shard_base(CORPUS_SHARD, *record_shard(rec))
+    return global_base
+
+def _file_key(rec: dict) -> str:
+    """Manifest key of a record's file; the same corpus file is tracked separately per shard."""
+    source = rec.get("source", "")
+    if rec.get("kind") == "corpus":
+        return f"{shard_dir(*record_shard(rec))}/{source}"
+    return source
+
 @dataclass
 class StorePaths:
     # where the embedder keeps its caches/stores
     embeddings_dir: str = "embeddings"
-    metadata_store_file: str = "embeddings/metadata_store.json"  # vector store (toy)
-    index_file: str = "embeddings/metadata_index.json"           # file → hash & chunks
+    metadata_store_file: str = "embeddings/metadata_store.npy"      # normalised float32 vectors (memmap)
+    metadata_records_file: str = "embeddings/metadata_store.jsonl"  # one record per vector row
+    index_file: str = "embeddings/metadata_index.json"              # file → mtime/size/sha256 & chunk hashes
 
 class FS:
     """Abstract FS that can be backed by e2b sandbox or local disk."""
@@ -115,50 +339,88 @@ class FS:
 class MetadataEmbedder:
     """
     Smart embedder:
-      - ALWAYS dirs: re-embed every run (patient_raw_data) when include_corpus=True
-      - ONCE dirs  : embed only if store missing (unless refresh=True)
+      - Incremental: a manifest (StorePaths.index_file) records path, mtime, size, sha256
+        and chunk hashes per file; only new/changed chunks are embedded, vectors for
+        unchanged chunks are reused and records of deleted files are dropped
+      - refresh=True re-hashes every file instead of trusting mtime/size
+      - patient_raw_data is only scanned when include_corpus=True; its chunks go to the
+        patient/session shard (see shards.py), psych metadata stays in the global store
       - EXCLUDE    : insights/, embeddings/, .git, __pycache__
-      - De-dupe via content hashing could be added later if needed
     """
     def __init__(self, sandbox=None, embedder: Optional[BaseEmbedder]=None):
         self.sandbox = sandbox
-        # ✅ define store paths
-        self.metadata_store_path = "embeddings/metadata_store.json"
-        self.agent_notes_store_path = "embeddings/agent_notes_store.json"
+        # ✅ define store paths (metadata is a binary VectorStore: <base>.npy + <base>.jsonl)
+        self.metadata_store_path = "embeddings/metadata_store"
+        self.agent_notes_store_path = AGENT_NOTES_BASE  # append-only <base>.log.jsonl + compacted <base>.npy/.jsonl
+        self.metadata_vectors = VectorStore(self.metadata_store_path, sandbox=sandbox)
+        self.index_path = StorePaths().index_file
+        self.fs = FS(sandbox)
 
         # ✅ embedder backend
-        self.embedder = embedder or get_embedder_from_env()
+        self.embedder = embedder or get_shared_embedder()
 
-        # in‑memory stores
+        # in‑memory store (metadata + loaded corpus shards); agent notes go straight to the append-only log
         self.metadata_store = []
-        self.agent_notes_store = []
+        self._origin: Dict[int, str] = {}  # id(record) → store base it was loaded from
+        self._loaded_bases: set[str] = set()  # store bases whose records are in metadata_store
+        self.notes_log = NotesLog(self.agent_notes_store_path, sandbox=sandbox)
+        self._shard_logs: Dict[str, NotesLog] = {}  # patient/session notes logs, opened on first note
+        self._bg_thread: Optional[threading.Thread] = None
 
     # -------- store IO --------
     def _check_metadata_exists(self) -> bool:
-        """Check if metadata embeddings already exist"""
-        if self.sandbox:
-            try:
-                self.sandbox.files.read(self.metadata_store_path)
-                return True
-            except Exception:
-                return False
-        return os.path.exists(self.metadata_store_path)
+        """Check if metadata embeddings already exist (a legacy JSON store is converted here)"""
+        return self.metadata_vectors.exists()
+
+    def _corpus_stores(self) -> List[VectorStore]:
+        stores = [VectorStore(b, sandbox=self.sandbox) for b in list_shard_bases(CORPUS_SHARD, sandbox=self.sandbox)]
+        return [s for s in stores if s.exists()]
 
-    def _load_existing_metadata(self) -> bool:
+    def _load_existing_metadata(self, bases: Optional[List[str]] = None) -> bool:
+        """
+        Load the global store and every corpus shard into metadata_store, or with `bases`, add
+        just those stores (skipping ones already loaded) to what is in memory.
+        """
         try:
-            if self.sandbox:
-                raw = self.sandbox.files.read(self.metadata_store_path)
-                store_data = raw.decode() if isinstance(raw, (bytes, bytearray)) else str(raw)
+            if bases is None:
+                stores = [self.metadata_vectors] + self._corpus_stores()
+                records: List[dict] = []
+                self._origin = {}
+                self._loaded_bases = set()
             else:
-                with open(self.metadata_store_path, "r", encoding="utf-8") as f:
-                    store_data = f.read()
-            self.metadata_store = json.loads(store_data) or []
+                stores = [VectorStore(b, sandbox=self.sandbox) for b in bases if b not in self._loaded_bases]
+                records = self.metadata_store
+            for store in stores:
+                self._loaded_bases.add(store.base_path)
+                if not store.exists():
+                    continue
+                vm = store.load()
+                vecs = vm.vectors()
+                # embeddings are row views into the memmap; nothing is copied
+                for i, rec in enumerate(vm.records):
+                    if i in vecs:
+                        rec["embedding"] = vecs[i]
+                    self._origin[id(rec)] = store.base_path
+                records.extend(vm.records)
+            self.metadata_store = records
             print(f"Loaded existing metadata embeddings: {len(self.metadata_store)} items")
             return True
         except Exception as e:
             print(f"Error loading metadata embeddings: {e}")
             return False
 
+    def _load_manifest(self) -> Dict[str, Any]:
+        try:
+            data = json.loads(self.fs.read_text(self.index_path))
+            if isinstance(data, dict) and isinstance(data.get("files"), dict):
+                return data
+        except Exception:
+            pass
+        return {"version": 1, "files": {}}
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        self.fs.write_text(self.index_path, json.dumps(manifest, indent=2))
+
     # -------- main API --------
     def embed_metadata_dirs(
         self,
@@ -166,26 +428,81 @@ class MetadataEmbedder:
         refresh: bool = False,
         include_corpus: bool = False,
         verbose: bool = False,
-        min_chunk_len: int = 30,
+        min_chunk_len: int = 0,
+        patient_id: Optional[str] = None,
+        session_date: Optional[str] = None,
+        workers: Optional[int] = None,
+        embed_batch_size: int = EMBED_BATCH_SIZE,
+        embed_concurrency: int = EMBED_CONCURRENCY,
+        checkpoint_s: float = 0.0,
+        chunk_tokens: int = CHUNK_MAX_TOKENS,
+        chunk_overlap: int = CHUNK_OVERLAP_TOKENS,
+        fit_idf: bool = True,
     ) -> str:
         """
-        Embed files from one or more directories into a single metadata store.
-        - refresh=False: reuse existing store if present
+        Embed files from one or more directories into a single metadata store, incrementally.
+        - refresh=False: trust the manifest's mtime/size; only re-read files whose stat changed
+        - refresh=True : re-hash every file (vectors of unchanged chunks are still reused)
         - include_corpus=False: skip ./patient_raw_data (prevents leakage/confusion)
-        - Skips agent-generated dirs like insights/ or embeddings/
-        - Record fields: kind ("metadata"|"corpus"), source, doc_id, chunk_index, content, embedding(+model/dim)
+        - corpus chunks are tagged with patient_id/session_date (default: PATIENT_ID/SESSION_DATE
+          from config) and written to that patient/session shard only
+        - Files are streamed through the token-aware chunker (chunker.py): chunk_tokens per chunk with
+          chunk_overlap tokens carried over; patient_raw_data transcripts are chunked on speaker turns
+        - Directories are walked recursively; skip_dirs (insights/, embeddings/, ...) are pruned at any depth
+        - Changed files are read, hashed and chunked on `workers` processes; their new chunks are
+          embedded in batches of embed_batch_size, embed_concurrency requests at a time, while reading continues
+        - Records of deleted files (in the scanned dirs) are dropped
+        - verbose=True also reports progress and read/embed throughput
+        - checkpoint_s > 0: every checkpoint_s seconds the stores are rewritten with the chunks embedded
+          so far, so searches running meanwhile see a growing partial index (background runs)
+        - fit_idf=True and an offline HashingEmbedder without IDF: the IDF is fitted over the chunks of
+          every scanned file first and saved to HASH_IDF_PATH (reused by later runs); this changes the
+          embedding model name, so existing vectors are re-embedded once
+        - Every non-blank chunk is kept (min_chunk_len > 0 drops shorter ones; off by default so short
+          speaker turns survive). Chunks of files over CHUNK_SPILL_BYTES are streamed through a temp file
+        - Record fields: kind ("metadata"|"corpus"), source, doc_id, chunk_index, content, chunk_sha256, embedding(+model/dim)
         """
-        if not refresh and self._check_metadata_exists():
-            if verbose:
+        patient_id = patient_id if patient_id is not None else (PATIENT_ID or "")
+        session_date = session_date if session_date is not None else (SESSION_DATE or "")
+        corpus_prefix = shard_dir(patient_id, session_date)
+        # only the stores the scanned files map to: the global one, plus this shard for the corpus
+        needed = [self.metadata_store_path] + ([f"{corpus_prefix}/{CORPUS_SHARD}"] if include_corpus else [])
+        needed = [b for b in needed if b not in self._loaded_bases]
+        if needed:
+            if verbose and any(VectorStore(b, sandbox=self.sandbox).exists() for b in needed):
                 print("ℹ️  Store exists, loading cached metadata embeddings...")
-            if self._load_existing_metadata():
-                return "Metadata embeddings loaded successfully"
+            self._load_existing_metadata(needed)
+
+        if fit_idf and isinstance(self.embedder, HashingEmbedder) and self.embedder.idf is None:
+            self._fit_hashing_idf(base_dirs, include_corpus, chunk_tokens, chunk_overlap, verbose)
+        model = getattr(self.embedder, "name", "unknown")
+
+        manifest = self._load_manifest()
+        files_meta: Dict[str, Any] = manifest["files"]
+
+        by_source: Dict[str, List[dict]] = {}
+        for rec in self.metadata_store:
+            by_source.setdefault(_file_key(rec), []).append(rec)
+
+        def _reusable(recs: List[dict], meta: Dict[str, Any]) -> bool:
+            if not recs:
+                return meta.get("chunks") == []  # a file that produced no chunks is recorded with none
+            return all(r.get("embedding_model") == model and r.get("embedding") is not None for r in recs)
+
+        # chunk hash → vector (same embedding model only); built on first changed file
+        reuse_pool: Optional[Dict[str, Any]] = None
 
         skip_dirs = {"insights", "embeddings", ".git", "__pycache__"}
         total_considered = 0
-        total_embedded = 0
-        new_records: list[dict] = []
-
+        total_unchanged = 0
+        total_reused = 0
+        scanned_prefixes: set[str] = set()
+        seen_sources: set[str] = set()
+        replaced: Dict[str, List[dict]] = {}
+        manifest_dirty = False
+
+        # 1) recursive discovery (skip_dirs pruned at every level) + the stat fast path
+        to_read: List[tuple] = []  # (key, source, fpath, stat, is_corpus)
         for dir_path in base_dirs:
             if not os.path.isdir(dir_path):
                 if verbose: print(f"⏭️  Not found or not a directory: {dir_path}")
@@ -202,125 +519,340 @@ class MetadataEmbedder:
                 continue
 
             if verbose:
-                print(f"📚 Creating embeddings from {dir_path} (refresh={refresh})")
+                print(f"📚 Checking {dir_path} for new/changed files (refresh={refresh})")
+            scanned_prefixes.add(f"{corpus_prefix}/{dir_name}/" if is_corpus else f"{dir_name}/")
 
-            try:
-                names = os.listdir(dir_path)
-            except Exception as e:
-                if verbose: print(f"⚠️  Unable to list {dir_path}: {e}")
-                continue
-
-            for fname in names:
-                fpath = os.path.join(dir_path, fname)
-                if not os.path.isfile(fpath):
-                    if verbose: print(f"  ⟶ skip: {fpath} (not a file)")
-                    continue
+            for fpath in _walk_files(dir_path, skip_dirs):
                 total_considered += 1
-
                 if not _is_supported_file(fpath):
                     if verbose: print(f"  ⟶ skip: {fpath} (unsupported extension)")
                     continue
 
-                # Read content
+                rel = os.path.relpath(fpath, dir_path).replace(os.sep, "/")
+                source = f"{dir_name}/{rel}"
+                key = f"{corpus_prefix}/{source}" if is_corpus else source
+                prev = files_meta.get(key) or {}
                 try:
-                    with open(fpath, "r", encoding="utf-8") as f:
-                        content = f.read()
+                    st = os.stat(fpath)
                 except Exception as e:
-                    if verbose: print(f"  ⟶ skip: {fpath} (read error: {e})")
+                    if verbose: print(f"  ⟶ skip: {fpath} (stat error: {e})")
+                    seen_sources.add(key)  # keep whatever we had
                     continue
+                seen_sources.add(key)
 
-                # Chunk, trimming tiny/empty bits
-                chunks = self._chunk_markdown(content, max_len=800, min_len=min_chunk_len)
-                docid = _doc_id(f"{dir_name}/{fname}")
-                added = 0
+                # fast path: stat unchanged → nothing to read
+                if (not refresh and prev.get("mtime") == st.st_mtime and prev.get("size") == st.st_size
+                        and _reusable(by_source.get(key, []), prev)):
+                    total_unchanged += 1
+                    continue
+                to_read.append((key, source, fpath, st, is_corpus))
+
+        # 2) read + hash + chunk in a process pool; 3) new chunks stream into the embed pipeline
+        pipeline = _EmbedPipeline(self._embed_batch, self.embedder, batch_size=embed_batch_size,
+                                  concurrency=embed_concurrency)
+        t_read = time.perf_counter()
+        progress_every = max(1, len(to_read) // 10)
+        status = get_indexing_status()
+        status.update(files_total=len(to_read), files_read=0)
+        last_checkpoint = time.perf_counter()
+
+        def _checkpoint() -> None:
+            nonlocal last_checkpoint
+            status.update(chunks_queued=pipeline.queued, chunks_embedded=pipeline.done)
+            if checkpoint_s <= 0 or time.perf_counter() - last_checkpoint < checkpoint_s or not replaced:
+                return
+            last_checkpoint = time.perf_counter()
+            partial = [r for r in self.metadata_store if _file_key(r) not in replaced]
+            partial.extend(r for recs in list(replaced.values()) for r in recs if r.get("embedding") is not None)
+            try:
+                self._write_stores(self._dirty_bases(set(replaced), replaced), records=partial)
+            except Exception as e:
+                if verbose: print(f"  ⚠️  checkpoint failed: {e}")
+        for n_read, (item, (sha, chunks, err)) in enumerate(
+                zip(to_read, _read_and_chunk_all([t[2] for t in to_read], [t[4] for t in to_read],
+                                                   chunk_tokens, chunk_overlap, workers)), 1):
+            key, source, fpath, st, is_corpus = item
+            status.update(files_read=n_read)
+            _checkpoint()
+            if verbose and n_read % progress_every == 0:
+                print(f"  … read {n_read}/{len(to_read)} files, {pipeline.queued} chunks queued, "
+                      f"{pipeline.done} embedded")
+            if err is not None:
+                if verbose: print(f"  ⟶ skip: {fpath} (read error: {err})")
+                continue
 
-                for i, chunk in enumerate(chunks):
-                    if not chunk or len(chunk.strip()) < min_chunk_len:
-                        continue
+            prev = files_meta.get(key) or {}
+            old_recs = by_source.get(key, [])
+            if prev.get("sha256") == sha and _reusable(old_recs, prev):
+                # touched but identical: refresh the stat, keep the vectors
+                prev.update({"path": fpath, "mtime": st.st_mtime, "size": st.st_size})
+                manifest_dirty = True
+                total_unchanged += 1
+                _discard(chunks)
+                continue
+
+            if reuse_pool is None:
+                reuse_pool = {}
+                for r in self.metadata_store:
+                    if r.get("embedding_model") == model and r.get("embedding") is not None:
+                        reuse_pool[r.get("chunk_sha256") or _chunk_hash(r.get("content", ""))] = r["embedding"]
 
-                    # ✅ This is the 'rec' you were unsure about — append one per chunk
-                    rec = {
-                        "kind": ("corpus" if is_corpus else "metadata"),
-                        "source": f"{dir_name}/{fname}",
-                        "doc_id": docid,
-                        "chunk_index": i,  # per-document index
-                        "content": chunk,
-                        "embedding": self._embed_fn(chunk),
-                        "embedding_model": getattr(self.embedder, "name", "unknown"),
-                        "embedding_dim": getattr(self.embedder, "dim", 0),
-                        "created_at": "refresh" if refresh else "startup",
-                    }
-                    new_records.append(rec)
-                    added += 1
-
-                total_embedded += added
-                if verbose:
-                    print(f"  ✔ embed: {fpath} (chunks={added})")
-
-        if new_records:
-            self.metadata_store.extend(new_records)
-
-        # Persist
+            docid = _doc_id(source)
+            recs: List[dict] = []
+            reused = 0
+
+            for i, chunk in enumerate(chunks):
+                # the chunker packs short units instead of dropping them; only blank chunks go
+                if not chunk.strip() or len(chunk.strip()) < min_chunk_len:
+                    continue
+
+                h = _chunk_hash(chunk)
+                rec = {
+                    "kind": ("corpus" if is_corpus else "metadata"),
+                    "source": source,
+                    "doc_id": docid,
+                    "chunk_index": i,  # per-document index
+                    "content": chunk,
+                    "chunk_sha256": h,
+                    "embedding": reuse_pool.get(h),
+                    "embedding_model": model,
+                    "embedding_dim": getattr(self.embedder, "dim", 0),
+                    "created_at": "refresh" if refresh else "startup",
+                }
+                if is_corpus:
+                    rec["patient_id"] = patient_id
+                    rec["session_date"] = session_date
+                if rec["embedding"] is None:
+                    pipeline.add(rec)
+                else:
+                    reused += 1
+                recs.append(rec)
+
+            replaced[key] = recs
+            files_meta[key] = {
+                "path": fpath,
+                "kind": "corpus" if is_corpus else "metadata",
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "sha256": sha,
+                "chunks": [r["chunk_sha256"] for r in recs],
+            }
+            manifest_dirty = True
+            total_reused += reused
+            if verbose:
+                print(f"  ✔ changed: {fpath} (chunks={len(recs)}, new={len(recs) - reused}, reused={reused})")
+        read_s = time.perf_counter() - t_read
+
+        # Only new/changed chunks hit the embedding backend; wait for the in-flight batches
         try:
-            os.makedirs(os.path.dirname(self.metadata_store_path), exist_ok=True)
-            store_json = json.dumps(self.metadata_store, indent=2)
-            if self.sandbox:
-                self.sandbox.files.write(self.metadata_store_path, store_json.encode())
-            else:
-                with open(self.metadata_store_path, "w", encoding="utf-8") as f:
-                    f.write(store_json)
-            return (
-                f"Successfully embedded {total_embedded} chunks from "
-                f"{len(base_dirs)} directories (considered {total_considered} files)"
-            )
+            pipeline.finish(tick=_checkpoint, interval=checkpoint_s or CHECKPOINT_SECONDS)
+        except Exception as e:
+            return f"Error embedding metadata chunks: {e}"
+        total_embedded = pipeline.done
+        status.update(chunks_queued=pipeline.queued, chunks_embedded=total_embedded)
+        if verbose and to_read:
+            print(f"  ⏱  read+chunk {len(to_read)} files in {read_s:.2f}s ({len(to_read) / max(read_s, 1e-9):.1f} files/s); "
+                  f"embedded {total_embedded} chunks in {pipeline.elapsed:.2f}s "
+                  f"({total_embedded / max(pipeline.elapsed, 1e-9):.1f} chunks/s, {pipeline.batches} batches)")
+
+        # Files that vanished from a scanned dir (corpus: only within the current shard)
+        removed = {
+            src for src in set(files_meta) | set(by_source)
+            if any(src.startswith(p) for p in scanned_prefixes) and src not in seen_sources
+        }
+        for src in removed:
+            files_meta.pop(src, None)
+            manifest_dirty = True
+        if verbose and removed:
+            print(f"  🗑  removed {len(removed)} deleted file(s) from the store")
+
+        summary = (
+            f"{len(base_dirs)} directories (considered {total_considered} files, "
+            f"unchanged {total_unchanged}, reused {total_reused} chunks, removed {len(removed)} files)"
+        )
+
+        try:
+            if replaced or removed or not self.metadata_vectors.exists():
+                changed = set(replaced) | removed
+                dirty = self._dirty_bases(changed, replaced)
+                store: List[dict] = [r for r in self.metadata_store if _file_key(r) not in changed]
+                for recs in replaced.values():
+                    store.extend(recs)
+                self.metadata_store = store
+                self._write_stores(dirty)
+            if manifest_dirty:
+                self._save_manifest(manifest)
         except Exception as e:
             return f"Error saving metadata embeddings: {e}"
 
+        if not replaced and not removed:
+            return f"Metadata embeddings up to date ({len(self.metadata_store)} chunks) — {summary}"
+        return f"Successfully embedded {total_embedded} chunks from {summary}"
+
+    def _fit_hashing_idf(self, base_dirs: list[str], include_corpus: bool, chunk_tokens: int,
+                         chunk_overlap: int, verbose: bool = False) -> None:
+        """
+        Fit a copy of the HashingEmbedder with an IDF over the chunks of every file ingestion would
+        scan, save it and switch to it; the shared embedder is left as is (the saved IDF file makes
+        get_shared_embedder build a new one). Agent notes embedded before the fit are re-embedded.
+        """
+        skip_dirs = {"insights", "embeddings", ".git", "__pycache__"}
+
+        def _chunks() -> Iterator[str]:
+            for dir_path in base_dirs:
+                dir_name = os.path.basename(dir_path.rstrip("/"))
+                is_corpus = dir_name == "patient_raw_data"
+                if not os.path.isdir(dir_path) or dir_name in skip_dirs or (is_corpus and not include_corpus):
+                    continue
+                for fpath in _walk_files(dir_path, skip_dirs):
+                    if not _is_supported_file(fpath):
+                        continue
+                    try:
+                        with open(fpath, "r", encoding="utf-8") as f:
+                            yield from stream_chunks(f, max_tokens=chunk_tokens, overlap_tokens=chunk_overlap,
+                                                     turns=is_corpus)
+                    except Exception:
+                        continue  # unreadable files are reported by the ingestion pass
+
+        t0 = time.perf_counter()
+        old = self.embedder
+        fitted = HashingEmbedder(dim=old.dim, char_ngrams=old.char_ngrams,
+                                 weights=(old.w_word, old.w_bigram, old.w_char),
+                                 max_batch_bytes=old.max_batch_bytes).fit(_chunks())
+        if fitted.idf is None:
+            return
+        self.embedder = fitted
+        path = os.getenv("HASH_EMBED_IDF", "") or HASH_IDF_PATH
+        try:
+            fitted.save_idf(path)
+        except Exception as e:
+            if verbose: print(f"  ⚠️  could not save IDF to {path}: {e}")
+        if verbose:
+            print(f"  📐 fitted hashing IDF in {time.perf_counter() - t0:.2f}s → {path}")
+        self._reembed_notes(verbose)
+
+    def _reembed_notes(self, verbose: bool = False) -> None:
+        """Re-embed agent notes (global log and every notes shard) made with another embedder."""
+        logs = [self.notes_log] + [self._shard_logs.get(b) or NotesLog(b, sandbox=self.sandbox)
+                                   for b in list_shard_bases(NOTES_SHARD, ALL_PATIENTS, sandbox=self.sandbox)]
+        model = getattr(self.embedder, "name", "unknown")
+        for log in logs:
+            try:
+                log.compact(embed_batch=self._embed_batch, model=model)
+            except Exception as e:
+                if verbose: print(f"  ⚠️  could not re-embed notes in {log.base_path}: {e}")
+
+    def _dirty_bases(self, changed: set, replaced: Dict[str, List[dict]]) -> set[str]:
+        """Store bases holding records of the changed files, before or after the change."""
+        dirty = {_store_base(r, self.metadata_store_path) for r in self.metadata_store if _file_key(r) in changed}
+        for recs in replaced.values():
+            dirty.update(_store_base(r, self.metadata_store_path) for r in recs)
+        return dirty
+
+    def _write_stores(self, dirty: set[str], records: Optional[List[dict]] = None) -> None:
+        """
+        Rewrite the global store and the corpus shards in `dirty` (plus records that moved store).
+        `records` (default: self.metadata_store) lets a checkpoint write a partial record set.
+        """
+        by_base: Dict[str, List[dict]] = {self.metadata_store_path: []}
+        for r in (self.metadata_store if records is None else records):
+            base = _store_base(r, self.metadata_store_path)
+            by_base.setdefault(base, []).append(r)
+            origin = self._origin.get(id(r))
+            if origin is not None and origin != base:
+                dirty.update((origin, base))  # e.g. corpus chunks of an older, unsharded store
+        if not self.metadata_vectors.exists():
+            dirty.add(self.metadata_store_path)
+        for base in dirty:
+            VectorStore(base, sandbox=self.sandbox).write(by_base.get(base, []))
+        if records is None:
+            self._origin = {id(r): _store_base(r, self.metadata_store_path) for r in self.metadata_store}
+
+    def start_background_embedding(self, base_dirs: list[str], **kwargs: Any) -> threading.Thread:
+        """
+        Run embed_metadata_dirs on a daemon thread and return immediately. Progress and readiness
+        are published on get_indexing_status(); partial stores are checkpointed meanwhile.
+        """
+        if self._bg_thread is not None and self._bg_thread.is_alive():
+            return self._bg_thread
+        kwargs.setdefault("checkpoint_s", CHECKPOINT_SECONDS)
+        verbose = kwargs.get("verbose", False)
+        status = get_indexing_status()
+        status.start()
+
+        def _run() -> None:
+            try:
+                result = self.embed_metadata_dirs(base_dirs, **kwargs)
+            except Exception as e:
+                status.finish(False, str(e))
+                print(f"❌ Background metadata embedding failed: {e}")
+                return
+            ok = not result.startswith("Error")
+            status.finish(ok, result)
+            if verbose or not ok:
+                print(result)
+
+        self._bg_thread = threading.Thread(target=_run, name="metadata-embedding", daemon=True)
+        self._bg_thread.start()
+        return self._bg_thread
+
     # -------- helpers --------
-    def _chunk_markdown(self, text: str, max_len: int = 800, min_len: int = 30) -> list[str]:
-        """Paragraph-ish chunker. Skips empty/tiny chunks, trims whitespace."""
-        paras = [p.strip() for p in text.split("\n\n")]
-        chunks, buf = [], []
-        acc = 0
-        for p in paras:
-            if not p or len(p) < min_len:
-                continue
-            if acc + len(p) > max_len and buf:
-                joined = "\n\n".join(buf).strip()
-                if len(joined) >= min_len:
-                    chunks.append(joined)
-                buf, acc = [], 0
-            buf.append(p)
-            acc += len(p)
-        if buf:
-            joined = "\n\n".join(buf).strip()
-            if len(joined) >= min_len:
-                chunks.append(joined)
-        return chunks
+    def _chunk_markdown(self, text: str, max_tokens: int = CHUNK_MAX_TOKENS,
+                        overlap_tokens: int = CHUNK_OVERLAP_TOKENS, turns: bool = False) -> list[str]:
+        """Token-aware paragraph (or speaker-turn) chunks of an in-memory text; see chunker.py."""
+        return chunk_text(text, max_tokens=max_tokens, overlap_tokens=overlap_tokens, turns=turns)
 
     def _embed_fn(self, chunk: str) -> List[float]:
         # unified entrypoint to backend
         return self.embedder.embed(chunk)
 
+    def _embed_batch(self, chunks: List[str]) -> List[List[float]]:
+        # whole lists go to the backend; it decides how to split them into requests
+        if hasattr(self.embedder, "batch_embed"):
+            return self.embedder.batch_embed(chunks)
+        return [self._embed_fn(c) for c in chunks]
+
     def index_agent_note(self, chunk_id: int, title: str, notes: str, metadata: dict | None = None) -> None:
-        """Append one agent note to the agent_notes_store.json with an embedding."""
+        """
+        Append one agent note (with its embedding) to the agent notes log; compaction runs in the background.
+        A near-duplicate of an existing note is merged into it (dup_count/dup_chunks) and not embedded.
+        """
+        log = self._notes_log_for(metadata or {})
+        created_at = datetime.utcnow().isoformat() + "Z"
+        dup = log.find_duplicate(notes)
+        if dup is not None:
+            log.merge(dup, chunk_id=chunk_id, created_at=created_at)
+            log.start_compactor()
+            return
         rec = {
             "chunk_id": chunk_id,
             "title": title,
             "notes": notes,
             "metadata": metadata or {},
             "embedding": self.embedder.embed(notes),  # uses the backend you configured (OpenAI or local)
+            "embedding_model": getattr(self.embedder, "name", "unknown"),
+            "created_at": created_at,
         }
-        self.agent_notes_store.append(rec)
-
-        # persist
-        payload = json.dumps(self.agent_notes_store, indent=2)
-        if self.sandbox:
-            self.sandbox.files.write(self.agent_notes_store_path, payload.encode())
-        else:
-            os.makedirs(os.path.dirname(self.agent_notes_store_path), exist_ok=True)
-            with open(self.agent_notes_store_path, "w", encoding="utf-8") as f:
-                f.write(payload)
+        log.append(rec)
+        log.start_compactor()
+
+    def _notes_log_for(self, metadata: dict) -> NotesLog:
+        """Notes that name a patient go to that patient/session shard; the rest to the global log."""
+        pid, session = record_shard({"metadata": metadata})
+        if not pid:
+            return self.notes_log
+        base = shard_base(NOTES_SHARD, pid, session)
+        if base not in self._shard_logs:
+            self._shard_logs[base] = NotesLog(base, sandbox=self.sandbox)
+        return self._shard_logs[base]
+
+    def close(self) -> None:
+        """Wait for a background embedding run, stop the notes compactors and fold pending notes."""
+        if self._bg_thread is not None:
+            self._bg_thread.join()
+        self.notes_log.stop_compactor(final_compact=True)
+        for log in self._shard_logs.values():
+            log.stop_compactor(final_compact=True)
 
 if __name__ == "__main__":
     import argparse
@@ -330,6 +862,7 @@ if __name__ == "__main__":
     parser.add_argument("--refresh", action="store_true", help="Rebuild store instead of loading cache")
     parser.add_argument("--include-corpus", action="store_true", help="Also embed patient_raw_data/")
     parser.add_argument("--verbose", action="store_true", help="Verbose prints")
+    parser.add_argument("--workers", type=int, default=None, help="Read/chunk processes (default: min(cpus, 8))")
     parser.add_argument("--dirs", nargs="+", default=None, help="One or more directories to embed")
     parser.add_argument("paths", nargs="*", help="(Optional) same as --dirs; trailing positional dirs")
 
@@ -343,5 +876,6 @@ if __name__ == "__main__":
             refresh=args.refresh,
             include_corpus=args.include_corpus,
             verbose=args.verbose,
+            workers=args.workers,
         )
     )
\ No newline at end of file
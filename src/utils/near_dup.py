@@ -0,0 +1,88 @@
+# src/utils/near_dup.py
+"""Near-duplicate detection for agent notes (MinHash signatures, LSH banding).
+
+A note is reduced to its word bigram shingles (crc32-hashed), then to a MinHash signature
+of NUM_PERM values: min over shingles of (a * h + b) mod p for NUM_PERM fixed (a, b) pairs.
+The signature is cut into LSH_BANDS bands; notes sharing any band bucket are candidates,
+and a candidate is a near-duplicate when the fraction of equal signature values (the
+Jaccard estimate) is at least NEAR_DUP_THRESHOLD.
+
+The index is in-memory only; NotesLog rebuilds it from the store + log on first use.
+"""
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+import os, zlib
+import numpy as np
+
+from src.utils.lexical_index import tokenize
+
+NUM_PERM = 64
+LSH_BANDS = 16                       # 16 bands x 4 rows: candidates from Jaccard ~0.5 upwards
+SHINGLE_SIZE = 2
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.7"))
+
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.default_rng(0x5EED)  # fixed: signatures must agree across processes
+_A = _rng.integers(1, int(_PRIME), size=NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, int(_PRIME), size=NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """crc32 hashes of the word n-grams of `text` (short texts: the whole token list)."""
+    toks = tokenize(text)
+    if not toks:
+        return np.empty(0, dtype=np.uint64)
+    grams = [" ".join(toks[i:i + size]) for i in range(max(1, len(toks) - size + 1))]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams),
+                                 dtype=np.uint64, count=len(grams)))
+
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """(NUM_PERM,) uint64 signature, or None for a text without tokens."""
+    h = shingles(text)
+    if h.size == 0:
+        return None
+    # a < 2^31 and h mod p < 2^31, so the product fits in uint64
+    vals = (_A[:, None] * (h[None, :] % _PRIME) + _B[:, None]) % _PRIME
+    return vals.min(axis=1)
+
+
+class NearDupIndex:
+    """LSH buckets over MinHash signatures; keys are note ids."""
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD, bands: int = LSH_BANDS):
+        self.threshold = float(threshold)
+        self.bands = int(bands)
+        self.rows = NUM_PERM // self.bands
+        self._buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(self.bands)]
+        self._sigs: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self._sigs)
+
+    def _band_keys(self, sig: np.ndarray) -> List[bytes]:
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, key: str, text: str, sig: Optional[np.ndarray] = None) -> None:
+        sig = minhash(text) if sig is None else sig
+        if sig is None or key in self._sigs:
+            return
+        self._sigs[key] = sig
+        for band, bk in zip(self._buckets, self._band_keys(sig)):
+            band.setdefault(bk, []).append(key)
+
+    def query(self, text: str, sig: Optional[np.ndarray] = None) -> Optional[Tuple[str, float]]:
+        """(key, estimated Jaccard) of the closest indexed note at or above the threshold."""
+        sig = minhash(text) if sig is None else sig
+        if sig is None:
+            return None
+        cands: set = set()
+        for band, bk in zip(self._buckets, self._band_keys(sig)):
+            cands.update(band.get(bk, ()))
+        if not cands:
+            return None
+        keys = list(cands)
+        sims = (np.stack([self._sigs[k] for k in keys]) == sig[None, :]).mean(axis=1)
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        return keys[best], float(sims[best])
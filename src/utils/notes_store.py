@@ -0,0 +1,408 @@
+# src/utils/notes_store.py
+"""
+Agent notes: an append-only log in front of a compacted VectorStore.
+
+  <base>.log.jsonl   one note per line (with its embedding); the first line is a
+                     {"_log": {"generation": ...}} header that changes on every compaction
+  <base>.npy/.jsonl  compacted VectorStore (see vector_store.py)
+
+index_agent_note appends one line (O(1) per note on the host). The sandbox filesystem
+cannot append, so there each note is written as its own one-line segment file instead:
+
+  <base>.log.d/<generation>/<time_ns>-<rand>.jsonl
+
+and the log file only holds the header. A background compactor folds the log (and the
+segments) into the VectorStore and starts a new generation. Host readers keep the byte
+offset they have consumed, sandbox readers the segment names; both only parse what was
+appended since.
+
+A note that is a near-duplicate of an existing one (MinHash/LSH, see near_dup.py) is not
+embedded again; a {"_merge": {"note_id", "chunk_id", "created_at"}} line is appended
+instead, which bumps the existing note's `dup_count` and adds to its `dup_chunks`.
+"""
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Optional
+import json, os, threading, time, uuid
+
+from src.utils.vector_store import VectorMatrix, VectorStore, _sbx_read_bytes, _sbx_write_bytes
+from src.utils.near_dup import NearDupIndex
+
+AGENT_NOTES_BASE = "embeddings/agent_notes_store"
+
+
+def note_record(n: Dict[str, Any]) -> Dict[str, Any]:
+    """Agent notes are stored as {chunk_id, title, notes, ...}; map them to the chunk record shape."""
+    if "content" in n or "notes" not in n:
+        return n
+    rec = {
+        "kind": "notes",
+        "source": "agent_notes_store.json",
+        "doc_id": n.get("doc_id") or "notes",
+        "chunk_index": n.get("chunk") or n.get("chunk_id") or 0,
+        "content": n.get("notes", ""),
+        "created_at": n.get("created_at", "unknown"),
+    }
+    if n.get("embedding") is not None:
+        rec["embedding"] = n["embedding"]
+    for k in ("title", "metadata", "note_id", "embedding_model", "dup_count", "dup_chunks", "last_seen_at"):
+        if k in n:
+            rec[k] = n[k]
+    return rec
+
+
+def migrate_legacy_notes(store: VectorStore) -> None:
+    """Convert the old agent_notes_store.json list ({chunk_id, title, notes, metadata, embedding}) once."""
+    if store._exists(store.records_path):
+        return
+    raw = store._read(store.legacy_path)
+    if not raw:
+        return
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except Exception:
+        return
+    if isinstance(data, list) and data:
+        store.write([note_record(n) for n in data])
+
+
+def apply_merge(rec: Dict[str, Any], merge: Dict[str, Any]) -> None:
+    """Fold one `_merge` line into the note it points at."""
+    rec["dup_count"] = int(rec.get("dup_count", 1)) + 1
+    if merge.get("chunk_id") is not None:
+        rec["dup_chunks"] = list(rec.get("dup_chunks", [])) + [merge["chunk_id"]]
+    if merge.get("created_at"):
+        rec["last_seen_at"] = merge["created_at"]
+
+
+def _new_generation() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def _log_header(generation: str) -> bytes:
+    return (json.dumps({"_log": {"generation": generation}}) + "\n").encode("utf-8")
+
+
+def _parse_generation(line: bytes) -> Optional[str]:
+    try:
+        return json.loads(line.decode("utf-8"))["_log"]["generation"]
+    except Exception:
+        return None
+
+
+def _sbx_list_files(sandbox, path: str) -> List[str]:
+    """Sorted file names in a sandbox directory ([] if it does not exist)."""
+    try:
+        entries = sandbox.files.list(path)
+    except Exception:
+        return []
+    out = []
+    for e in entries:
+        name = e["name"] if isinstance(e, dict) else getattr(e, "name", "")
+        is_dir = e.get("is_dir", False) if isinstance(e, dict) else getattr(e, "type", "") == "dir"
+        if name and not is_dir:
+            out.append(name)
+    return sorted(out)
+
+
+def _sbx_segments(sandbox, segments_path: str, generation: Optional[str]) -> List[str]:
+    """Paths of a generation's sandbox segment files, oldest first."""
+    if not generation:
+        return []
+    seg_dir = f"{segments_path}/{generation}"
+    return [f"{seg_dir}/{n}" for n in _sbx_list_files(sandbox, seg_dir)]
+
+
+class NotesLog:
+    """Writer side: append one note per line, compact in the background."""
+    def __init__(self, base_path: str = AGENT_NOTES_BASE, sandbox=None,
+                 compact_every: int = 256, compact_interval: float = 30.0):
+        self.base_path = base_path
+        self.sandbox = sandbox
+        self.log_path = f"{base_path}.log.jsonl"
+        self.segments_path = f"{base_path}.log.d"  # sandbox only
+        self.store = VectorStore(base_path, sandbox=sandbox)
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._dups: Optional[NearDupIndex] = None  # built on the first find_duplicate()
+
+    # -------- append --------
+    def append(self, rec: Dict[str, Any]) -> str:
+        """Append one note; returns its note_id."""
+        rec = dict(rec)
+        rec.setdefault("note_id", uuid.uuid4().hex)
+        emb = rec.get("embedding")
+        if emb is not None:
+            rec["embedding"] = [float(x) for x in emb]
+        self._append_line(rec)
+        if self._dups is not None:
+            self._dups.add(rec["note_id"], rec.get("notes") or rec.get("content", ""))
+        return rec["note_id"]
+
+    def merge(self, note_id: str, chunk_id: Any = None, created_at: Optional[str] = None) -> None:
+        """Record a near-duplicate of `note_id` without storing (or embedding) it again."""
+        self._append_line({"_merge": {"note_id": note_id, "chunk_id": chunk_id, "created_at": created_at}})
+
+    def find_duplicate(self, text: str) -> Optional[str]:
+        """note_id of an existing note `text` near-duplicates, if any."""
+        with self._lock:
+            if self._dups is None:
+                self._dups = NearDupIndex()
+                notes, _ = self._read_log()
+                for rec in self.store.load_records() + notes:
+                    if rec.get("note_id"):
+                        self._dups.add(rec["note_id"], rec.get("notes") or rec.get("content", ""))
+            hit = self._dups.query(text)
+        return hit[0] if hit else None
+
+    def _append_line(self, obj: Dict[str, Any]) -> None:
+        line = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self.sandbox:
+                # the sandbox FS has no append: one small segment file per line
+                gen = self._sandbox_generation()
+                name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:6]}.jsonl"
+                _sbx_write_bytes(self.sandbox, f"{self.segments_path}/{gen}/{name}", line)
+            else:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                with open(self.log_path, "ab") as f:
+                    if f.tell() == 0:
+                        f.write(_log_header(_new_generation()))
+                    f.write(line)
+            self._pending += 1
+        if self._pending >= self.compact_every:
+            self._wake.set()
+
+    def _sandbox_generation(self) -> str:
+        """Current generation from the sandbox log header, writing a header if there is none."""
+        raw = _sbx_read_bytes(self.sandbox, self.log_path) or b""
+        gen = _parse_generation(raw.split(b"\n", 1)[0])
+        if not gen:
+            gen = _new_generation()
+            _sbx_write_bytes(self.sandbox, self.log_path, _log_header(gen) + raw)
+        return gen
+
+    # -------- compaction --------
+    def _read_log(self) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """(notes, merges) currently in the log."""
+        if self.sandbox:
+            raw = _sbx_read_bytes(self.sandbox, self.log_path) or b""
+            gen = _parse_generation(raw.split(b"\n", 1)[0])
+            segments = [_sbx_read_bytes(self.sandbox, p) or b"" for p in
+                        _sbx_segments(self.sandbox, self.segments_path, gen)]
+            raw = b"".join([raw if raw.endswith(b"\n") or not raw else raw + b"\n"] + segments)
+        else:
+            try:
+                with open(self.log_path, "rb") as f:
+                    raw = f.read()
+            except FileNotFoundError:
+                raw = b""
+        out: List[Dict[str, Any]] = []
+        merges: List[Dict[str, Any]] = []
+        for line in raw.splitlines():
+            try:
+                rec = json.loads(line.decode("utf-8"))
+            except Exception:
+                continue  # torn last line
+            if "_merge" in rec:
+                merges.append(rec["_merge"])
+            elif "_log" not in rec:
+                out.append(rec)
+        return out, merges
+
+    def compact(self, embed_batch: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                model: Optional[str] = None) -> int:
+        """
+        Fold the log into the VectorStore and start a new log generation. Returns notes in the store.
+        With `embed_batch`, notes whose embedding_model is not `model` are re-embedded on the way.
+        """
+        with self._lock:
+            logged, merges = self._read_log()
+            if not logged and not merges and embed_batch is None:
+                self._pending = 0
+                return -1
+            migrate_legacy_notes(self.store)
+            base = self.store.load()
+            vecs = base.vectors()
+            merged: List[Dict[str, Any]] = []
+            seen: set[str] = set()
+            for i, rec in enumerate(base.records):
+                if i in vecs:
+                    rec["embedding"] = vecs[i]
+                merged.append(note_record(rec))
+                if rec.get("note_id"):
+                    seen.add(rec["note_id"])
+            for rec in logged:
+                if rec.get("note_id") in seen:
+                    continue
+                merged.append(note_record(rec))
+            by_id = {r["note_id"]: r for r in merged if r.get("note_id")}
+            for m in merges:
+                if m.get("note_id") in by_id:
+                    apply_merge(by_id[m["note_id"]], m)
+            stale = [r for r in merged if r.get("embedding_model") != model] if embed_batch else []
+            if stale:
+                vectors = embed_batch([r.get("content") or r.get("notes", "") for r in stale])
+                for r, vec in zip(stale, vectors):
+                    r["embedding"] = [float(x) for x in vec]
+                    r["embedding_model"] = model
+            elif not logged and not merges:
+                self._pending = 0
+                return len(merged)
+            self.store.write(merged)
+            # new generation → readers reload the compacted store and restart at offset 0
+            if self.sandbox:
+                old = _parse_generation((_sbx_read_bytes(self.sandbox, self.log_path) or b"").split(b"\n", 1)[0])
+                _sbx_write_bytes(self.sandbox, self.log_path, _log_header(_new_generation()))
+                if old:
+                    try:
+                        self.sandbox.files.remove(f"{self.segments_path}/{old}")
+                    except Exception:
+                        pass
+            else:
+                tmp = f"{self.log_path}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(_log_header(_new_generation()))
+                os.replace(tmp, self.log_path)
+            self._pending = 0
+            return len(merged)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.compact_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            if self._pending:
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"[notes] compaction failed: {e}")
+
+    def start_compactor(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="notes-compactor", daemon=True)
+        self._thread.start()
+
+    def stop_compactor(self, final_compact: bool = True) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if final_compact and self._pending:
+            self.compact()
+
+
+class NotesLogReader:
+    """
+    Reader side: the compacted store is loaded once per log generation, then only the
+    bytes appended after the last seen offset (and, in a sandbox, unseen segments) are parsed.
+    """
+    def __init__(self, base_path: str = AGENT_NOTES_BASE, sandbox=None, fallback_embed=None):
+        self.base_path = base_path
+        self.sandbox = sandbox
+        self.log_path = f"{base_path}.log.jsonl"
+        self.segments_path = f"{base_path}.log.d"
+        self.fallback_embed = fallback_embed
+        self.generation: Optional[str] = None
+        self.offset = 0
+        self._segments_seen: set[str] = set()
+        self.base = VectorMatrix([], [])
+        self.tail_records: List[Dict[str, Any]] = []
+        self.tail = VectorMatrix([], [])
+        self._base_ids: set[str] = set()
+        self._by_id: Dict[str, Dict[str, Any]] = {}  # note_id → record, for `_merge` lines
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _reload_base(self) -> None:
+        store = VectorStore(self.base_path, sandbox=self.sandbox)
+        migrate_legacy_notes(store)
+        self.base = store.load(fallback_embed=self.fallback_embed)
+        self.base.records = [note_record(r) for r in self.base.records]
+        self._base_ids = {r["note_id"] for r in self.base.records if r.get("note_id")}
+        self._by_id = {r["note_id"]: r for r in self.base.records if r.get("note_id")}
+        self.tail_records = []
+        self.tail = VectorMatrix([], [])
+        self.offset = 0
+        self._segments_seen = set()
+
+    def read(self) -> List[VectorMatrix]:
+        """Current [compacted, tail] matrices; only new log bytes are parsed."""
+        with self._lock:
+            return self._read_locked()
+
+    def _read_locked(self) -> List[VectorMatrix]:
+        if self.sandbox:
+            raw = _sbx_read_bytes(self.sandbox, self.log_path) or b""
+            nl = raw.find(b"\n")
+            gen = _parse_generation(raw[:nl]) if nl >= 0 else None
+            if not self._loaded or gen != self.generation:
+                self._reload_base()
+                self.generation = gen
+                self._loaded = True
+            new = raw[self.offset:]
+            segments = []
+            for path in _sbx_segments(self.sandbox, self.segments_path, gen):
+                if path in self._segments_seen:
+                    continue
+                data = _sbx_read_bytes(self.sandbox, path) or b""
+                if not data.endswith(b"\n"):
+                    continue  # not fully written yet
+                self._segments_seen.add(path)
+                segments.append(data)
+        else:
+            try:
+                f = open(self.log_path, "rb")
+            except FileNotFoundError:
+                f = None
+            try:
+                gen = _parse_generation(f.readline()) if f else None
+                if not self._loaded or gen != self.generation:
+                    self._reload_base()
+                    self.generation = gen
+                    self._loaded = True
+                if f:
+                    f.seek(self.offset)
+                    new = f.read()
+                else:
+                    new = b""
+            finally:
+                if f:
+                    f.close()
+            segments = []
+
+        # only consume complete lines; a torn last line is picked up next time
+        end = new.rfind(b"\n")
+        chunk = new[: end + 1] if end >= 0 else b""
+        self.offset += len(chunk)
+        chunk += b"".join(segments)
+        if chunk:
+            added: List[Dict[str, Any]] = []
+            for line in chunk.splitlines():
+                try:
+                    rec = json.loads(line.decode("utf-8"))
+                except Exception:
+                    continue
+                if "_merge" in rec:
+                    target = self._by_id.get(rec["_merge"].get("note_id"))
+                    if target is not None:
+                        apply_merge(target, rec["_merge"])
+                    continue
+                # a reader racing a compaction can see a note in both places
+                if "_log" in rec or rec.get("note_id") in self._base_ids:
+                    continue
+                note = note_record(rec)
+                added.append(note)
+                if note.get("note_id"):
+                    self._by_id[note["note_id"]] = note
+            if added:
+                self.tail_records.extend(added)
+                self.tail = VectorMatrix.from_records(self.tail_records, fallback_embed=self.fallback_embed)
+        return [self.base, self.tail]
@@ -31,6 +31,7 @@ Graph schema: {t.graph_schema_json}
    - write_cypher_for_chunk(k, cypher_text)
    - write_csv_for_chunk(k, csv_text, record_count, columns)
    - search_metadata_chunks(query, top_k=5, kind="metadata|corpus|any", include_notes=true)
+   - search_metadata_batch(queries=[...], top_k=5, kind="metadata|corpus|any") for several lookups at once
 
  """.strip()
 
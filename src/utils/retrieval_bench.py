@@ -0,0 +1,262 @@
+# src/utils/retrieval_bench.py
+"""
+Retrieval benchmark over synthetic stores (no network).
+
+For each store size a corpus of topic-clustered pseudo-clinical chunks is generated and
+embedded offline (HashingEmbedder, or clustered random vectors with --vectors random for
+the largest sizes), written with VectorStore.write (the MetadataEmbedder write path, which
+also builds the BM25 and, above ANN_MIN_ROWS, the IVF index) and loaded back. Then every
+search backend answers the same queries:
+
+  exact    VectorMatrix.search(exact=True)       brute-force mat-vec, the recall reference
+  ivf      VectorMatrix.search()                 IVF lists (only when the store has an index)
+  batch    VectorMatrix.search_batch()           all queries as one matrix-matrix product
+  lexical  VectorMatrix.lexical_search()         BM25
+  hybrid   VectorMatrix.hybrid_search()          BM25 + vector, reciprocal rank fusion
+  tool     SearchMetadataChunks.forward()        end to end through the store cache
+
+Reported per size: embed / write / load seconds, p50/p95/mean query latency and recall@k
+against `exact` per backend, and peak RSS. Each size runs in a fresh process so its
+peak RSS is its own. Results go to a JSON file so runs can be compared:
+
+  python -m src.utils.retrieval_bench --sizes 1000 100000 1000000 --out bench.json
+"""
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Sequence
+import json, os, platform, resource, shutil, sys, tempfile, time
+import numpy as np
+
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+DEFAULT_DIM = 768
+BACKENDS = ("exact", "ivf", "batch", "lexical", "hybrid", "tool")
+
+_TOPICS = {
+    "distortion": "catastrophizing overgeneralization mind reading fortune telling labeling should statements "
+                  "personalization filtering magnification minimization all or nothing thinking",
+    "attachment": "secure anxious avoidant disorganized reassurance abandonment closeness partner trust "
+                  "rejection dependence withdrawal caregiver bond",
+    "defense": "denial projection rationalization displacement repression sublimation intellectualization "
+               "regression reaction formation splitting humor suppression",
+    "erikson": "trust mistrust autonomy shame initiative guilt industry inferiority identity confusion "
+               "intimacy isolation generativity stagnation integrity despair",
+    "affect": "anxious sad angry ashamed hopeless relieved calm tense irritable numb overwhelmed lonely "
+              "guilty frustrated hopeful",
+    "context": "work manager deadline family mother father sibling relationship sleep appetite school "
+               "friends money health therapy session",
+}
+_FILLER = ("client therapist said felt feels about week again really maybe when because always never "
+           "today lately often sometimes describes reports notes").split()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def synthetic_texts(n: int, seed: int = 0, words: int = 48) -> tuple[List[str], np.ndarray]:
+    """n chunk texts drawn from one of the _TOPICS vocabularies plus filler; returns (texts, topic ids)."""
+    rng = np.random.default_rng(seed)
+    vocabs = [v.split() for v in _TOPICS.values()]
+    topic = rng.integers(0, len(vocabs), size=n)
+    texts: List[str] = []
+    for t in topic:
+        vocab = vocabs[int(t)]
+        own = rng.choice(len(vocab), size=words * 2 // 3)
+        fill = rng.choice(len(_FILLER), size=words - len(own))
+        toks = [vocab[i] for i in own] + [_FILLER[i] for i in fill]
+        rng.shuffle(toks)
+        texts.append(" ".join(toks))
+    return texts, topic
+
+
+def synthetic_vectors(topic: np.ndarray, dim: int, seed: int = 0, clusters_per_topic: int = 32,
+                      block: int = 65536) -> np.ndarray:
+    """Clustered unit vectors (one Gaussian blob per sub-topic) for sizes too large to embed quickly."""
+    from src.utils.vector_store import l2_normalize
+    rng = np.random.default_rng(seed + 1)
+    n_topics = int(topic.max()) + 1 if topic.size else 1
+    centers = l2_normalize(rng.normal(size=(n_topics * clusters_per_topic, dim)).astype(np.float32))
+    sub = topic * clusters_per_topic + rng.integers(0, clusters_per_topic, size=topic.shape[0])
+    out = np.empty((topic.shape[0], dim), dtype=np.float32)
+    for i in range(0, topic.shape[0], block):
+        c = centers[sub[i:i + block]]
+        out[i:i + block] = l2_normalize(c + rng.normal(scale=0.6 / np.sqrt(dim), size=c.shape).astype(np.float32))
+    return out
+
+
+def _perturb(text: str, rng: np.random.Generator, drop: float = 0.3) -> str:
+    toks = text.split()
+    keep = rng.random(len(toks)) >= drop
+    return " ".join(t for t, k in zip(toks, keep) if k) or text
+
+
+def _latency(fn, items: Sequence[Any]) -> tuple[Dict[str, float], List[Any]]:
+    times: List[float] = []
+    out: List[Any] = []
+    for it in items:
+        t0 = time.perf_counter()
+        out.append(fn(it))
+        times.append(time.perf_counter() - t0)
+    ms = np.asarray(times) * 1000.0
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3), "p95_ms": round(float(np.percentile(ms, 95)), 3),
+            "mean_ms": round(float(ms.mean()), 3)}, out
+
+
+def _recall(results: List[List[int]], reference: List[List[int]], k: int) -> float:
+    hit = sum(len(set(r[:k]) & set(ref[:k])) for r, ref in zip(results, reference))
+    total = sum(min(k, len(ref)) for ref in reference)
+    return round(hit / total, 4) if total else 1.0
+
+
+def run_size(n: int, dim: int = DEFAULT_DIM, vectors: str = "hashing", queries: int = 200, k: int = 10,
+             nprobe: int = 0, backends: Sequence[str] = BACKENDS, seed: int = 0,
+             workdir: Optional[str] = None) -> Dict[str, Any]:
+    """Build, load and query one synthetic store of n chunks; returns its result row."""
+    from src.utils.embeddings import HashingEmbedder
+    from src.utils.vector_store import VectorStore, get_store_cache
+
+    tmp = workdir or tempfile.mkdtemp(prefix="retrieval_bench_")
+    base = os.path.join(tmp, "embeddings", "corpus_store")
+    embedder = HashingEmbedder(dim=dim)
+    row: Dict[str, Any] = {"n": n, "dim": dim, "vectors": vectors, "k": k, "queries": queries}
+    try:
+        texts, topic = synthetic_texts(n, seed)
+        t0 = time.perf_counter()
+        if vectors == "random":
+            mat = synthetic_vectors(topic, dim, seed)
+        else:
+            mat = np.concatenate([embedder.embed_matrix(texts[i:i + 8192]) for i in range(0, n, 8192)]) \
+                if n else np.zeros((0, dim), dtype=np.float32)
+        row["embed_s"] = round(time.perf_counter() - t0, 3)
+
+        records = [{"kind": "corpus", "source": f"synthetic/doc_{i // 50}.md", "doc_id": f"d{i // 50}",
+                    "chunk_index": i % 50, "content": t, "embedding": mat[i], "embedding_model": embedder.name}
+                   for i, t in enumerate(texts)]
+        del mat
+        t0 = time.perf_counter()
+        VectorStore(base).write(records)
+        row["write_s"] = round(time.perf_counter() - t0, 3)
+        del records
+
+        get_store_cache().invalidate()
+        t0 = time.perf_counter()
+        vm = VectorStore(base).load()
+        row["load_s"] = round(time.perf_counter() - t0, 3)
+        row["ivf_index"] = vm.ann is not None
+
+        rng = np.random.default_rng(seed + 2)
+        picks = rng.choice(n, size=min(queries, n), replace=False) if n else np.empty(0, dtype=np.int64)
+        qtexts = [_perturb(texts[int(i)], rng) for i in picks]
+        if vectors == "random":
+            # queries near the picked rows: the stored vector plus fresh noise
+            base_rows = np.asarray(vm.groups[0][1][picks], dtype=np.float32)
+            qvs = base_rows + rng.normal(scale=0.3 / np.sqrt(dim), size=base_rows.shape).astype(np.float32)
+        else:
+            qvs = embedder.embed_matrix(qtexts)
+        del texts
+
+        results: Dict[str, Any] = {}
+        exact_stats, exact_hits = _latency(lambda q: vm.search(q, k, exact=True), list(qvs))
+        reference = [[i for i, _ in h] for h in exact_hits]
+        if "exact" in backends:
+            results["exact"] = {**exact_stats, "recall": 1.0}
+        if "ivf" in backends and vm.ann is not None:
+            stats, hits = _latency(lambda q: vm.search(q, k, nprobe=nprobe), list(qvs))
+            results["ivf"] = {**stats, "recall": _recall([[i for i, _ in h] for h in hits], reference, k),
+                              "nprobe": nprobe or vm.ann.default_nprobe()}
+        if "batch" in backends:
+            t0 = time.perf_counter()
+            hits = vm.search_batch(qvs, k, nprobe=nprobe)
+            per_q = (time.perf_counter() - t0) * 1000.0 / max(1, len(qvs))
+            results["batch"] = {"mean_ms": round(per_q, 3),
+                                "recall": _recall([[i for i, _ in h] for h in hits], reference, k)}
+        if "lexical" in backends:
+            stats, hits = _latency(lambda q: vm.lexical_search(q, k), qtexts)
+            results["lexical"] = {**stats, "recall": _recall([[i for i, _ in h] for h in hits], reference, k)}
+        if "hybrid" in backends:
+            stats, hits = _latency(lambda qi: vm.hybrid_search(qvs[qi], qtexts[qi], k, nprobe=nprobe),
+                                   list(range(len(qtexts))))
+            results["hybrid"] = {**stats, "recall": _recall([[i for i, _ in h] for h in hits], reference, k)}
+        if "tool" in backends:
+            results["tool"] = _tool_latency(tmp, qtexts, k, embedder)
+        row["backends"] = results
+        row["peak_rss_mb"] = peak_rss_mb()
+        return row
+    finally:
+        get_store_cache().invalidate()
+        if workdir is None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _tool_latency(root: str, qtexts: List[str], k: int, embedder) -> Dict[str, Any]:
+    """SearchMetadataChunks.forward over the corpus store under `root`, with the bench's embedder."""
+    try:
+        from tools.search_tools import SearchMetadataChunks
+    except ImportError as e:  # smolagents not installed
+        return {"skipped": str(e)}
+    tool = SearchMetadataChunks(embedder=embedder, root=root)
+    tool.forward(qtexts[0], top_k=k, kind="corpus", include_notes=False)  # first call loads the store
+    stats, _ = _latency(lambda q: tool.forward(q, top_k=k, kind="corpus", include_notes=False), qtexts)
+    return stats
+
+
+def run(sizes: Sequence[int] = DEFAULT_SIZES, isolate: bool = True, **kwargs: Any) -> Dict[str, Any]:
+    """Benchmark every size (each in its own process unless isolate=False)."""
+    rows: List[Dict[str, Any]] = []
+    for n in sizes:
+        if isolate:
+            import multiprocessing as mp
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as ex:
+                row = ex.submit(run_size, int(n), **kwargs).result()
+        else:
+            row = run_size(int(n), **kwargs)
+        print(_summary(row))
+        rows.append(row)
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "params": {k: (list(v) if isinstance(v, tuple) else v) for k, v in kwargs.items()},
+        "results": rows,
+    }
+
+
+def _summary(row: Dict[str, Any]) -> str:
+    parts = [f"n={row['n']:>8} embed={row['embed_s']}s write={row['write_s']}s load={row['load_s']}s "
+             f"rss={row['peak_rss_mb']}MB"]
+    for name, r in row["backends"].items():
+        if "skipped" in r:
+            parts.append(f"  {name:8} skipped ({r['skipped']})")
+        else:
+            p50 = f"p50={r['p50_ms']}ms p95={r['p95_ms']}ms" if "p50_ms" in r else f"mean={r['mean_ms']}ms"
+            rec = f" recall@{row['k']}={r['recall']}" if "recall" in r else ""
+            parts.append(f"  {name:8} {p50}{rec}")
+    return "\n".join(parts)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="retrieval_bench.py", description="Benchmark retrieval on synthetic stores")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    parser.add_argument("--vectors", choices=("hashing", "random"), default="hashing",
+                        help="hashing = HashingEmbedder over the synthetic texts; random = clustered vectors (fast)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, default=0)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-isolate", action="store_true", help="run all sizes in this process")
+    parser.add_argument("--out", default="retrieval_bench.json", help="JSON results file")
+    args = parser.parse_args()
+
+    report = run(args.sizes, isolate=not args.no_isolate, dim=args.dim, vectors=args.vectors,
+                 queries=args.queries, k=args.k, nprobe=args.nprobe, backends=tuple(args.backends), seed=args.seed)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
@@ -0,0 +1,87 @@
+# src/utils/shards.py
+"""Where the corpus and notes stores of each patient / session live.
+
+  embeddings/metadata_store                                   global shard (psych frameworks etc.)
+  embeddings/agent_notes_store                                global agent notes (no patient set)
+  embeddings/shards/<patient_id>/<session_date>/corpus_store        patient_raw_data chunks
+  embeddings/shards/<patient_id>/<session_date>/agent_notes_store   agent notes of that session
+
+Sessions without a date use `_all`, records without a patient `_unassigned`. A search only
+opens the shards of the patient (and session) it is scoped to, by default the active patient;
+crossing patients takes an explicit ALL_PATIENTS. StoreCache keeps recently used shards and
+evicts cold ones.
+"""
+from __future__ import annotations
+from typing import Any, Dict, List, Optional
+import os, re
+
+SHARDS_DIR = "embeddings/shards"
+CORPUS_SHARD = "corpus_store"
+NOTES_SHARD = "agent_notes_store"
+NO_SESSION = "_all"
+UNASSIGNED_PATIENT = "_unassigned"
+ALL_PATIENTS = "*"
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _safe(part: Optional[str], default: str) -> str:
+    part = _UNSAFE.sub("_", str(part or "").strip()).strip("._")
+    return part or default
+
+
+def shard_dir(patient_id: Optional[str], session: Optional[str] = None) -> str:
+    return f"{SHARDS_DIR}/{_safe(patient_id, UNASSIGNED_PATIENT)}/{_safe(session, NO_SESSION)}"
+
+
+def shard_base(name: str, patient_id: Optional[str], session: Optional[str] = None) -> str:
+    """Store base path of `name` (corpus_store / agent_notes_store) in a patient/session shard."""
+    return f"{shard_dir(patient_id, session)}/{name}"
+
+
+def record_shard(rec: Dict[str, Any]) -> tuple[str, str]:
+    """(patient_id, session) a record belongs to; agent notes keep them under `metadata`."""
+    meta = rec.get("metadata") if isinstance(rec.get("metadata"), dict) else {}
+    pid = rec.get("patient_id") or meta.get("patient_id") or ""
+    session = rec.get("session_date") or meta.get("session_date") or ""
+    return str(pid), str(session)
+
+
+def _list_dirs(path: str, sandbox=None) -> List[str]:
+    if sandbox:
+        try:
+            out = []
+            for e in sandbox.files.list(path):
+                name = e["name"] if isinstance(e, dict) else getattr(e, "name", "")
+                is_dir = e.get("is_dir", False) if isinstance(e, dict) else getattr(e, "type", "") == "dir"
+                if name and is_dir:
+                    out.append(name)
+            return sorted(out)
+        except Exception:
+            return []
+    try:
+        return sorted(n for n in os.listdir(path) if os.path.isdir(os.path.join(path, n)))
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def list_shard_bases(name: str, patient_id: Optional[str] = None, session: Optional[str] = None,
+                     sandbox=None, root: str = "") -> List[str]:
+    """
+    Base paths of `name` in the shards matching the scope (None / ALL_PATIENTS = every patient,
+    None = every session), under `root` if given. Only directories are listed here; whether a
+    store actually exists is left to the loader.
+    """
+    shards_dir = os.path.join(root, SHARDS_DIR) if root else SHARDS_DIR
+    if not patient_id or patient_id == ALL_PATIENTS:
+        patients = _list_dirs(shards_dir, sandbox)
+    else:
+        patients = [patient_id if patient_id == UNASSIGNED_PATIENT else _safe(patient_id, UNASSIGNED_PATIENT)]
+    out: List[str] = []
+    for pid in patients:
+        if session:
+            sessions = [session if session == NO_SESSION else _safe(session, NO_SESSION)]
+        else:
+            sessions = _list_dirs(f"{shards_dir}/{pid}", sandbox)
+        out.extend(f"{shards_dir}/{pid}/{s}/{name}" for s in sessions)
+    return out
@@ -1,7 +1,10 @@
 from __future__ import annotations
-import sqlite3
+import itertools, os, queue, random, sqlite3, threading, time
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import Iterable, Mapping, Any, Optional
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Any, Optional, Sequence, TypeVar
+
+from src.utils.db_schema import SCHEMA_VERSION, migrate
 
 # SQLAlchemy optional (nice for pandas / ORM)
 try:
@@ -17,43 +20,316 @@ PRAGMA_BOOT = [
 "PRAGMA mmap_size=134217728;", # 128MB
 ]
 
-def init_sqlite(db_path: str) -> None:
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        for p in PRAGMA_BOOT:
-            cur.execute(p)
-        conn.commit()
+# Per-connection settings for the read-only pool (journal_mode is a property of the db file, set by the writer)
+PRAGMA_READ = [
+"PRAGMA temp_store=MEMORY;",
+"PRAGMA mmap_size=134217728;",
+]
 
-def ensure_schema(db_path: str) -> None:
-    """Create minimal tables used by your pipeline; extend as needed."""
-    with sqlite3.connect(db_path) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS qa_pairs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id TEXT,
-            session_type TEXT,
-            session_date TEXT,
-            q TEXT,
-            a TEXT,
-            source TEXT
-            );
-            """
-        )
-        cur.execute(
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL", "4"))
+BUSY_RETRIES = 5
+BULK_BATCH_SIZE = int(os.getenv("SQLITE_BULK_BATCH", "1000"))
+QUERY_TIMEOUT_S = float(os.getenv("SQLITE_QUERY_TIMEOUT_S", "10"))
+PROGRESS_OPS = 10_000  # VM instructions between deadline checks
+RESULT_CACHE_MAX = int(os.getenv("SQLITE_RESULT_CACHE", "256"))
+
+T = TypeVar("T")
+
+
+def is_busy_error(e: BaseException) -> bool:
+    msg = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+
+def with_busy_retry(fn: Callable[[], T], retries: int = BUSY_RETRIES, base_delay: float = 0.05) -> T:
+    """Run fn(), retrying with jittered exponential backoff while SQLite reports SQLITE_BUSY/LOCKED."""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if attempt >= retries or not is_busy_error(e):
+                raise
+            time.sleep(base_delay * (2 ** attempt) * (0.5 + random.random()))
+    raise AssertionError("unreachable")
+
+
+class QueryTimeout(Exception):
+    """A query ran past its wall-clock deadline and was interrupted."""
+
+
+@contextmanager
+def query_deadline(conn: sqlite3.Connection, timeout_s: Optional[float] = QUERY_TIMEOUT_S) -> Iterator[None]:
+    """
+    Interrupt statements on `conn` (execute and every fetch) once timeout_s has elapsed,
+    via set_progress_handler; the interruption surfaces as QueryTimeout. The handler is
+    removed on exit, so pooled connections come back clean.
+    """
+    if not timeout_s or timeout_s <= 0:
+        yield
+        return
+    deadline = time.monotonic() + float(timeout_s)
+    fired = []
+
+    def _check() -> int:
+        if time.monotonic() > deadline:
+            fired.append(True)
+            return 1
+        return 0
+
+    conn.set_progress_handler(_check, PROGRESS_OPS)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if fired:
+            raise QueryTimeout(f"query exceeded {timeout_s:g}s") from e
+        raise
+    finally:
+        conn.set_progress_handler(None, PROGRESS_OPS)
+
+
+class QueryResultCache:
+    """
+    LRU of read-query results for one database. Entries are keyed by the caller's query key
+    plus the data_version they were read under, so any commit (from this process or
+    another) makes older entries unreachable; they age out of the LRU.
+    """
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX):
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "max": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteManager:
+    """
+    Connections for one database file, shared by every tool in the process:
+      - one long-lived writer (autocommit mode; writes go through transaction()/write(), serialised by a lock)
+      - up to `read_pool_size` read-only connections (mode=ro), handed out by reader()/read()
+    PRAGMA_BOOT and busy_timeout are applied once per connection; pending db_schema migrations
+    run when the writer is first opened, and extra DDL via ensure_schema() once per process.
+    """
+    def __init__(self, db_path: str, read_pool_size: int = READ_POOL_SIZE, busy_timeout_ms: int = BUSY_TIMEOUT_MS):
+        self.db_path = db_path
+        self.read_pool_size = max(1, int(read_pool_size))
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self._write_lock = threading.RLock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._n_readers = 0
+        self._pool_lock = threading.Lock()
+        self._schema_done: set = set()
+        self._version_conn: Optional[sqlite3.Connection] = None
+        self._version_lock = threading.Lock()
+        self.results = QueryResultCache()
+
+    # -------- connections --------
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        timeout = self.busy_timeout_ms / 1000.0
+        if readonly:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=timeout, check_same_thread=False)
+            pragmas = PRAGMA_READ
+        else:
+            parent = os.path.dirname(self.db_path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=timeout, check_same_thread=False, isolation_level=None)
+            pragmas = PRAGMA_BOOT
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms};")
+        for p in pragmas:
+            with_busy_retry(lambda: conn.execute(p))
+        return conn
+
+    def _writer_conn(self) -> sqlite3.Connection:
+        if self._writer is None:
+            conn = self._connect(readonly=False)
+            try:
+                with_busy_retry(lambda: migrate(conn))  # schema is current before anyone uses the db
+            except Exception:
+                conn.close()
+                raise
+            self._writer = conn
+        return self._writer
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """BEGIN IMMEDIATE ... COMMIT on the writer (ROLLBACK on error)."""
+        with self._write_lock:
+            conn = self._writer_conn()
+            with_busy_retry(lambda: conn.execute("BEGIN IMMEDIATE"))
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                # a failed COMMIT (busy, deferred constraint) leaves the transaction open
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """fn(conn) in one write transaction, re-run from the start if the database stays busy."""
+        def _once() -> T:
+            with self.transaction() as conn:
+                return fn(conn)
+        return with_busy_retry(_once)
+
+    def bulk_write(self, sql: str, rows: Iterable[Sequence[Any]], batch_size: int = BULK_BATCH_SIZE) -> int:
         """
-        CREATE TABLE IF NOT EXISTS graph_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id TEXT,
-            session_date TEXT,
-            kind TEXT, -- e.g. DISTORTION, EMOTION, STAGE
-            payload TEXT, -- JSON blob
-            created_at TEXT DEFAULT (datetime('now'))
-            );
+        executemany(sql) over `rows` in batches of batch_size, all in one transaction.
+        `rows` may be a generator: only one batch is held in memory. Not retried as a whole
+        (a consumed generator can't be replayed); busy_timeout covers lock waits. Returns rows written.
+        """
+        it = iter(rows)
+        count = 0
+        with self.transaction() as conn:
+            while True:
+                batch = list(itertools.islice(it, max(1, int(batch_size))))
+                if not batch:
+                    break
+                conn.executemany(sql, batch)
+                count += len(batch)
+        return count
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """A pooled read-only connection (blocks while all read_pool_size are in use)."""
+        conn: Optional[sqlite3.Connection] = None
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                grow = self._n_readers < self.read_pool_size
+                if grow:
+                    self._n_readers += 1
+            if grow:
+                try:
+                    with self._write_lock:
+                        self._writer_conn()  # creates/migrates the file; mode=ro can do neither
+                    conn = self._connect(readonly=True)
+                except Exception:
+                    with self._pool_lock:
+                        self._n_readers -= 1
+                    raise
+            else:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """fn(conn) on a pooled reader, retried while the database is busy."""
+        def _once() -> T:
+            with self.reader() as conn:
+                return fn(conn)
+        return with_busy_retry(_once)
+
+    def data_version(self) -> int:
         """
-        )
-        conn.commit()
+        PRAGMA data_version on a dedicated read-only connection. It changes whenever another
+        connection (our writer included, or another process) commits, so it versions reads.
+        """
+        with self._version_lock:
+            if self._version_conn is None:
+                with self._write_lock:
+                    self._writer_conn()
+                self._version_conn = self._connect(readonly=True)
+            return int(self._version_conn.execute("PRAGMA data_version;").fetchone()[0])
+
+    def checkpoint(self) -> None:
+        """Fold the WAL into the main db file (before copying the file elsewhere)."""
+        with self._write_lock:
+            with_busy_retry(lambda: self._writer_conn().execute("PRAGMA wal_checkpoint(TRUNCATE);"))
+
+    # -------- schema --------
+    def ensure_schema(self, *ddl: str) -> None:
+        """Run each DDL statement once per process (the CREATE ... IF NOT EXISTS stays idempotent)."""
+        todo = [d for d in ddl if d not in self._schema_done]
+        if not todo:
+            return
+        def _apply(conn: sqlite3.Connection) -> None:
+            for d in todo:
+                conn.execute(d)
+        self.write(_apply)
+        self._schema_done.update(todo)
+
+    def close(self) -> None:
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._pool_lock:
+            self._n_readers = 0
+        with self._version_lock:
+            if self._version_conn is not None:
+                self._version_conn.close()
+                self._version_conn = None
+        self.results.clear()
+
+
+_MANAGERS: Dict[str, SQLiteManager] = {}
+_MANAGERS_LOCK = threading.Lock()
+
+
+def get_sqlite_manager(db_path: str) -> SQLiteManager:
+    """Process-wide SQLiteManager for db_path (keyed by absolute path)."""
+    key = os.path.abspath(str(db_path))
+    with _MANAGERS_LOCK:
+        mgr = _MANAGERS.get(key)
+        if mgr is None:
+            mgr = _MANAGERS[key] = SQLiteManager(key)
+        return mgr
+
+
+def close_all_sqlite() -> None:
+    with _MANAGERS_LOCK:
+        for mgr in _MANAGERS.values():
+            mgr.close()
+        _MANAGERS.clear()
+
+def init_sqlite(db_path: str) -> None:
+    """Create the db if needed, apply PRAGMA_BOOT and bring the schema to SCHEMA_VERSION."""
+    get_sqlite_manager(db_path).write(lambda conn: None)
+
+def ensure_schema(db_path: str) -> int:
+    """Apply pending schema migrations (see db_schema.py); returns the schema version."""
+    init_sqlite(db_path)
+    return SCHEMA_VERSION
 
 @contextmanager
 def sqlite_conn(db_path: str):
@@ -63,17 +339,41 @@ def sqlite_conn(db_path: str):
     finally:
         conn.close()
 
-def bulk_insert_qa(db_path: str, rows: Iterable[Mapping[str, Any]]):
-    with sqlite_conn(db_path) as conn:
-        cur = conn.cursor()
-        cur.executemany(
-        """
-            INSERT INTO qa_pairs (patient_id, session_type, session_date, q, a, source)
-            VALUES (:patient_id, :session_type, :session_date, :q, :a, :source)
-            """,
-            list(rows),
-        )
-        conn.commit()
+_QA_TURN_SQL = (
+    "INSERT INTO qa_pairs (patient_id, session_type, session_date, turn_id, speaker, text_raw, text_clean) "
+    "VALUES (:patient_id, :session_type, :session_date, :turn_id, :speaker, :text_raw, :text_clean) "
+    "ON CONFLICT(patient_id, session_type, session_date, turn_id) DO UPDATE SET "
+    "speaker=excluded.speaker, text_raw=excluded.text_raw, text_clean=excluded.text_clean"
+)
+
+# q/a rows carry no turn id: each becomes the next turn of its session
+_QA_LEGACY_SQL = (
+    "INSERT INTO qa_pairs (patient_id, session_type, session_date, turn_id, text_raw, text_clean) "
+    "SELECT :patient_id, :session_type, :session_date, COALESCE(MAX(turn_id), 0) + 1, :q, :a FROM qa_pairs "
+    "WHERE patient_id = :patient_id AND session_type = :session_type AND session_date = :session_date"
+)
+
+
+def _legacy_qa_row(r: Mapping[str, Any]) -> Dict[str, Any]:
+    return {"patient_id": r.get("patient_id") or "unknown", "session_type": r.get("session_type") or "unknown",
+            "session_date": r.get("session_date") or "unknown", "q": r.get("q"), "a": r.get("a")}
+
+
+def bulk_insert_qa(db_path: str, rows: Iterable[Mapping[str, Any]]) -> int:
+    """
+    Upsert turn rows ({patient_id, session_type, session_date, turn_id, speaker, text_raw, text_clean}).
+    Rows in the older {patient_id, session_type, session_date, q, a, source} shape are still
+    accepted (decided by the first row): q → text_raw, a → text_clean, appended as the session's
+    next turn. qa_pairs has no source column, so `source` is not stored.
+    """
+    it = iter(rows)
+    first = next(it, None)
+    if first is None:
+        return 0
+    rows = itertools.chain([first], it)
+    if "turn_id" not in first and ("q" in first or "a" in first):
+        return get_sqlite_manager(db_path).bulk_write(_QA_LEGACY_SQL, (_legacy_qa_row(r) for r in rows))
+    return get_sqlite_manager(db_path).bulk_write(_QA_TURN_SQL, rows)
 
 def run_query(db_path: str, sql: str, params: Optional[dict]=None):
     if SQLA_OK:
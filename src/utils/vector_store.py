@@ -0,0 +1,818 @@
+# src/utils/vector_store.py
+"""
+NumPy scoring and the on-disk format of the embedding stores (metadata / corpus / agent notes).
+
+Every store is turned into a pre-normalised float32 matrix once, so a query is a
+single matrix-vector product followed by an argpartition top-k.
+
+On disk a store `<base>` is two files:
+  <base>.npy    (n, d) normalised float32 matrix; opened with mmap_mode="r" on the host
+  <base>.jsonl  header line + one record per row (kind, source, doc_id, chunk_index, content, ...)
+plus a BM25 inverted index <base>.bm25.npz over the record contents (see lexical_index.py)
+and, for stores of at least ANN_MIN_ROWS vectors, an IVF index <base>.ivf.npz (see ann_index.py).
+A legacy `<base>.json` list store (embeddings inline as floats) is converted on first use.
+"""
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import io, json, os, threading, uuid, warnings
+from collections import OrderedDict
+import numpy as np
+
+from src.utils.ann_index import ANN_MIN_ROWS, IVFIndex, build_or_update
+from src.utils.lexical_index import BM25Index, rank_scores, rrf_fuse
+
+STORE_FORMAT_VERSION = 1
+BATCH_BLOCK_ROWS = 65536  # rows per matrix-matrix block in VectorMatrix.search_batch
+STORE_CACHE_MAX = int(os.getenv("STORE_CACHE_MAX", "16"))  # loaded stores/shards kept by StoreCache
+
+
+def l2_normalize(mat: np.ndarray) -> np.ndarray:
+    """Row-wise L2 normalisation to float32. Zero rows stay zero."""
+    m = np.asarray(mat, dtype=np.float32)
+    if m.ndim == 1:
+        m = m[None, :]
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first."""
+    n = int(scores.shape[0])
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def cosine_scores(mat: np.ndarray, qv: np.ndarray) -> np.ndarray:
+    """
+    Cosine of every (already normalised) row of `mat` against `qv`.
+    On a dim mismatch both sides are truncated to the shorter length,
+    which is what the old pure-Python `_cosine` did.
+    """
+    q = np.asarray(qv, dtype=np.float32).ravel()
+    d = mat.shape[1]
+    if q.shape[0] == d:
+        qn = float(np.linalg.norm(q))
+        if qn == 0:
+            return np.zeros(mat.shape[0], dtype=np.float32)
+        return mat @ (q / qn)
+    n = min(d, q.shape[0])
+    sub = mat[:, :n]
+    qq = q[:n]
+    qn = float(np.linalg.norm(qq))
+    norms = np.linalg.norm(sub, axis=1)
+    if qn == 0:
+        return np.zeros(mat.shape[0], dtype=np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = (sub @ qq) / (norms * qn)
+    return np.nan_to_num(s, nan=0.0, posinf=0.0, neginf=0.0).astype(np.float32)
+
+
+class VectorMatrix:
+    """
+    Records plus their embeddings as pre-normalised float32 matrices.
+    Rows are grouped by embedding dim, because legacy stores can mix real vectors
+    with 10-d placeholder ones; each group is scored on its own.
+    """
+    def __init__(self, records: List[Dict[str, Any]], groups: List[Tuple[np.ndarray, np.ndarray]],
+                 ann: Optional[IVFIndex] = None, lexical: Optional[BM25Index] = None):
+        self.records = records
+        self.groups = groups  # [(row_ids into records, (n, d) matrix)]
+        self.ann = ann        # IVF index over groups[0] (the store's .npy matrix), if one was built
+        self._lexical = lexical
+        self._models: Optional[set] = None
+        self._columns: Optional[RecordColumns] = None
+        self._row_of: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def from_records(
+        cls,
+        records: List[Dict[str, Any]],
+        fallback_embed: Optional[Callable[[str], List[float]]] = None,
+    ) -> "VectorMatrix":
+        by_dim: Dict[int, Tuple[List[int], List[Sequence[float]]]] = {}
+        for i, rec in enumerate(records):
+            emb = rec.get("embedding")
+            if not isinstance(emb, list) or not emb:
+                if fallback_embed is None:
+                    continue
+                emb = fallback_embed(rec.get("content", ""))
+            ids, vecs = by_dim.setdefault(len(emb), ([], []))
+            ids.append(i)
+            vecs.append(emb)
+        groups = [
+            (np.asarray(ids, dtype=np.int64), l2_normalize(np.asarray(vecs, dtype=np.float32)))
+            for ids, vecs in by_dim.values()
+        ]
+        return cls(records, groups)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def vectors(self) -> Dict[int, np.ndarray]:
+        """record index -> normalised vector (views into the matrices, no copies)."""
+        return {int(i): mat[j] for ids, mat in self.groups for j, i in enumerate(ids)}
+
+    def embedding(self, i: int) -> Optional[np.ndarray]:
+        """Normalised vector of record i (a view into its group matrix), or None."""
+        if self._row_of is None:
+            group_of = np.full(len(self.records), -1, dtype=np.int32)
+            row_of = np.zeros(len(self.records), dtype=np.int64)
+            for g, (ids, _mat) in enumerate(self.groups):
+                group_of[ids] = g
+                row_of[ids] = np.arange(len(ids))
+            self._row_of = (group_of, row_of)
+        group_of, row_of = self._row_of
+        g = int(group_of[i])
+        return None if g < 0 else np.asarray(self.groups[g][1][row_of[i]], dtype=np.float32)
+
+    def models(self) -> set:
+        """Embedding model names present in the records (computed once)."""
+        if self._models is None:
+            self._models = {r["embedding_model"] for r in self.records if r.get("embedding_model")}
+        return self._models
+
+    @property
+    def lexical(self) -> BM25Index:
+        """BM25 index over record contents (persisted for stores, built on first use otherwise)."""
+        if self._lexical is None or len(self._lexical) != len(self.records):
+            self._lexical = BM25Index.from_texts(r.get("content", "") for r in self.records)
+        return self._lexical
+
+    def lexical_search(self, query: str, k: int, mask: Optional[np.ndarray] = None,
+                       fused: bool = False) -> List[Tuple[int, float]]:
+        """
+        Top-k (record index, BM25 score), best first; `mask` is a per-record bool filter.
+        fused=True returns rank (RRF) scores instead, for merging with other stores' hits.
+        """
+        hits = self.lexical.search(query, k, mask=mask)
+        return rank_scores(hits) if fused else hits
+
+    def hybrid_search(self, qv: Sequence[float], query: str, k: int, min_score: float = 0.0,
+                      nprobe: int = 0, exact: bool = False, depth: int = 0,
+                      mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Reciprocal rank fusion of the vector and BM25 rankings (each `depth` deep, default
+        max(4k, 50)). Scores are RRF scores, so results of several stores merge by rank;
+        min_score (a cosine threshold) filters the vector side only.
+        """
+        depth = depth or max(4 * k, 50)
+        dense = self.search(qv, depth, min_score, nprobe=nprobe, exact=exact, mask=mask)
+        sparse = self.lexical_search(query, depth, mask=mask)
+        return rrf_fuse([[i for i, _ in dense], [i for i, _ in sparse]], k)
+
+    # -------- attribute pre-filters --------
+    @property
+    def columns(self) -> "RecordColumns":
+        """Dictionary-encoded attribute columns of the records (built on first use)."""
+        if self._columns is None or self._columns.n != len(self.records):
+            self._columns = RecordColumns(self.records)
+        return self._columns
+
+    def filter_mask(self, **filters: Any) -> Optional[np.ndarray]:
+        """Per-record bool mask for RecordColumns filters; None when no filter is set."""
+        return self.columns.mask(**filters)
+
+    def _narrow(self, ids: np.ndarray, mat: np.ndarray, mask: Optional[np.ndarray], use_ann: bool):
+        """
+        Apply a record mask to one group before any scoring. Returns (ids, mat, row_mask) or
+        None if nothing survives; row_mask is only set for IVF-probed groups (filtered lists).
+        """
+        if mask is None:
+            return ids, mat, None
+        gm = mask[ids]
+        if not gm.any():
+            return None
+        if gm.all():
+            return ids, mat, None
+        if use_ann and int(gm.sum()) >= ANN_MIN_ROWS:
+            return ids, mat, gm
+        sel = np.flatnonzero(gm)
+        return ids[sel], mat[sel], None  # only the surviving rows are read / scored
+
+    def search(self, qv: Sequence[float], k: int, min_score: float = 0.0,
+               nprobe: int = 0, exact: bool = False, mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (record index, score) pairs with score >= min_score, best first.
+        The main matrix goes through the IVF index when there is one (nprobe lists, 0 = index
+        default) unless exact=True. `mask` (see filter_mask) drops records before scoring.
+        """
+        if k <= 0 or not self.groups:
+            return []
+        q = np.asarray(qv, dtype=np.float32)
+        hit_ids: List[np.ndarray] = []
+        hit_scores: List[np.ndarray] = []
+        for g, (ids, mat) in enumerate(self.groups):
+            if mat.shape[0] == 0:
+                continue
+            use_ann = g == 0 and self.ann is not None and not exact and q.shape[0] == self.ann.dim
+            narrowed = self._narrow(ids, mat, mask, use_ann)
+            if narrowed is None:
+                continue
+            ids_g, mat_g, row_mask = narrowed
+            if use_ann and mat_g is mat:
+                qn = float(np.linalg.norm(q))
+                if qn == 0:
+                    continue
+                rows, s = self.ann.search(mat, q / qn, k, nprobe, row_mask=row_mask)
+                keep = s >= min_score
+                hit_ids.append(ids[rows[keep]])
+                hit_scores.append(s[keep])
+                continue
+            s = cosine_scores(mat_g, q)
+            best = top_k_indices(s, k)
+            best = best[s[best] >= min_score]
+            hit_ids.append(ids_g[best])
+            hit_scores.append(s[best])
+        if not hit_ids:
+            return []
+        ids_all = np.concatenate(hit_ids)
+        scores_all = np.concatenate(hit_scores)
+        order = top_k_indices(scores_all, k)
+        return [(int(ids_all[i]), float(scores_all[i])) for i in order]
+
+    def search_batch(self, qvs: Sequence[Sequence[float]], k: int, min_score: float = 0.0,
+                     nprobe: int = 0, exact: bool = False,
+                     mask: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        """
+        search() for several queries at once. Exact groups are scored with one
+        matrix-matrix product per row block (block x m scores); IVF-indexed groups are
+        probed per query, which is already sub-linear.
+        """
+        m = len(qvs)
+        if k <= 0 or not self.groups or m == 0:
+            return [[] for _ in range(m)]
+        dims = {len(q) for q in qvs}
+        if len(dims) != 1:
+            return [self.search(q, k, min_score, nprobe=nprobe, exact=exact, mask=mask) for q in qvs]
+        q = l2_normalize(np.asarray(qvs, dtype=np.float32))  # (m, d)
+        pooled: List[List[Tuple[np.ndarray, np.ndarray]]] = [[] for _ in range(m)]
+        for g, (ids, mat) in enumerate(self.groups):
+            if mat.shape[0] == 0:
+                continue
+            use_ann = g == 0 and self.ann is not None and not exact and q.shape[1] == self.ann.dim
+            narrowed = self._narrow(ids, mat, mask, use_ann)
+            if narrowed is None:
+                continue
+            ids_g, mat_g, row_mask = narrowed
+            if use_ann and mat_g is mat:
+                for j in range(m):
+                    if not q[j].any():
+                        continue
+                    rows, s = self.ann.search(mat, q[j], k, nprobe, row_mask=row_mask)
+                    keep = s >= min_score
+                    pooled[j].append((ids[rows[keep]], s[keep]))
+                continue
+            if mat_g.shape[1] != q.shape[1]:
+                for j in range(m):
+                    s = cosine_scores(mat_g, q[j])
+                    best = top_k_indices(s, k)
+                    best = best[s[best] >= min_score]
+                    pooled[j].append((ids_g[best], s[best]))
+                continue
+            qt = np.ascontiguousarray(q.T)
+            for start in range(0, mat_g.shape[0], BATCH_BLOCK_ROWS):
+                block = np.asarray(mat_g[start:start + BATCH_BLOCK_ROWS], dtype=np.float32) @ qt  # (b, m)
+                kk = min(k, block.shape[0])
+                if kk < block.shape[0]:
+                    top = np.argpartition(-block, kk - 1, axis=0)[:kk]  # (kk, m)
+                else:
+                    top = np.broadcast_to(np.arange(block.shape[0])[:, None], block.shape)
+                top_s = np.take_along_axis(block, top, axis=0)
+                for j in range(m):
+                    keep = top_s[:, j] >= min_score
+                    pooled[j].append((ids_g[start + top[keep, j]], top_s[keep, j]))
+        out: List[List[Tuple[int, float]]] = []
+        for parts in pooled:
+            if not parts:
+                out.append([])
+                continue
+            ids_all = np.concatenate([p[0] for p in parts])
+            scores_all = np.concatenate([p[1] for p in parts])
+            order = top_k_indices(scores_all, k)
+            out.append([(int(ids_all[i]), float(scores_all[i])) for i in order])
+        return out
+
+
+def _record_attr(rec: Dict[str, Any], field: str) -> str:
+    """Filter attribute of a record; agent notes keep patient/session fields under `metadata`."""
+    meta = rec.get("metadata") if isinstance(rec.get("metadata"), dict) else {}
+    if field == "session":
+        v = rec.get("session_date") or meta.get("session_date") or rec.get("session") or meta.get("session")
+    elif field == "kind":
+        v = rec.get("kind", "metadata")
+    else:
+        v = rec.get(field) or meta.get(field)
+    return "" if v is None else str(v)
+
+
+def _chunk_of(rec: Dict[str, Any]) -> int:
+    v = rec.get("chunk_index", rec.get("chunk_id"))
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return -1
+
+
+class RecordColumns:
+    """
+    Compact per-record attribute columns: each string field is dictionary-encoded into an
+    int32 code array (values[field][code] is the string), chunk ids are an int64 array
+    (-1 = none). A filter compares the few distinct values once, then masks the codes.
+    """
+    FIELDS = ("kind", "source", "doc_id", "patient_id", "session")
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.n = len(records)
+        self.values: Dict[str, List[str]] = {}
+        self.codes: Dict[str, np.ndarray] = {}
+        for field in self.FIELDS:
+            lookup: Dict[str, int] = {}
+            codes = np.fromiter(
+                (lookup.setdefault(_record_attr(r, field), len(lookup)) for r in records),
+                dtype=np.int32, count=self.n,
+            )
+            self.values[field] = list(lookup)
+            self.codes[field] = codes
+        self.chunk = np.fromiter((_chunk_of(r) for r in records), dtype=np.int64, count=self.n)
+
+    @staticmethod
+    def _matches(stored: str, wanted: str, field: str) -> bool:
+        if field == "kind":
+            return stored.lower() == wanted.lower()
+        # "psych_frameworks.md" also matches the stored "psych_metadata/psych_frameworks.md"
+        return stored == wanted or (field == "source" and stored.endswith("/" + wanted))
+
+    def mask(self, chunk_min: Optional[int] = None, chunk_max: Optional[int] = None,
+             **filters: Any) -> Optional[np.ndarray]:
+        """
+        Bool mask for equality filters (a value or list of values per field in FIELDS)
+        and an inclusive chunk id range. None when nothing is filtered.
+        """
+        out: Optional[np.ndarray] = None
+        for field, wanted in filters.items():
+            if wanted is None or wanted == "" or field not in self.codes:
+                continue
+            wanted_list = [str(w) for w in (wanted if isinstance(wanted, (list, tuple, set)) else [wanted])]
+            hit_codes = [c for c, v in enumerate(self.values[field])
+                         if any(self._matches(v, w, field) for w in wanted_list)]
+            m = np.isin(self.codes[field], np.asarray(hit_codes, dtype=np.int32))
+            out = m if out is None else (out & m)
+        if chunk_min is not None or chunk_max is not None:
+            m = np.ones(self.n, dtype=bool)
+            if chunk_min is not None:
+                m &= self.chunk >= int(chunk_min)
+            if chunk_max is not None:
+                m &= self.chunk <= int(chunk_max)
+            out = m if out is None else (out & m)
+        return out
+
+
+def merge_hits(
+    per_store: List[Tuple[VectorMatrix, List[Tuple[int, float]]]], k: int
+) -> List[Tuple[Dict[str, Any], float]]:
+    """Merge per-store hit lists into one global top-k of (record, score)."""
+    pooled = [(vm.records[i], s) for vm, hits in per_store for i, s in hits]
+    pooled.sort(key=lambda x: x[1], reverse=True)
+    return pooled[:k]
+
+
+def mmr_select(relevance: np.ndarray, sim: np.ndarray, k: int, lam: float) -> List[int]:
+    """
+    Maximal Marginal Relevance: greedily pick argmax(lam * rel - (1 - lam) * max sim to picked).
+    `sim` is the (m, m) candidate similarity matrix; the running max-similarity vector is
+    updated with one np.maximum per pick, so the whole selection is O(k * m).
+    """
+    m = relevance.shape[0]
+    k = min(k, m)
+    if k <= 0:
+        return []
+    chosen: List[int] = [int(np.argmax(relevance))]
+    max_sim = sim[chosen[0]].astype(np.float32, copy=True)
+    free = np.ones(m, dtype=bool)
+    free[chosen[0]] = False
+    for _ in range(k - 1):
+        gain = lam * relevance - (1.0 - lam) * max_sim
+        gain[~free] = -np.inf
+        j = int(np.argmax(gain))
+        chosen.append(j)
+        free[j] = False
+        np.maximum(max_sim, sim[j], out=max_sim)
+    return chosen
+
+
+def merge_hits_mmr(
+    per_store: List[Tuple[VectorMatrix, List[Tuple[int, float]]]], k: int, lam: float
+) -> List[Tuple[Dict[str, Any], float]]:
+    """
+    merge_hits with MMR diversification over the pooled candidates (lam=1 → plain merge).
+    Relevance is the hit score min-max scaled to 0..1; candidates whose vectors differ in dim
+    (or have none) count as dissimilar.
+    """
+    pooled = [(vm, i, s) for vm, hits in per_store for i, s in hits]
+    pooled.sort(key=lambda x: x[2], reverse=True)
+    if lam >= 1.0 or len(pooled) <= k:
+        return [(vm.records[i], s) for vm, i, s in pooled[:k]]
+    rel = np.asarray([s for _, _, s in pooled], dtype=np.float32)
+    span = float(rel.max() - rel.min())
+    rel = (rel - rel.min()) / span if span > 0 else np.ones_like(rel)
+
+    vecs = [vm.embedding(i) for vm, i, _ in pooled]
+    m = len(pooled)
+    sim = np.zeros((m, m), dtype=np.float32)
+    by_dim: Dict[int, List[int]] = {}
+    for j, v in enumerate(vecs):
+        if v is not None:
+            by_dim.setdefault(v.shape[0], []).append(j)
+    for members in by_dim.values():
+        idx = np.asarray(members, dtype=np.int64)
+        mat = np.stack([vecs[j] for j in members])
+        sim[np.ix_(idx, idx)] = mat @ mat.T
+    chosen = mmr_select(rel, sim, k, max(0.0, float(lam)))
+    return [(pooled[j][0].records[pooled[j][1]], pooled[j][2]) for j in chosen]
+
+
+# ---- on-disk store ----
+def _sbx_read_bytes(sandbox, path: str) -> Optional[bytes]:
+    try:
+        try:
+            blob = sandbox.files.read(path, format="bytes")
+        except TypeError:
+            blob = sandbox.files.read(path)
+    except Exception:
+        return None
+    if isinstance(blob, (bytes, bytearray)):
+        return bytes(blob)
+    return str(blob).encode("utf-8")
+
+
+def _sbx_exists(sandbox, path: str) -> bool:
+    """Existence check without reading the file: files.exists() if offered, else one parent listing."""
+    exists = getattr(sandbox.files, "exists", None)
+    try:
+        if callable(exists):
+            return bool(exists(path))
+        parent, name = os.path.split(path)
+        entries = sandbox.files.list(parent or ".")
+    except Exception:
+        return False
+    return any((e["name"] if isinstance(e, dict) else getattr(e, "name", "")) == name for e in entries)
+
+
+def _sbx_write_bytes(sandbox, path: str, data: bytes) -> None:
+    try:
+        sandbox.files.mkdir(os.path.dirname(path))
+    except Exception:
+        pass
+    sandbox.files.write(path, data)
+
+
+class VectorStore:
+    """
+    Binary vector store shared by MetadataEmbedder (writer) and SearchMetadataChunks (reader).
+    Host loads are zero-copy (np.memmap via np.load(mmap_mode="r")); sandbox loads read the bytes once.
+    """
+    def __init__(self, base_path: str, sandbox=None, dtype: str = "float32"):
+        base = base_path[:-5] if base_path.endswith(".json") else base_path
+        self.base_path = base
+        self.sandbox = sandbox
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = f"{base}.npy"
+        self.records_path = f"{base}.jsonl"
+        self.legacy_path = f"{base}.json"
+        self.ann_path = f"{base}.ivf.npz"
+        self.lexical_path = f"{base}.bm25.npz"
+        self.version_path = f"{base}.version"
+
+    # -------- IO primitives (host or sandbox) --------
+    def _read(self, path: str) -> Optional[bytes]:
+        if self.sandbox:
+            return _sbx_read_bytes(self.sandbox, path)
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except Exception:
+            return None
+
+    def _write(self, path: str, data: bytes) -> None:
+        if self.sandbox:
+            _sbx_write_bytes(self.sandbox, path, data)
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # write-then-rename so readers holding a memmap of the old file are unaffected
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _write_all(self, files: List[Tuple[str, bytes]], remove: Sequence[str] = ()) -> None:
+        """
+        Write several files as one change, the last one (the version marker) last. On the host each
+        file is staged under a temp name before any is renamed into place, so a failed write leaves
+        the previous store whole; the sandbox has no rename and writes them in order.
+        """
+        if self.sandbox:
+            for path, data in files[:-1]:
+                _sbx_write_bytes(self.sandbox, path, data)
+            for path in remove:
+                self._remove(path)
+            _sbx_write_bytes(self.sandbox, *files[-1])
+            return
+        token = uuid.uuid4().hex[:8]
+        staged: List[Tuple[str, str]] = []
+        try:
+            for path, data in files:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                staged.append((f"{path}.{token}.tmp", path))
+                with open(staged[-1][0], "wb") as f:
+                    f.write(data)
+        except BaseException:
+            for tmp, _ in staged:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            raise
+        for tmp, path in staged[:-1]:
+            os.replace(tmp, path)
+        for path in remove:
+            self._remove(path)
+        os.replace(*staged[-1])
+
+    def _remove(self, path: str) -> None:
+        try:
+            if self.sandbox:
+                self.sandbox.files.remove(path)
+            else:
+                os.remove(path)
+        except Exception:
+            pass
+
+    def _exists(self, path: str) -> bool:
+        if self.sandbox:
+            return _sbx_exists(self.sandbox, path)
+        return os.path.exists(path)
+
+    # -------- public API --------
+    def exists(self) -> bool:
+        """True if a binary store exists (converting a legacy JSON store if needed)."""
+        if self._exists(self.records_path):
+            return True
+        return self._exists(self.legacy_path) and self.migrate_legacy()
+
+    def migrate_legacy(self) -> bool:
+        """Convert `<base>.json` (list of records with inline float embeddings) to .npy + .jsonl."""
+        raw = self._read(self.legacy_path)
+        if not raw:
+            return False
+        try:
+            data = json.loads(raw.decode("utf-8"))
+        except Exception:
+            return False
+        if isinstance(data, dict) and "items" in data:
+            data = data["items"]
+        if not isinstance(data, list):
+            return False
+        self.write(data)
+        return True
+
+    def write(self, records: List[Dict[str, Any]]) -> int:
+        """
+        Persist records that carry an `embedding` (list or ndarray).
+        The dominant dim goes into the .npy matrix; odd-dim vectors (legacy placeholders) stay inline.
+        """
+        dims: Dict[int, int] = {}
+        for rec in records:
+            emb = rec.get("embedding")
+            if emb is not None and len(emb):
+                dims[len(emb)] = dims.get(len(emb), 0) + 1
+        dim = max(dims, key=dims.get) if dims else 0
+
+        rows: List[Any] = []
+        row_records: List[Dict[str, Any]] = []
+        lines: List[str] = []
+        for rec in records:
+            emb = rec.get("embedding")
+            meta = {k: v for k, v in rec.items() if k != "embedding"}
+            if emb is not None and len(emb) == dim and dim:
+                meta["row"] = len(rows)
+                rows.append(emb)
+                row_records.append(rec)
+            elif emb is not None and len(emb):
+                meta["embedding"] = [float(x) for x in emb]
+            lines.append(json.dumps(meta, ensure_ascii=False))
+
+        mat = l2_normalize(np.asarray(rows, dtype=np.float32)) if rows else np.zeros((0, dim), dtype=np.float32)
+        buf = io.BytesIO()
+        np.save(buf, mat.astype(self.dtype, copy=False))
+        header = {"_store": {"version": STORE_FORMAT_VERSION, "rows": len(rows), "dim": dim,
+                             "dtype": self.dtype.name, "count": len(records)}}
+        # every payload is built before anything is written
+        files = [
+            (self.vectors_path, buf.getvalue()),
+            (self.records_path, ("\n".join([json.dumps(header)] + lines) + "\n").encode("utf-8")),
+            (self.lexical_path, BM25Index.from_texts(r.get("content", "") for r in records).to_bytes()),
+        ]
+        ann = self._ann_bytes(mat, row_records)
+        if ann is not None:
+            files.append((self.ann_path, ann))
+        # written last: a changed stamp tells cached readers (StoreCache) to reload
+        files.append((self.version_path, uuid.uuid4().hex.encode("ascii")))
+        self._write_all(files, remove=[self.ann_path] if ann is None and self._exists(self.ann_path) else [])
+        return len(records)
+
+    def stamp(self) -> Optional[Tuple[Any, ...]]:
+        """
+        Cheap change marker: (mtime_ns, size) of the store files on the host, the version file
+        in the sandbox. None means unknown (no version file yet), i.e. always reload.
+        """
+        if self.sandbox:
+            raw = self._read(self.version_path)
+            return ("v", raw) if raw else None
+        out: List[Any] = []
+        for path in (self.records_path, self.vectors_path, self.lexical_path, self.ann_path, self.legacy_path):
+            try:
+                st = os.stat(path)
+                out.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                out.append(None)
+        return tuple(out)
+
+    # -------- ANN index --------
+    def _ann_bytes(self, mat: np.ndarray, row_records: List[Dict[str, Any]]) -> Optional[bytes]:
+        """
+        <base>.ivf.npz in step with the matrix (incremental when an index already exists);
+        None means the store should have no index.
+        """
+        if mat.shape[0] < ANN_MIN_ROWS:
+            return None
+        try:
+            return build_or_update(self.load_ann(), mat, row_records).to_bytes()
+        except Exception as e:
+            warnings.warn(f"IVF index for {self.base_path} not written ({e}); searches fall back to exact scans",
+                          RuntimeWarning, stacklevel=2)
+            return None
+
+    def load_ann(self, mat: Optional[np.ndarray] = None) -> Optional[IVFIndex]:
+        """The persisted IVF index, or None; with `mat`, only if it matches that matrix."""
+        raw = self._read(self.ann_path)
+        idx = IVFIndex.from_bytes(raw) if raw else None
+        if idx is not None and mat is not None and (len(idx) != mat.shape[0] or idx.dim != mat.shape[1]):
+            return None
+        return idx
+
+    def load_lexical(self, n_records: int) -> Optional[BM25Index]:
+        """The persisted BM25 index if it covers exactly `n_records` records (else it is rebuilt lazily)."""
+        raw = self._read(self.lexical_path)
+        idx = BM25Index.from_bytes(raw) if raw else None
+        return idx if idx is not None and len(idx) == n_records else None
+
+    def build_ann(self, force: bool = False) -> Optional[IVFIndex]:
+        """(Re)build the index from the stored matrix, regardless of ANN_MIN_ROWS."""
+        mat = self.load_matrix()
+        if mat.ndim != 2 or mat.shape[0] == 0:
+            return None
+        prev = None if force else self.load_ann(mat)
+        row_records: List[Dict[str, Any]] = [{} for _ in range(mat.shape[0])]
+        for rec in self.load_records():
+            row = rec.get("row")
+            if isinstance(row, int) and 0 <= row < mat.shape[0]:
+                row_records[row] = rec
+        idx = build_or_update(prev, mat, row_records)
+        self._write(self.ann_path, idx.to_bytes())
+        return idx
+
+    def load_records(self) -> List[Dict[str, Any]]:
+        raw = self._read(self.records_path)
+        if not raw:
+            return []
+        out: List[Dict[str, Any]] = []
+        for line in raw.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+            if "_store" in rec:
+                continue
+            out.append(rec)
+        return out
+
+    def load_matrix(self) -> np.ndarray:
+        if not self.sandbox and os.path.exists(self.vectors_path):
+            try:
+                return np.load(self.vectors_path, mmap_mode="r")
+            except Exception:
+                return np.zeros((0, 0), dtype=np.float32)
+        raw = self._read(self.vectors_path)
+        if not raw:
+            return np.zeros((0, 0), dtype=np.float32)
+        try:
+            return np.load(io.BytesIO(raw))
+        except Exception:
+            return np.zeros((0, 0), dtype=np.float32)
+
+    def load(self, fallback_embed: Optional[Callable[[str], List[float]]] = None) -> VectorMatrix:
+        """Load the store as a VectorMatrix (converting a legacy JSON store on first use)."""
+        if not self.exists():
+            return VectorMatrix([], [])
+        records = self.load_records()
+        mat = self.load_matrix()
+        n = mat.shape[0] if mat.ndim == 2 else 0
+
+        main_ids: List[int] = []
+        main_rows: List[int] = []
+        extra: List[Dict[str, Any]] = []
+        extra_ids: List[int] = []
+        for i, rec in enumerate(records):
+            row = rec.pop("row", None)
+            if isinstance(row, int) and 0 <= row < n:
+                main_ids.append(i)
+                main_rows.append(row)
+            else:
+                extra.append(rec)
+                extra_ids.append(i)
+
+        groups: List[Tuple[np.ndarray, np.ndarray]] = []
+        ann: Optional[IVFIndex] = None
+        if main_ids:
+            rows_arr = np.asarray(main_rows, dtype=np.int64)
+            # rows are written in record order, so this is normally the memmap itself
+            contiguous = rows_arr[0] == 0 and rows_arr[-1] == len(rows_arr) - 1 and len(rows_arr) == n
+            groups.append((np.asarray(main_ids, dtype=np.int64), mat if contiguous else mat[rows_arr]))
+            if contiguous:
+                ann = self.load_ann(mat)
+        if extra:
+            sub = VectorMatrix.from_records(extra, fallback_embed=fallback_embed)
+            ids_map = np.asarray(extra_ids, dtype=np.int64)
+            groups.extend((ids_map[ids], m) for ids, m in sub.groups)
+            for rec in extra:
+                rec.pop("embedding", None)
+        return VectorMatrix(records, groups, ann=ann, lexical=self.load_lexical(len(records)))
+
+
+class StoreCache:
+    """
+    Process-wide cache of loaded VectorMatrix objects, keyed by (sandbox, base path).
+    Each get() compares the store's stamp() with the one it was loaded under and reloads
+    only stores that changed; records without an embedding go through fallback_embed
+    once per load, not once per query. At most `max_stores` stores stay loaded; the least
+    recently used one is evicted (its memmap is released with it).
+    """
+    def __init__(self, max_stores: int = STORE_CACHE_MAX):
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[Any, VectorMatrix]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_stores = max(1, int(max_stores))
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, base_path: str, sandbox=None,
+            fallback_embed: Optional[Callable[[str], List[float]]] = None) -> VectorMatrix:
+        store = VectorStore(base_path, sandbox=sandbox)
+        key = (id(sandbox) if sandbox is not None else 0, store.base_path)
+        stamp = store.stamp()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and stamp is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        vm = store.load(fallback_embed=fallback_embed)
+        if stamp is None:
+            stamp = store.stamp()  # a legacy store converted by load() now has a version
+        with self._lock:
+            self._entries[key] = (stamp, vm)
+            self._entries.move_to_end(key)
+            self.loads += 1
+            while len(self._entries) > self.max_stores:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return vm
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"loaded": len(self._entries), "max": self.max_stores, "loads": self.loads,
+                    "hits": self.hits, "evictions": self.evictions}
+
+    def invalidate(self, base_path: Optional[str] = None) -> None:
+        with self._lock:
+            if base_path is None:
+                self._entries.clear()
+                return
+            base = base_path[:-5] if base_path.endswith(".json") else base_path
+            for key in [k for k in self._entries if k[1] == base]:
+                del self._entries[key]
+
+
+_STORE_CACHE = StoreCache()
+
+
+def get_store_cache() -> StoreCache:
+    return _STORE_CACHE
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+# stores and shards are resolved relative to the working directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeSandboxFiles:
+    """In-memory stand-in for the sandbox filesystem (no append), recording reads and writes."""
+    def __init__(self):
+        self.data = {}
+        self.reads = []
+        self.writes = []
+
+    def read(self, path, format=None):
+        self.reads.append(path)
+        if path not in self.data:
+            raise FileNotFoundError(path)
+        return self.data[path]
+
+    def write(self, path, data):
+        self.writes.append(path)
+        self.data[path] = bytes(data)
+
+    def mkdir(self, path):
+        pass
+
+    def list(self, path):
+        prefix = path.rstrip("/") + "/"
+        names = set()
+        for p in self.data:
+            if p.startswith(prefix):
+                head, _, rest = p[len(prefix):].partition("/")
+                names.add((head, bool(rest)))
+        if not names:
+            raise FileNotFoundError(path)
+        return [{"name": n, "is_dir": d} for n, d in sorted(names)]
+
+    def remove(self, path):
+        for p in [p for p in self.data if p == path or p.startswith(path.rstrip("/") + "/")]:
+            del self.data[p]
+
+
+class FakeSandbox:
+    def __init__(self):
+        self.files = FakeSandboxFiles()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Fresh cwd with the offline hashing embedder and empty process-wide caches."""
+    from src.utils.vector_store import get_store_cache
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("EMBED_BACKEND", "hashing")
+    monkeypatch.setenv("HASH_EMBED_DIM", "64")
+    get_store_cache().invalidate()
+    yield tmp_path
+    get_store_cache().invalidate()
+
+
+@pytest.fixture
+def fake_sandbox(workdir):
+    return FakeSandbox()
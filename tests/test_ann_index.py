@@ -0,0 +1,40 @@
+import numpy as np
+
+from src.utils.ann_index import IVFIndex, build_or_update
+from src.utils.vector_store import l2_normalize
+
+
+def _clustered(n, dim=32, centers=16, seed=0):
+    rng = np.random.default_rng(seed)
+    c = rng.normal(size=(centers, dim))
+    return l2_normalize((c[rng.integers(0, centers, n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32))
+
+
+def _records(n, start=0):
+    return [{"source": "s.md", "chunk_index": i, "content": f"chunk {i}"} for i in range(start, start + n)]
+
+
+def test_ivf_recall_and_exact_probe():
+    mat = _clustered(2000)
+    idx = build_or_update(None, mat, _records(2000))
+    assert idx.nlist == int(np.sqrt(2000))
+    assert idx.recall_at_k(mat, k=10, n_queries=50) >= 0.9
+    # probing every list is an exact scan
+    q = mat[7]
+    rows, scores = idx.search(mat, q, 5, nprobe=idx.nlist)
+    assert rows[0] == 7 and np.all(np.diff(scores) <= 0)
+
+
+def test_ivf_update_keeps_known_rows_and_round_trips():
+    mat = _clustered(1000)
+    idx = build_or_update(None, mat, _records(1000))
+    grown = np.vstack([mat, _clustered(200, seed=1)])
+    upd = build_or_update(idx, grown, _records(1200))
+    assert np.array_equal(upd.centroids, idx.centroids)  # no retrain below RETRAIN_GROWTH
+    assert np.array_equal(upd.assign[:1000], idx.assign)
+    loaded = IVFIndex.from_bytes(upd.to_bytes())
+    assert np.array_equal(loaded.assign, upd.assign) and loaded.trained_rows == 1000
+    mask = np.zeros(1200, dtype=bool)
+    mask[1000:] = True
+    rows, _ = loaded.search(grown, grown[1100], 3, nprobe=loaded.nlist, row_mask=mask)
+    assert rows[0] == 1100 and np.all(rows >= 1000)
@@ -0,0 +1,73 @@
+import re
+
+from src.utils.chunker import approx_tokens, chunk_text
+from src.utils.metadata_embedder import MetadataEmbedder, _read_and_chunk, _SpilledChunks
+
+
+def _words(text):
+    return re.findall(r"\S+", text)
+
+
+def _covered(text, chunks):
+    """Every word of `text` appears, in order, in the chunk stream (overlap may repeat some)."""
+    stream = [w for c in chunks for w in _words(c)]
+    pos = 0
+    for w in _words(text):
+        try:
+            pos = stream.index(w, pos) + 1
+        except ValueError:
+            return False
+    return True
+
+
+TRANSCRIPT = "\n".join(
+    ["Therapist: How was your week?", "Client: Ok.", "T3 Anything else?", "C3 No."]
+    + [f"Client: I keep thinking about sentence number {i} and what it means for me." for i in range(60)]
+)
+
+
+def test_chunker_drops_no_text():
+    paragraphs = "\n\n".join(["Hi."] + [f"Paragraph {i}. " + "word " * (i * 7 % 90) for i in range(40)]
+                             + ["x " * 500, "End."])
+    for text, turns in ((paragraphs, False), (TRANSCRIPT, True)):
+        chunks = chunk_text(text, max_tokens=60, overlap_tokens=10, turns=turns)
+        assert _covered(text, chunks)
+        assert all(approx_tokens(c) <= 60 for c in chunks)
+
+
+def test_short_final_chunk_is_folded_without_repeating_the_overlap():
+    para = " ".join(f"w{i}" for i in range(1, 44))
+    text = "\n\n".join([para, "Ok.", "Ok.", "Yes fine now."])
+    chunks = chunk_text(text, max_tokens=45, overlap_tokens=10)
+    assert all(approx_tokens(c) <= 45 for c in chunks)
+    assert _covered(text, chunks)
+    assert sum(c.count("Yes fine now.") for c in chunks) == 1
+    # the short tail keeps the previous chunk's overlap as its context
+    assert chunks[-1].startswith("Ok.") and chunks[-1].endswith("Yes fine now.")
+
+
+def test_short_turns_are_kept(tmp_path):
+    f = tmp_path / "session.txt"
+    f.write_text("Therapist: Hi.\nClient: Ok.\n")
+    sha, chunks, err = _read_and_chunk(str(f), turns=True)
+    assert err is None and list(chunks) == ["Therapist: Hi.\nClient: Ok."]
+
+
+def test_large_files_spill_chunks(tmp_path):
+    f = tmp_path / "session.txt"
+    f.write_text(TRANSCRIPT)
+    small = _read_and_chunk(str(f), turns=True, max_tokens=40)
+    big = _read_and_chunk(str(f), turns=True, max_tokens=40, spill_bytes=16)
+    assert isinstance(big[1], _SpilledChunks) and big[0] == small[0]
+    assert list(big[1]) == small[1]
+    assert not (tmp_path / big[1].path).exists()
+
+
+def test_ingestion_keeps_short_chunks(workdir):
+    d = workdir / "psych_metadata"
+    d.mkdir()
+    (d / "tiny.md").write_text("Denial.\n")
+    emb = MetadataEmbedder()
+    emb.embed_metadata_dirs([str(d)], fit_idf=False)
+    assert [r["content"] for r in emb.metadata_store] == ["Denial."]
+
@@ -0,0 +1,51 @@
+import sqlite3
+
+from src.utils.db_schema import SCHEMA_VERSION, current_version, migrate
+from src.utils.sqlite_helpers import bulk_insert_qa, close_all_sqlite
+
+
+def _legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE qa_pairs (id INTEGER PRIMARY KEY AUTOINCREMENT, patient_id TEXT, session_type TEXT,
+                               session_date TEXT, q TEXT, a TEXT, source TEXT)
+    """)
+    conn.executemany("INSERT INTO qa_pairs (patient_id, session_type, session_date, q, a, source) VALUES (?,?,?,?,?,?)",
+                     [("p1", "intake", "2025-01-01", "how are you?", "tired", "chat"),
+                      (None, None, None, "orphan q", "orphan a", "chat")])
+    conn.commit()
+    conn.close()
+
+
+def test_migrate_unifies_legacy_qa_pairs(tmp_path):
+    db = str(tmp_path / "therapy.db")
+    _legacy_db(db)
+    conn = sqlite3.connect(db, isolation_level=None)
+    assert migrate(conn) == list(range(1, SCHEMA_VERSION + 1))
+    rows = conn.execute("SELECT patient_id, session_type, session_date, turn_id, text_raw, text_clean "
+                        "FROM qa_pairs ORDER BY turn_id").fetchall()
+    assert rows == [("p1", "intake", "2025-01-01", 1, "how are you?", "tired"),
+                    ("unknown", "unknown", "unknown", 2, "orphan q", "orphan a")]
+    # the original table is kept, and a second run is a no-op
+    assert conn.execute("SELECT COUNT(*) FROM qa_pairs_legacy").fetchone()[0] == 2
+    assert migrate(conn) == [] and current_version(conn) == SCHEMA_VERSION
+    indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_qa_pairs_speaker", "idx_graph_events_kind"} <= indexes
+    conn.close()
+
+
+def test_bulk_insert_qa_accepts_turn_and_legacy_rows(tmp_path):
+    db = str(tmp_path / "therapy.db")
+    try:
+        turns = [{"patient_id": "p1", "session_type": "intake", "session_date": "2025-01-01", "turn_id": t,
+                  "speaker": "patient", "text_raw": f"raw {t}", "text_clean": f"clean {t}"} for t in (1, 2)]
+        assert bulk_insert_qa(db, iter(turns)) == 2
+        legacy = [{"patient_id": "p1", "session_type": "intake", "session_date": "2025-01-01",
+                   "q": "q3", "a": "a3", "source": "chat"}]
+        assert bulk_insert_qa(db, legacy) == 1
+        assert bulk_insert_qa(db, []) == 0
+    finally:
+        close_all_sqlite()
+    with sqlite3.connect(db) as conn:
+        rows = conn.execute("SELECT turn_id, text_raw, text_clean FROM qa_pairs ORDER BY turn_id").fetchall()
+    assert rows == [(1, "raw 1", "clean 1"), (2, "raw 2", "clean 2"), (3, "q3", "a3")]
@@ -0,0 +1,211 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.utils.embeddings import (HASH_IDF_PATH, BaseEmbedder, CachedEmbedder, HashingEmbedder, _QueryMemo, _registry_key,
+                                  get_embedder_from_env, get_shared_embedder)
+from src.utils.metadata_embedder import MetadataEmbedder
+
+
+def test_hashing_batch_matches_single():
+    emb = HashingEmbedder(dim=256)
+    texts = ["hello world", "a", "", "foo", "bb", "Therapist: how was the week?", "x y"]
+    batched = emb.embed_matrix(texts)
+    for i, t in enumerate(texts):
+        np.testing.assert_allclose(batched[i], emb.embed_matrix([t])[0], atol=1e-6)
+
+
+def test_hashing_fit_is_streamed_and_changes_name():
+    emb = HashingEmbedder(dim=64)
+    plain = emb.name
+    emb.fit(iter(["anxious about work", "anxious about sleep", "calm weekend"]), batch_size=2)
+    assert emb.idf is not None and emb.idf.shape == (64,)
+    assert emb.name != plain
+    assert HashingEmbedder(dim=64).fit([]).idf is None
+
+
+def test_ingestion_fits_and_saves_idf(workdir):
+    d = workdir / "psych_metadata"
+    d.mkdir()
+    (d / "distortions.md").write_text("Catastrophizing\n\nExpecting the worst outcome.\n\nMind reading\n")
+    emb = HashingEmbedder(dim=64)
+    me = MetadataEmbedder(embedder=emb)
+    result = me.embed_metadata_dirs([str(d)], verbose=False)
+    assert result.startswith("Successfully"), result
+    # the IDF is fitted into a new embedder; the one passed in (possibly shared) is untouched
+    assert emb.idf is None and emb.name == "hashing:64"
+    assert me.embedder is not emb and me.embedder.idf is not None
+    np.testing.assert_array_equal(np.load(HASH_IDF_PATH), me.embedder.idf)
+
+
+def test_shared_embedder_follows_the_idf_file(workdir):
+    plain = get_shared_embedder()
+    assert get_shared_embedder() is plain and plain.idf is None
+    HashingEmbedder(dim=64).fit(["anxious about work", "calm weekend"]).save_idf(HASH_IDF_PATH)
+    fitted = get_shared_embedder()
+    assert fitted is not plain and fitted.idf is not None and plain.idf is None
+    assert get_shared_embedder() is fitted
+    HashingEmbedder(dim=64).fit(["poor sleep", "racing thoughts", "deadline"]).save_idf(HASH_IDF_PATH)
+    os.utime(HASH_IDF_PATH, ns=(0, 0))  # same size as before: the mtime alone marks the new file
+    assert get_shared_embedder() is not fitted
+
+
+def test_notes_embedded_before_the_idf_fit_are_reembedded(workdir):
+    d = workdir / "psych_metadata"
+    d.mkdir()
+    (d / "distortions.md").write_text("Catastrophizing\n\nExpecting the worst outcome.\n")
+    me = MetadataEmbedder(embedder=HashingEmbedder(dim=64))
+    me.index_agent_note(1, "sleep", "patient reports poor sleep before deadlines")
+    me.notes_log.compact()
+    me.index_agent_note(2, "work", "worried about the performance review at work")
+    me.embed_metadata_dirs([str(d)], verbose=False)
+    notes = me.notes_log.store.load()
+    assert len(notes) == 2
+    assert {r["embedding_model"] for r in notes.records} == {me.embedder.name}
+    expected = me.embedder.embed_matrix([r["content"] for r in notes.records])
+    vecs = notes.vectors()
+    np.testing.assert_allclose([vecs[i] for i in range(2)], expected, atol=1e-6)
+    me.close()
+
+
+class _Resp:
+    def __init__(self, status, data=None, text=""):
+        self.status_code, self._data, self.text = status, data or {}, text
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+class _OldOllama:
+    """Pre-0.3 Ollama: /api/embed is missing, /api/embeddings answers one prompt at a time."""
+    def __init__(self):
+        self.single_calls = 0
+
+    def post(self, url, json, timeout):
+        if url.endswith("/api/embed"):
+            return _Resp(404, text="404 page not found")
+        self.single_calls += 1
+        return _Resp(200, {"embedding": [float(len(json["prompt"])), 1.0]})
+
+
+def test_ollama_falls_back_when_batch_endpoint_missing():
+    from src.utils.embeddings import OllamaEmbedder
+
+    emb = OllamaEmbedder()
+    emb.session = _OldOllama()
+    assert emb.batch_embed(["a", "bbb"]) == [[1.0, 1.0], [3.0, 1.0]]
+    assert emb._batch_supported is False and emb.session.single_calls == 2
+
+
+class _PullingOllama(_OldOllama):
+    """Current Ollama whose model is not pulled yet: /api/embed answers 404 model-not-found."""
+    def post(self, url, json, timeout):
+        if url.endswith("/api/embed"):
+            return _Resp(404, text='{"error":"model \\"nomic-embed-text\\" not found, try pulling it first"}')
+        return super().post(url, json, timeout)
+
+
+def test_ollama_model_not_found_keeps_batching():
+    from src.utils.embeddings import OllamaEmbedder
+
+    emb = OllamaEmbedder()
+    emb.session = _PullingOllama()
+    with pytest.raises(RuntimeError, match="not found"):
+        emb.batch_embed(["a", "bbb"])
+    assert emb._batch_supported is None and emb.session.single_calls == 0
+
+
+def test_mismatched_idf_file_warns_and_is_ignored(workdir):
+    os.makedirs(os.path.dirname(HASH_IDF_PATH), exist_ok=True)
+    np.save(HASH_IDF_PATH, np.ones(32, dtype=np.float32))  # HASH_EMBED_DIM is 64
+    with pytest.warns(RuntimeWarning, match="ignoring hashing IDF"):
+        emb = get_embedder_from_env()
+    assert emb.idf is None
+
+
+def test_registry_key_tracks_the_config(workdir, monkeypatch):
+    key = _registry_key(cache=True)
+    assert _registry_key(cache=True) == key
+    shared = get_shared_embedder()
+    assert get_shared_embedder() is shared
+    monkeypatch.setenv("HASH_EMBED_DIM", "32")
+    assert _registry_key(cache=True) != key
+    other = get_shared_embedder()
+    assert other is not shared and other.dim == 32
+    before_idf = _registry_key(cache=True)
+    HashingEmbedder(dim=32).fit(["anxious about work", "calm weekend"]).save_idf(HASH_IDF_PATH)
+    assert _registry_key(cache=True) != before_idf
+    assert get_shared_embedder() is not other and get_shared_embedder().idf is not None
+    os.remove(HASH_IDF_PATH)
+    monkeypatch.setenv("HASH_EMBED_DIM", "64")
+    assert get_shared_embedder() is shared
+
+
+class _CountingEmbedder(BaseEmbedder):
+    def __init__(self, name="counting", dim=2):
+        self.name, self.dim, self.calls = name, dim, []
+
+    def embed(self, text):
+        return self.batch_embed([text])[0]
+
+    def batch_embed(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t))] + [1.0] * (self.dim - 1) for t in texts]
+
+
+def test_query_memo_hits_skip_the_embedder():
+    memo, emb = _QueryMemo(size=2), _CountingEmbedder()
+    assert memo.get(emb, "sleep") == memo.get(emb, "sleep") == [5.0, 1.0]
+    assert emb.calls == [["sleep"]]
+    # only misses are batched, once per distinct text
+    assert memo.get_many(emb, ["sleep", "work", "work"]) == [[5.0, 1.0], [4.0, 1.0], [4.0, 1.0]]
+    assert emb.calls[-1] == ["work"]
+    memo.get(emb, "mood")  # evicts "sleep", the least recently used
+    memo.get(emb, "sleep")
+    assert emb.calls[-1] == ["sleep"] and len(emb.calls) == 4
+    # vectors are memoised per embedder name
+    other = _CountingEmbedder(name="other")
+    memo.get(other, "sleep")
+    assert other.calls == [["sleep"]]
+
+
+def test_cached_embedder_hits_sqlite_across_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    inner = _CountingEmbedder()
+    first = CachedEmbedder(inner, path=path)
+    vecs = first.batch_embed(["sleep", "work", "sleep"])
+    assert inner.calls == [["sleep", "work"]] and first.stats()["misses"] == 2
+    second = CachedEmbedder(inner, path=path)
+    assert second.batch_embed(["work", "sleep"]) == [vecs[1], vecs[0]]
+    assert len(inner.calls) == 1 and second.disk_hits == 2
+    second.embed("work")  # now served from memory
+    assert second.disk_hits == 2 and second.hits == 3
+
+
+def test_cached_embedder_evicts_least_recently_used(tmp_path):
+    inner = _CountingEmbedder()
+    # each vector is 2 float32 = 8 bytes: room for four rows, trimmed to 90%
+    cache = CachedEmbedder(inner, path=str(tmp_path / "cache.sqlite"), max_bytes=32, lru_size=2)
+    for text in ("a", "bb", "ccc", "dddd"):
+        cache.embed(text)
+    assert len(cache._lru) == 2 and cache.evictions == 0
+    cache.embed("eeeee")
+    assert cache.evictions == 2 and cache.stats()["disk_bytes"] <= 32 * 0.9
+    kept = {k for (k,) in cache._conn.execute("SELECT key FROM embed_cache")}
+    assert kept == {CachedEmbedder._key(t) for t in ("ccc", "dddd", "eeeee")}
+
+
+def test_cached_embedder_key_includes_name_and_dim(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    CachedEmbedder(_CountingEmbedder(), path=path).embed("sleep")
+    renamed = _CountingEmbedder(name="counting-v2")
+    CachedEmbedder(renamed, path=path).embed("sleep")
+    resized = _CountingEmbedder(dim=3)
+    assert CachedEmbedder(resized, path=path).embed("sleep") == [5.0, 1.0, 1.0]
+    assert renamed.calls == resized.calls == [["sleep"]]
+
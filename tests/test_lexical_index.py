@@ -0,0 +1,40 @@
+import numpy as np
+
+from src.utils.lexical_index import BM25Index, rank_scores, rrf_fuse
+
+
+TEXTS = [
+    "EriksonStage trust vs mistrust in early sessions",
+    "patient reported catastrophizing about a work deadline",
+    "sleep problems and anxiety before the deadline",
+    "no distortions noted this week",
+]
+
+
+def test_bm25_ranks_exact_terms_first():
+    idx = BM25Index.from_texts(TEXTS)
+    hits = idx.search("catastrophizing deadline", 3)
+    assert hits[0][0] == 1
+    assert {doc for doc, _ in hits} == {1, 2}
+    assert idx.search("EriksonStage", 2)[0][0] == 0
+
+
+def test_bm25_mask_and_round_trip():
+    idx = BM25Index.from_texts(TEXTS)
+    mask = np.array([True, False, True, True])
+    assert [doc for doc, _ in idx.search("deadline", 4, mask=mask)] == [2]
+    loaded = BM25Index.from_bytes(idx.to_bytes())
+    assert loaded.search("catastrophizing deadline", 3) == idx.search("catastrophizing deadline", 3)
+
+
+def test_rank_scores_are_store_independent():
+    # a short store inflates raw BM25; rank scores only keep the order
+    small = BM25Index.from_texts(["deadline"]).search("deadline", 1)
+    large = BM25Index.from_texts(TEXTS).search("deadline", 1)
+    assert small[0][1] != large[0][1]
+    assert [s for _, s in rank_scores(small)] == [s for _, s in rank_scores(large)] == [1.0 / 61]
+
+
+def test_rrf_fuse_rewards_agreement():
+    fused = rrf_fuse([[1, 2, 3], [3, 1, 4]], k=2)
+    assert [doc for doc, _ in fused] == [1, 3]
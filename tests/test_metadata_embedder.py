@@ -0,0 +1,151 @@
+import json
+import threading
+
+from src.utils.embeddings import HashingEmbedder
+from src.utils.metadata_embedder import MetadataEmbedder, get_indexing_status
+from src.utils.shards import CORPUS_SHARD, shard_base
+from src.utils.vector_store import VectorStore
+
+
+class _CountingHasher(HashingEmbedder):
+    def __init__(self):
+        super().__init__(dim=64)
+        self.texts = []
+
+    def batch_embed(self, texts):
+        self.texts.extend(texts)
+        return super().batch_embed(texts)
+
+
+def test_parallel_ingestion_matches_serial(workdir):
+    d = workdir / "psych_metadata"
+    d.mkdir()
+    for i in range(10):
+        (d / f"f{i}.md").write_text(f"# Topic {i}\n\n" + "\n\n".join(f"Point {i}.{j} about coping." for j in range(5)))
+    serial, parallel = MetadataEmbedder(), MetadataEmbedder()
+    serial.embed_metadata_dirs([str(d)], fit_idf=False, workers=1)
+    (workdir / "embeddings" / "metadata_index.json").unlink()
+    parallel.metadata_store = []
+    parallel.embed_metadata_dirs([str(d)], fit_idf=False, workers=2, refresh=True)
+    key = lambda r: (r["source"], r["chunk_index"])
+    assert [(key(r), r["content"]) for r in sorted(serial.metadata_store, key=key)] == \
+           [(key(r), r["content"]) for r in sorted(parallel.metadata_store, key=key)]
+
+
+def test_manifest_only_reembeds_changed_files(workdir):
+    d = workdir / "psych_metadata"
+    d.mkdir()
+    (d / "a.md").write_text("Catastrophizing\n\nExpecting the worst outcome.")
+    (d / "b.md").write_text("Mind reading\n\nAssuming what others think.")
+    (d / "c.md").write_text("Labeling\n\nA fixed global label for oneself.")
+    (d / "empty.md").write_text("\n\n")
+    emb = _CountingHasher()
+    me = MetadataEmbedder(embedder=emb)
+    assert me.embed_metadata_dirs([str(d)], fit_idf=False).startswith("Successfully")
+    manifest = json.loads((workdir / "embeddings" / "metadata_index.json").read_text())["files"]
+    assert manifest["psych_metadata/empty.md"]["chunks"] == []
+
+    emb.texts.clear()
+    assert me.embed_metadata_dirs([str(d)], fit_idf=False).startswith("Metadata embeddings up to date")
+    assert emb.texts == []
+
+    (d / "b.md").write_text("Mind reading\n\nAssuming you know what others think of you.")
+    me.embed_metadata_dirs([str(d)], fit_idf=False)
+    assert emb.texts and all("Mind reading" in t or "others think" in t for t in emb.texts)
+
+    (d / "c.md").unlink()
+    emb.texts.clear()
+    me.embed_metadata_dirs([str(d)], fit_idf=False)
+    assert emb.texts == []
+    fresh = MetadataEmbedder(embedder=emb)
+    fresh._load_existing_metadata()
+    assert {r["source"] for r in fresh.metadata_store} == {"psych_metadata/a.md", "psych_metadata/b.md"}
+    manifest = json.loads((workdir / "embeddings" / "metadata_index.json").read_text())["files"]
+    assert set(manifest) == {"psych_metadata/a.md", "psych_metadata/b.md", "psych_metadata/empty.md"}
+
+
+class _GatedHasher(HashingEmbedder):
+    """Blocks every batch until `gate` is set; raises `error` instead if one is given."""
+    def __init__(self, error=None):
+        super().__init__(dim=64)
+        self.gate, self.error = threading.Event(), error
+
+    def batch_embed(self, texts):
+        self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return super().batch_embed(texts)
+
+
+def _two_files(workdir):
+    d = workdir / "psych_metadata"
+    d.mkdir()
+    (d / "a.md").write_text("Catastrophizing\n\nExpecting the worst outcome.")
+    (d / "b.md").write_text("Mind reading\n\nAssuming what others think.")
+    return [str(d)]
+
+
+def test_background_embedding_reports_progress_then_ready(workdir):
+    emb = _GatedHasher()
+    me = MetadataEmbedder(embedder=emb)
+    status = get_indexing_status()
+    me.start_background_embedding(_two_files(workdir), fit_idf=False)
+    assert status.running and not status.wait(0.05)
+    emb.gate.set()
+    assert status.wait(5)
+    snap = status.snapshot()
+    assert snap["state"] == "ready" and snap["message"].startswith("Successfully")
+    assert snap["files_read"] == snap["files_total"] == 2
+    assert snap["chunks_embedded"] == snap["chunks_queued"] == len(me.metadata_store) > 0
+    me.close()
+
+
+def test_background_embedding_failure_is_reported(workdir, monkeypatch):
+    emb = _GatedHasher(error=RuntimeError("backend down"))
+    emb.gate.set()
+    me = MetadataEmbedder(embedder=emb)
+    status = get_indexing_status()
+    me.start_background_embedding(_two_files(workdir), fit_idf=False)
+    assert status.wait(5)
+    assert status.state == "failed" and "backend down" in status.message
+    assert "backend down" in status.info()
+    me.close()
+
+    # an exception escaping embed_metadata_dirs itself is reported the same way
+    def boom(*args, **kwargs):
+        raise ValueError("bad manifest")
+    monkeypatch.setattr(me, "embed_metadata_dirs", boom)
+    me.start_background_embedding([])
+    assert status.wait(5) and status.state == "failed" and status.message == "bad manifest"
+    me.close()
+
+
+def test_corpus_run_loads_only_its_own_shard(workdir, monkeypatch):
+    corpus = workdir / "patient_raw_data"
+    corpus.mkdir()
+    (corpus / "s.txt").write_text("Therapist: How was the week?\nPatient: Work was hard.\n")
+    for pid in ("p1", "p2"):
+        MetadataEmbedder().embed_metadata_dirs([str(corpus)], include_corpus=True, fit_idf=False,
+                                               patient_id=pid, session_date="2025-01-01")
+    p2 = shard_base(CORPUS_SHARD, "p2", "2025-01-01")
+    before = len(VectorStore(p2).load())
+
+    loaded = []
+    real_load = VectorStore.load
+
+    def tracking_load(self, *args, **kwargs):
+        loaded.append(self.base_path)
+        return real_load(self, *args, **kwargs)
+
+    (corpus / "s.txt").write_text("Therapist: How was the week?\nPatient: Sleep was better.\n")
+    me = MetadataEmbedder()
+    with monkeypatch.context() as m:
+        m.setattr(VectorStore, "load", tracking_load)
+        me.embed_metadata_dirs([str(corpus)], include_corpus=True, fit_idf=False,
+                               patient_id="p1", session_date="2025-01-01")
+    assert p2 not in loaded and shard_base(CORPUS_SHARD, "p1", "2025-01-01") in loaded
+    assert {r["patient_id"] for r in me.metadata_store} == {"p1"}
+    assert len(VectorStore(p2).load()) == before
+    p1 = VectorStore(shard_base(CORPUS_SHARD, "p1", "2025-01-01")).load()
+    assert any("Sleep was better" in r["content"] for r in p1.records)
+
@@ -0,0 +1,30 @@
+import numpy as np
+
+from src.utils.near_dup import NUM_PERM, NearDupIndex, minhash, shingles
+
+BASE = ("patient described waking at four every morning with racing thoughts about the "
+        "quarterly review and a sense that one mistake will cost them the job")
+
+
+def _jaccard(a, b):
+    sa, sb = set(shingles(a).tolist()), set(shingles(b).tolist())
+    return len(sa & sb) / len(sa | sb)
+
+
+def test_minhash_estimates_jaccard():
+    other = BASE.replace("quarterly review", "annual appraisal")
+    est = float((minhash(BASE) == minhash(other)).mean())
+    assert abs(est - _jaccard(BASE, other)) < 0.2
+    assert minhash("") is None and minhash(BASE).shape == (NUM_PERM,)
+    np.testing.assert_array_equal(minhash(BASE), minhash(BASE.upper()))
+
+
+def test_index_finds_reworded_notes_only():
+    idx = NearDupIndex()
+    idx.add("n1", BASE)
+    idx.add("n2", "discussed her relationship with her sister and the upcoming wedding plans")
+    hit = idx.query(BASE + " again tonight")
+    assert hit is not None and hit[0] == "n1" and hit[1] >= idx.threshold
+    assert idx.query("talked about the weekend hike and feeling calmer outdoors") is None
+    idx.add("n1", "ignored: the key is already indexed")
+    assert len(idx) == 2
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from src.utils.notes_store import NotesLog, NotesLogReader
+
+
+def _note(i, text=None):
+    return {"chunk_id": i, "title": f"t{i}", "notes": text or f"note number {i} about sleep",
+            "embedding": [float(i), 1.0, 0.0, 0.0]}
+
+
+@pytest.fixture(params=["host", "sandbox"])
+def sandbox(request, workdir):
+    return request.getfixturevalue("fake_sandbox") if request.param == "sandbox" else None
+
+
+def test_reader_sees_appends_then_compacted_store(sandbox):
+    log = NotesLog("embeddings/notes", sandbox=sandbox, compact_every=10_000)
+    reader = NotesLogReader("embeddings/notes", sandbox=sandbox)
+    ids = [log.append(_note(i)) for i in range(3)]
+    log.merge(ids[0], chunk_id=9, created_at="2025-01-01")
+    base, tail = reader.read()
+    assert len(base) == 0 and len(tail) == 3
+    assert tail.records[0]["dup_count"] == 2 and tail.records[0]["dup_chunks"] == [9]
+
+    log.append(_note(3))
+    assert len(reader.read()[1]) == 4  # only the new line is parsed
+
+    assert log.compact() == 4
+    base, tail = reader.read()
+    assert len(base) == 4 and len(tail) == 0
+    assert {r["note_id"] for r in base.records} >= set(ids)
+    assert next(r for r in base.records if r["note_id"] == ids[0])["dup_count"] == 2
+
+
+def test_sandbox_append_writes_one_small_file_per_note(fake_sandbox):
+    sbx = fake_sandbox
+    log = NotesLog("embeddings/notes", sandbox=sbx, compact_every=10_000)
+    for i in range(20):
+        log.append(_note(i))
+    # the log file itself is written once (its header), never rewritten per note
+    assert sbx.files.writes.count(log.log_path) == 1
+    segments = [p for p in sbx.files.data if p.startswith(log.segments_path)]
+    assert len(segments) == 20 and all(sbx.files.data[p].count(b"\n") == 1 for p in segments)
+
+    log.compact()
+    assert not [p for p in sbx.files.data if p.startswith(log.segments_path)]
+    assert len(NotesLogReader("embeddings/notes", sandbox=sbx).read()[0]) == 20
+
+
+def test_near_duplicate_notes_are_found(sandbox):
+    log = NotesLog("embeddings/notes", sandbox=sandbox)
+    text = "patient reports poor sleep and racing thoughts before work deadlines every week"
+    note_id = log.append(_note(0, text))
+    assert log.find_duplicate(text + ".") == note_id
+    assert log.find_duplicate("discussed childhood memories of the family farm and horses") is None
+
+
+def test_host_log_survives_a_torn_line(workdir):
+    log = NotesLog("embeddings/notes")
+    reader = NotesLogReader("embeddings/notes")
+    log.append(_note(0))
+    with open(log.log_path, "ab") as f:
+        f.write(b'{"notes": "half')
+    assert len(reader.read()[1]) == 1
+    assert os.path.getsize(log.log_path) > reader.offset
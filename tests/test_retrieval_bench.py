@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+from src.utils import retrieval_bench
+
+
+def test_tool_backend_leaves_cwd_and_shared_embedder_alone(workdir):
+    pytest.importorskip("smolagents")
+    import tools.search_tools as search_tools
+
+    shared = search_tools.get_shared_embedder
+    row = retrieval_bench.run_size(300, dim=64, queries=5, k=3, backends=("exact", "tool"),
+                                   workdir=str(workdir / "bench"))
+    assert os.getcwd() == str(workdir)
+    assert search_tools.get_shared_embedder is shared
+    assert "mean_ms" in row["backends"]["tool"]
@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("smolagents")
+
+from src.utils import config as C
+from src.utils.embeddings import get_shared_embedder
+from src.utils.shards import CORPUS_SHARD, shard_base
+from src.utils.vector_store import VectorStore
+import tools.search_tools as search_tools
+
+
+def _write(base, texts, **fields):
+    emb = get_shared_embedder()
+    VectorStore(base).write([
+        {"kind": fields.get("kind", "corpus"), "source": f"{i}.md", "chunk_index": i, "content": t,
+         "embedding": emb.embed(t), **{k: v for k, v in fields.items() if k != "kind"}}
+        for i, t in enumerate(texts)
+    ])
+
+
+@pytest.fixture
+def stores(workdir, monkeypatch):
+    monkeypatch.setattr(C, "PATIENT_ID", "p1")
+    _write(search_tools.METADATA_STORE_PATH, ["catastrophizing is a cognitive distortion"], kind="metadata")
+    _write(shard_base(CORPUS_SHARD, "p1", "2025-01-01"), ["p1 talked about catastrophizing at work"],
+           patient_id="p1", session_date="2025-01-01")
+    _write(shard_base(CORPUS_SHARD, "p2", "2025-01-02"), ["p2 talked about catastrophizing at home"],
+           patient_id="p2", session_date="2025-01-02")
+    return workdir
+
+
+def _sources(out):
+    return sorted(h["kind"] + ":" + h["preview"][:2] for h in out["results"])
+
+
+def test_patient_scope_keeps_global_metadata(stores):
+    tool = search_tools.SearchMetadataChunks()
+    out = tool.forward("catastrophizing", kind="metadata", include_notes=False, patient_id="p1")
+    assert [h["kind"] for h in out["results"]] == ["metadata"]
+    out = tool.forward("catastrophizing", kind="any", include_notes=False, patient_id="p1", session="2025-01-01")
+    assert _sources(out) == ["corpus:p1", "metadata:ca"]
+
+
+def test_unscoped_search_defaults_to_active_patient(stores):
+    tool = search_tools.SearchMetadataChunks()
+    out = tool.forward("catastrophizing", kind="corpus", include_notes=False)
+    assert _sources(out) == ["corpus:p1"]
+    out = tool.forward("catastrophizing", kind="corpus", include_notes=False, patient_id="*")
+    assert _sources(out) == ["corpus:p1", "corpus:p2"]
+
+
+def test_lexical_mode_merges_stores_by_rank(stores):
+    tool = search_tools.SearchMetadataChunks()
+    out = tool.forward("catastrophizing", kind="any", include_notes=False, mode="lexical", min_score=0.5)
+    # each store's best hit gets the same rank score, whatever its raw BM25
+    assert {h["score"] for h in out["results"]} == {round(1.0 / 61, 4)}
+    assert "min_score" in out["info"]
+
+
+def test_batch_tool_matches_single_queries(stores):
+    single = search_tools.SearchMetadataChunks()
+    batch = search_tools.SearchMetadataBatch()
+    assert "query" not in batch.inputs and set(batch.inputs) - {"queries"} <= set(single.inputs)
+    queries = ["catastrophizing", "cognitive distortion"]
+    out = batch.forward(queries, kind="any", include_notes=False)
+    for q, per_query in zip(queries, out["results"]):
+        assert per_query["query"] == q
+        assert per_query["results"] == single.forward(q, kind="any", include_notes=False)["results"]
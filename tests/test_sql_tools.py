@@ -0,0 +1,93 @@
+import pytest
+
+pytest.importorskip("smolagents")
+
+from src.utils.sqlite_helpers import bulk_insert_qa, close_all_sqlite, get_sqlite_manager
+from tools.sql_tools import QuerySQLite, UpsertDFCleanToSQLite
+
+
+@pytest.fixture
+def tool(tmp_path):
+    db = str(tmp_path / "therapy.db")
+    bulk_insert_qa(db, [{"patient_id": "p1", "session_type": "intake", "session_date": "2025-01-01",
+                         "turn_id": t, "speaker": "patient", "text_raw": f"raw {t}", "text_clean": None}
+                        for t in range(1, 8)])
+    yield QuerySQLite(db_path=db)
+    close_all_sqlite()
+
+
+def test_cursor_pages_through_all_rows(tool):
+    sql = "SELECT turn_id FROM qa_pairs WHERE patient_id = ? ORDER BY turn_id"
+    seen, cursor = [], None
+    while True:
+        out = tool.forward(sql, params=["p1"], limit=3, cursor=cursor)
+        assert out["ok"] and out["rowcount"] <= 3
+        seen += [r[0] for r in out["rows"]]
+        cursor = out["next_cursor"]
+        if not cursor:
+            break
+    assert seen == list(range(1, 8))
+
+
+def test_cursor_is_bound_to_its_query(tool):
+    out = tool.forward("SELECT turn_id FROM qa_pairs ORDER BY turn_id", limit=2)
+    other = tool.forward("SELECT speaker FROM qa_pairs", limit=2, cursor=out["next_cursor"])
+    assert not other["ok"] and "cursor_does_not_match_query" in other["message"]
+    assert not tool.forward("SELECT 1", cursor="not-a-cursor")["ok"]
+
+
+def test_pragma_pages_client_side(tool):
+    out = tool.forward("PRAGMA table_info(qa_pairs)", limit=4)
+    rest = tool.forward("PRAGMA table_info(qa_pairs)", limit=4, cursor=out["next_cursor"])
+    names = [r[1] for r in out["rows"] + rest["rows"]]
+    assert names == ["patient_id", "session_type", "session_date", "turn_id", "speaker", "text_raw", "text_clean"]
+
+
+def test_result_cache_is_invalidated_by_writes(tool):
+    sql = "SELECT COUNT(*) FROM qa_pairs"
+    first = tool.forward(sql)
+    again = tool.forward(sql)
+    assert not first["cache"]["hit"] and again["cache"]["hit"] and again["rows"] == first["rows"]
+
+    get_sqlite_manager(tool.db_path).write(lambda conn: conn.execute("DELETE FROM qa_pairs WHERE turn_id > 5"))
+    after = tool.forward(sql)
+    assert not after["cache"]["hit"] and after["rows"][0][0] == 5
+    # volatile expressions are never served from the cache
+    assert not tool.forward("SELECT random()")["cache"]["hit"]
+    assert not tool.forward("SELECT random()")["cache"]["hit"]
+
+
+def test_write_statements_are_rejected(tool):
+    assert not tool.forward("DELETE FROM qa_pairs")["ok"]
+    assert tool.forward("SELECT COUNT(*) FROM qa_pairs")["rows"][0][0] == 7
+
+
+def test_trailing_comment_and_duplicate_columns_are_kept(tool):
+    out = tool.forward("SELECT turn_id FROM qa_pairs ORDER BY turn_id -- first turns", limit=2)
+    assert out["ok"] and [r[0] for r in out["rows"]] == [1, 2] and out["next_cursor"]
+    out = tool.forward("SELECT a.turn_id, b.turn_id FROM qa_pairs a JOIN qa_pairs b ON b.turn_id = a.turn_id + 1 "
+                       "ORDER BY a.turn_id", limit=3)
+    assert out["columns"] == ["turn_id", "turn_id"] and [tuple(r) for r in out["rows"]] == [(1, 2), (2, 3), (3, 4)]
+
+
+def test_upsert_csv_twice_updates_in_place(tmp_path):
+    db = str(tmp_path / "therapy.db")
+    tool = UpsertDFCleanToSQLite(db_path=db)
+    header = "session_date,session_type,turn_id,speaker,text_raw,text_clean\n"
+    try:
+        first = tool.forward(csv_text=header + "2025-01-01,intake,1,therapist,hi,hi\n"
+                                               "2025-01-01,intake,2,patient,tired,\n"
+                                               "2025-01-01,intake,3,therapist,why?,why\n", patient_id="p1")
+        assert first["ok"] and first["upserts"] == 3
+        again = tool.forward(csv_text=header + "2025-01-01,intake,2.0,patient,so tired,tired\n"
+                                               "2025-01-01,intake,4,patient,work,work\n", patient_id="p1")
+        assert again["ok"] and again["upserts"] == 2
+        rows = get_sqlite_manager(db).read(lambda conn: conn.execute(
+            "SELECT turn_id, speaker, text_raw, text_clean FROM qa_pairs WHERE patient_id = 'p1' "
+            "ORDER BY turn_id").fetchall())
+        assert rows == [(1, "therapist", "hi", "hi"), (2, "patient", "so tired", "tired"),
+                        (3, "therapist", "why?", "why"), (4, "patient", "work", "work")]
+        assert not tool.forward(csv_text="turn_id,speaker\n1,patient\n")["ok"]
+    finally:
+        close_all_sqlite()
+
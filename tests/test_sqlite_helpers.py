@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+
+import pytest
+
+from src.utils.sqlite_helpers import SQLiteManager, with_busy_retry
+
+
+@pytest.fixture
+def mgr(tmp_path):
+    m = SQLiteManager(str(tmp_path / "therapy.db"), read_pool_size=2, busy_timeout_ms=20)
+    m.ensure_schema("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT)")
+    yield m
+    m.close()
+
+
+def test_failed_commit_is_rolled_back(mgr):
+    mgr.ensure_schema(
+        "CREATE TABLE IF NOT EXISTS parent (id INTEGER PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS child (pid INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)",
+    )
+    mgr._writer_conn().execute("PRAGMA foreign_keys=ON")
+    with pytest.raises(sqlite3.IntegrityError):
+        # the deferred foreign key is only checked, and fails, at COMMIT
+        with mgr.transaction() as conn:
+            conn.execute("INSERT INTO child VALUES (42)")
+    assert not mgr._writer_conn().in_transaction
+    mgr.write(lambda conn: conn.execute("INSERT INTO kv VALUES ('a', '1')"))
+    assert mgr.read(lambda conn: conn.execute("SELECT COUNT(*) FROM child").fetchone()[0]) == 0
+
+
+def test_reader_pool_is_bounded_and_read_only(mgr):
+    mgr.write(lambda conn: conn.execute("INSERT INTO kv VALUES ('a', '1')"))
+    held, third_got = [], threading.Event()
+    with mgr.reader() as r1, mgr.reader() as r2:
+        held += [r1, r2]
+
+        def third():
+            with mgr.reader() as r3:
+                held.append(r3)
+                third_got.set()
+        t = threading.Thread(target=third)
+        t.start()
+        assert not third_got.wait(0.1)  # both pooled connections are in use
+        with pytest.raises(sqlite3.OperationalError):
+            r1.execute("INSERT INTO kv VALUES ('b', '2')")
+    t.join(5)
+    assert third_got.is_set() and held[2] in held[:2] and mgr._n_readers == 2
+
+
+def test_busy_writes_are_retried(mgr, tmp_path):
+    other = sqlite3.connect(str(tmp_path / "therapy.db"), isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.15, other.execute, args=("COMMIT",)).start()
+    # busy_timeout is 20 ms: only the retry loop outlasts the other writer's lock
+    mgr.write(lambda conn: conn.execute("INSERT INTO kv VALUES ('a', '1')"))
+    assert mgr.read(lambda conn: conn.execute("SELECT v FROM kv").fetchone()[0]) == "1"
+    other.close()
+
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "ok"
+    assert with_busy_retry(flaky, base_delay=0.001) == "ok" and len(calls) == 3
+
+    def broken():
+        calls.append(1)
+        raise sqlite3.OperationalError("no such table: nope")
+    with pytest.raises(sqlite3.OperationalError, match="no such table"):
+        with_busy_retry(broken)
+    assert len(calls) == 4  # other errors are not retried
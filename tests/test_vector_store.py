@@ -0,0 +1,100 @@
+import json
+
+import numpy as np
+import pytest
+
+from src.utils.vector_store import StoreCache, VectorMatrix, VectorStore, merge_hits, merge_hits_mmr, mmr_select
+
+
+def _records(n, dim=4, offset=0.0):
+    rng = np.random.default_rng(n)
+    return [{"kind": "corpus", "source": "s.md", "chunk_index": i, "content": f"chunk {i}",
+             "embedding": (rng.normal(size=dim) + offset).tolist()} for i in range(n)]
+
+
+def test_store_cache_hits_until_the_store_changes(workdir):
+    VectorStore("embeddings/corpus_store").write(_records(5))
+    cache = StoreCache()
+    vm = cache.get("embeddings/corpus_store")
+    assert cache.get("embeddings/corpus_store") is vm
+    assert cache.stats()["loads"] == 1 and cache.stats()["hits"] == 1
+
+    VectorStore("embeddings/corpus_store").write(_records(7))
+    reloaded = cache.get("embeddings/corpus_store")
+    assert reloaded is not vm and len(reloaded) == 7 and cache.stats()["loads"] == 2
+
+    cache.invalidate("embeddings/corpus_store")
+    assert cache.get("embeddings/corpus_store") is not reloaded and cache.stats()["loads"] == 3
+
+
+def test_sandbox_store_is_not_read_to_check_it_exists(fake_sandbox):
+    files = fake_sandbox.files
+    VectorStore("embeddings/corpus_store", sandbox=fake_sandbox).write(_records(5))
+    cache = StoreCache()
+    cache.get("embeddings/corpus_store", sandbox=fake_sandbox)
+    files.reads.clear()
+
+    assert VectorStore("embeddings/corpus_store", sandbox=fake_sandbox).exists()
+    assert not VectorStore("embeddings/missing_store", sandbox=fake_sandbox).exists()
+    cache.get("embeddings/corpus_store", sandbox=fake_sandbox)
+    # an unchanged store costs one read of its small .version stamp
+    assert files.reads == ["embeddings/corpus_store.version"]
+    assert cache.stats()["hits"] == 1
+
+
+def test_write_reload_and_legacy_migration(workdir):
+    recs = _records(6)
+    recs.append({"kind": "notes", "content": "placeholder", "embedding": [1.0] * 10})  # odd dim stays inline
+    store = VectorStore("embeddings/corpus_store")
+    assert store.write(recs) == 7
+    assert not list((workdir / "embeddings").glob("*.tmp"))
+    vm = VectorStore("embeddings/corpus_store").load()
+    assert [r["content"] for r in vm.records] == [r["content"] for r in recs]
+    vecs = vm.vectors()
+    expected = np.asarray(recs[0]["embedding"]) / np.linalg.norm(recs[0]["embedding"])
+    np.testing.assert_allclose(vecs[0], expected, atol=1e-6)
+    assert len(vecs[6]) == 10
+
+    legacy = workdir / "embeddings" / "metadata_store.json"
+    legacy.write_text(json.dumps(_records(3)))
+    migrated = VectorStore("embeddings/metadata_store.json")
+    assert migrated.exists() and migrated.base_path == "embeddings/metadata_store"
+    assert [r["chunk_index"] for r in migrated.load().records] == [0, 1, 2]
+    assert (workdir / "embeddings" / "metadata_store.version").exists()
+
+
+def test_failed_write_keeps_the_previous_store(workdir, monkeypatch):
+    store = VectorStore("embeddings/corpus_store")
+    store.write(_records(4))
+    before = {p.name: p.read_bytes() for p in (workdir / "embeddings").iterdir()}
+
+    real_open = open
+
+    def failing_open(path, mode="r", *args, **kwargs):
+        if str(path).endswith(".tmp") and ".bm25.npz" in str(path):
+            raise OSError("disk full")
+        return real_open(path, mode, *args, **kwargs)
+
+    with monkeypatch.context() as m, pytest.raises(OSError):
+        m.setattr("builtins.open", failing_open)
+        store.write(_records(9))
+    assert {p.name: p.read_bytes() for p in (workdir / "embeddings").iterdir()} == before
+    assert len(VectorStore("embeddings/corpus_store").load()) == 4
+
+
+def test_mmr_promotes_a_diverse_hit():
+    vm = VectorMatrix.from_records([
+        {"content": "sleep", "embedding": [1.0, 0.0, 0.0]},
+        {"content": "sleep again", "embedding": [0.99, 0.05, 0.0]},
+        {"content": "work", "embedding": [0.0, 1.0, 0.0]},
+        {"content": "mood", "embedding": [0.0, 0.0, 1.0]},
+    ])
+    per_store = [(vm, [(0, 0.95), (1, 0.94), (2, 0.70), (3, 0.30)])]
+    plain = [r["content"] for r, _ in merge_hits(per_store, 3)]
+    assert plain == ["sleep", "sleep again", "work"]
+    assert [r["content"] for r, _ in merge_hits_mmr(per_store, 3, lam=1.0)] == plain
+    assert [r["content"] for r, _ in merge_hits_mmr(per_store, 3, lam=0.5)] == ["sleep", "work", "mood"]
+
+    rel = np.array([0.9, 0.8, 0.5, 0.1], dtype=np.float32)
+    assert mmr_select(rel, np.eye(4, dtype=np.float32), 4, lam=1.0) == [0, 1, 2, 3]
+
@@ -8,7 +8,7 @@ database operations, and documentation.
 # Import from database_tools.py
 from .sql_tools import (QuerySQLite, WriteQAtoSQLite)
 from .graph_tools import WriteCypherForChunk, WriteGraphForChunk
-from .search_tools import SearchMetadataChunks
+from .search_tools import SearchMetadataChunks, SearchMetadataBatch
 # Import from documentation_tools.py
 from .documentation_tools import (
     DocumentLearningInsights,
@@ -20,6 +20,7 @@ __all__ = [
     'DocumentLearningInsights',
     'WriteCypherForChunk',
     'WriteGraphForChunk',
-    'SearchMetadataChunks'
+    'SearchMetadataChunks',
+    'SearchMetadataBatch'
 
 ]
\ No newline at end of file
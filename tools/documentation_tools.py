@@ -124,7 +124,10 @@ _Time:_ {ts}
 
         if index and callable(self.indexer):
             try:
-                self.indexer(k, title, notes_markdown, meta)
+                # session fields go along so searches can filter notes by patient/session
+                self.indexer(k, title, notes_markdown, {
+                    "patient_id": PATIENT_ID, "session_type": SESSION_TYPE, "session_date": SESSION_DATE, **meta,
+                })
             except Exception as e:
                 return {
                     "chunk_id": k,
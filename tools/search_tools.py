@@ -1,28 +1,26 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Optional
-from smolagents import Tool
+from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
 import os
-import json
-from src.utils.embeddings import get_embedder_from_env
+from smolagents import Tool
+from src.utils.embeddings import get_shared_embedder, embed_query, embed_queries
+from src.utils.vector_store import STORE_CACHE_MAX, VectorMatrix, VectorStore, get_store_cache, merge_hits_mmr
+from src.utils.notes_store import NotesLogReader, AGENT_NOTES_BASE
+from src.utils.shards import ALL_PATIENTS, CORPUS_SHARD, NOTES_SHARD, UNASSIGNED_PATIENT, list_shard_bases
+from src.utils import config as C
+from src.utils.metadata_embedder import get_indexing_status
 
-# Default store locations (host or sandbox paths are identical strings)
-METADATA_STORE_PATH = "embeddings/metadata_store.json"
-CORPUS_STORE_PATH   = "embeddings/corpus_store.json"
-AGENT_NOTES_PATH    = "embeddings/agent_notes_store.json"
+# Default store locations (host or sandbox paths are identical strings).
+# Metadata/corpus are binary stores: <base>.npy + <base>.jsonl (legacy <base>.json is converted on first use).
+METADATA_STORE_PATH = "embeddings/metadata_store"
+CORPUS_STORE_PATH   = "embeddings/corpus_store"  # pre-sharding corpus store, still searched if present
+AGENT_NOTES_PATH    = AGENT_NOTES_BASE  # append-only log + compacted store (see notes_store.py)
+# Corpus chunks and patient notes live in per-patient/session shards (see shards.py). A search
+# opens the shards of patient_id (default: the active config.PATIENT_ID, "*" = every patient);
+# the global metadata / notes stores are always searched, keeping their patient-less records.
 
 SUPPORTED_KINDS = {"metadata", "corpus", "any"}
-
-def _cosine(a: List[float], b: List[float]) -> float:
-    # robust cosine (no numpy dep)
-    if not a or not b:
-        return 0.0
-    n = min(len(a), len(b))
-    dot = sum(a[i] * b[i] for i in range(n))
-    na = sum(a[i] * a[i] for i in range(n)) ** 0.5
-    nb = sum(b[i] * b[i] for i in range(n)) ** 0.5
-    if na == 0 or nb == 0:
-        return 0.0
-    return dot / (na * nb)
+SUPPORTED_MODES = {"vector", "lexical", "hybrid"}
 
 def _dummy_embed(text: str) -> List[float]:
     """
@@ -33,12 +31,32 @@ def _dummy_embed(text: str) -> List[float]:
     v = float(len(text) % 10)
     return [v] * 10
 
-def _read_json_local(path: str) -> Optional[str]:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read()
-    except Exception:
-        return None
+def _format_hit(rec: Dict[str, Any], score: float, include_content: bool, preview_chars: int) -> Dict[str, Any]:
+    content = rec.get("content", "")
+    out = {
+        "score": round(float(score), 4),
+        "kind": rec.get("kind", "metadata"),
+        "source": rec.get("source", ""),
+        "doc_id": rec.get("doc_id") or "",
+        "chunk_index": rec.get("chunk_index") if "chunk_index" in rec else rec.get("chunk_id", 0),
+    }
+    if rec.get("dup_count"):
+        out["dup_count"] = rec["dup_count"]  # agent note repeated across chunks (merged near-duplicates)
+    if include_content:
+        out["content"] = content
+    else:
+        preview = content[:preview_chars].replace("\n", " ")
+        out["preview"] = preview + ("…" if len(content) > preview_chars else "")
+    return out
+
+def _with_indexing_info(out: Dict[str, Any]) -> Dict[str, Any]:
+    """Flag results served while the startup embedding is still running (or has failed)."""
+    status = get_indexing_status()
+    note = status.info()
+    if note:
+        out["indexing"] = status.running
+        out["info"] = f"{out['info']} {note}" if out.get("info") else note
+    return out
 
 class SearchMetadataChunks(Tool):
     name = "search_metadata_chunks"
@@ -72,7 +90,8 @@ class SearchMetadataChunks(Tool):
         },
         "min_score": {
             "type": "number",
-            "description": "Score threshold 0..1",
+            "description": "Cosine similarity threshold 0..1 (vector mode and the vector side of hybrid; "
+                           "lexical hits are ranked, not thresholded)",
             "default": 0.0,
             "nullable": False
         },
@@ -88,13 +107,78 @@ class SearchMetadataChunks(Tool):
             "default": 240,
             "nullable": False
         },
+        "source": {
+            "type": "string",
+            "description": "Only this source file (e.g. psych_frameworks.md)",
+            "default": None,
+            "nullable": True
+        },
+        "doc_id": {
+            "type": "string",
+            "description": "Only this doc_id",
+            "default": None,
+            "nullable": True
+        },
+        "patient_id": {
+            "type": "string",
+            "description": "Only records of this patient (default: the active patient; \"*\" = all patients)",
+            "default": None,
+            "nullable": True
+        },
+        "session": {
+            "type": "string",
+            "description": "Only records of this session date",
+            "default": None,
+            "nullable": True
+        },
+        "chunk_min": {
+            "type": "integer",
+            "description": "Lowest chunk id (inclusive)",
+            "default": None,
+            "nullable": True
+        },
+        "chunk_max": {
+            "type": "integer",
+            "description": "Highest chunk id (inclusive)",
+            "default": None,
+            "nullable": True
+        },
+        "mmr_lambda": {
+            "type": "number",
+            "description": "1.0 = rank by relevance only; lower (e.g. 0.5) drops near-duplicate chunks (MMR)",
+            "default": 1.0,
+            "nullable": False
+        },
+        "mode": {
+            "type": "string",
+            "description": "vector|lexical|hybrid (hybrid = BM25 + vector, reciprocal rank fusion; best for exact terms)",
+            "default": "vector",
+            "nullable": False
+        },
+        "nprobe": {
+            "type": "integer",
+            "description": "IVF lists probed on large indexed stores (0 = default, -1 = exact scan)",
+            "default": 0,
+            "nullable": False
+        },
     }
 
     output_type = "object"
 
-    def __init__(self, sandbox=None):
+    def __init__(self, sandbox=None, embedder=None, root: Optional[str] = None):
+        """
+        embedder: query embedder (default: the process-wide shared one).
+        root: directory the embeddings/ paths are resolved against (default: the working directory).
+        """
         super().__init__()
         self.sandbox = sandbox
+        self.root = root or ""
+        self._embedder = embedder
+        # keeps the last seen log offset so each search only parses newly appended notes
+        self._notes_reader = NotesLogReader(self._path(AGENT_NOTES_PATH), sandbox=sandbox,
+                                            fallback_embed=self._embed_missing)
+        # one reader per patient/session notes shard, least recently used dropped beyond STORE_CACHE_MAX
+        self._shard_readers: "OrderedDict[str, NotesLogReader]" = OrderedDict()
         # smolagents validates against forward(...), not run(...)
         # IMPORTANT: smolagents inspects **forward**, not run
 
@@ -107,113 +191,233 @@ class SearchMetadataChunks(Tool):
             min_score: float = 0.0,
             include_content: bool = False,
             preview_chars: int = 240,
+            source: Optional[str] = None,
+            doc_id: Optional[str] = None,
+            patient_id: Optional[str] = None,
+            session: Optional[str] = None,
+            chunk_min: Optional[int] = None,
+            chunk_max: Optional[int] = None,
+            mmr_lambda: float = 1.0,
+            mode: str = "vector",
+            nprobe: int = 0,
     ):
         if not query or not str(query).strip():
             return {"results": [], "info": "Empty query."}
 
-        embedder = get_embedder_from_env()
-        qv = embedder.embed(query)
-
         kind = (kind or "metadata").lower()
         if kind not in SUPPORTED_KINDS:
             kind = "metadata"
+        mode = (mode or "vector").lower()
+        if mode not in SUPPORTED_MODES:
+            mode = "vector"
+
+        # shared, process-wide embedder; repeated queries are served from the query LRU
+        embedder = self.embedder
+        qv = embed_query(query, embedder) if mode != "lexical" else None
+
+        shard_pid, patient_filter = self._scope(patient_id)
+        stores = self._collect_stores(kind, include_notes, shard_pid, session)
+        if not stores:
+            return _with_indexing_info({"results": [], "info": "No stores found or empty."})
+        info = self._model_info(stores, embedder) if mode != "lexical" else None
+        if mode == "lexical" and min_score:
+            info = "min_score applies to cosine similarity; lexical results are not thresholded."
+
+        # Score: one mat-vec per store (or the IVF lists of large stores), top-k per store, then a global merge
+        k = max(1, int(top_k))
+        exact = int(nprobe or 0) < 0
+        nprobe = max(0, int(nprobe or 0))
+        filters = dict(source=source, doc_id=doc_id, patient_id=patient_filter, session=session,
+                       chunk_min=chunk_min, chunk_max=chunk_max)
+        # MMR re-ranks a deeper candidate pool down to k
+        lam = 1.0 if mmr_lambda is None else float(mmr_lambda)
+        depth = k if lam >= 1.0 else max(4 * k, 20)
+        per_store = []
+        for vm, mask in self._masked(stores, filters):
+            if mode == "lexical":
+                # raw BM25 is per-store (own IDF / avg length): merge stores by rank instead
+                hits_vm = vm.lexical_search(query, depth, mask=mask, fused=True)
+            elif mode == "hybrid":
+                hits_vm = vm.hybrid_search(qv, query, depth, min_score, nprobe=nprobe, exact=exact, mask=mask)
+            else:
+                hits_vm = vm.search(qv, depth, min_score, nprobe=nprobe, exact=exact, mask=mask)
+            per_store.append((vm, hits_vm))
+        hits = merge_hits_mmr(per_store, k, lam)
+
+        # Previews are only built for the hits we return
+        out = {"results": [_format_hit(rec, score, include_content, preview_chars) for rec, score in hits]}
+        if info: out["info"] = info
+        return _with_indexing_info(out)
 
-        # Load stores
-        results_pool: List[Dict[str, Any]] = []
+    @staticmethod
+    def _scope(patient_id: Optional[str]) -> Tuple[str, Any]:
+        """
+        (shard patient, patient_id filter) of a search: the given patient, else the active
+        config.PATIENT_ID, else only records without a patient. ALL_PATIENTS crosses patients.
+        """
+        if patient_id == ALL_PATIENTS:
+            return ALL_PATIENTS, None
+        pid = patient_id or C.PATIENT_ID
+        if pid:
+            return pid, pid
+        return UNASSIGNED_PATIENT, [""]
+
+    def _collect_stores(self, kind: str, include_notes: bool,
+                        patient_id: Optional[str] = None,
+                        session: Optional[str] = None) -> List[Tuple[VectorMatrix, bool]]:
+        """
+        Non-empty (store, is_global) pairs for `kind` (one pre-normalised matrix per store).
+        Corpus and note shards are only opened for the patient/session in scope (see
+        list_shard_bases); the global metadata and notes stores are always included.
+        """
+        stores: List[Tuple[VectorMatrix, bool]] = []
         if kind in ("metadata", "any"):
-            results_pool.extend(self._load_store(METADATA_STORE_PATH))
+            stores.append((self._load_vector_store(self._path(METADATA_STORE_PATH)), True))
         if kind in ("corpus", "any"):
-            results_pool.extend(self._load_store(CORPUS_STORE_PATH))
+            for base in [self._path(CORPUS_STORE_PATH)] + list_shard_bases(
+                    CORPUS_SHARD, patient_id, session, sandbox=self.sandbox, root=self.root):
+                if VectorStore(base, sandbox=self.sandbox).exists():
+                    stores.append((self._load_vector_store(base), False))
         if include_notes:
-            # Agent notes may not have vectors; degrade gracefully
-            notes = self._load_store(AGENT_NOTES_PATH)
-            for n in notes:
-                if "content" not in n and "notes" in n:
-                    n = {
-                        "kind": "notes",
-                        "source": "agent_notes_store.json",
-                        "doc_id": n.get("doc_id") or "notes",
-                        "chunk_index": n.get("chunk") or 0,
-                        "content": n.get("notes", ""),
-                        "embedding": n.get("embedding") or _dummy_embed(n.get("notes", "")),
-                        "created_at": n.get("created_at", "unknown"),
-                    }
-                results_pool.append(n)
-
-        if not results_pool:
-            return {"results": [], "info": "No stores found or empty."}
-
-        #      embedder = get_embedder_from_env()
-        #     qv = embedder.embed(query)
-
-        store_models = set()
-        for rec in results_pool:
-            m = rec.get("embedding_model")
-            if m: store_models.add(m)
-
-        info = None
-        if store_models and (getattr(embedder, "name", None) not in store_models):
-            info = f"Query embedder {getattr(embedder, 'name', '?')} differs from store models {sorted(store_models)}; scores may be less comparable."
-
-        # Score
-        scored: List[Dict[str, Any]] = []
-        for rec in results_pool:
-            emb = rec.get("embedding")
-            if not isinstance(emb, list) or not emb:
-                # fallback: embed content on the fly
-                emb = _dummy_embed(rec.get("content", ""))
-            score = _cosine(qv, emb)
-            if score >= min_score:
-                kind_out = rec.get("kind", "metadata")
-                source = rec.get("source", "")
-                doc_id = rec.get("doc_id") or ""
-                idx = rec.get("chunk_index") if "chunk_index" in rec else rec.get("chunk_id", 0)
-                content = rec.get("content", "")
-                out = {
-                    "score": round(float(score), 4),
-                    "kind": kind_out,
-                    "source": source,
-                    "doc_id": doc_id,
-                    "chunk_index": idx,
-                }
-                if include_content:
-                    out["content"] = content
-                else:
-                    preview = content[:preview_chars].replace("\n", " ")
-                    out["preview"] = preview + ("…" if len(content) > preview_chars else "")
-                scored.append(out)
-
-        scored.sort(key=lambda x: x["score"], reverse=True)
-        out = {"results": scored[: max(1, int(top_k))]}
-        if info: out = out["info"]
+            # Agent notes: compacted store + the tail of the append-only log
+            stores.extend((vm, True) for vm in self._notes_reader.read())
+            for base in list_shard_bases(NOTES_SHARD, patient_id, session, sandbox=self.sandbox, root=self.root):
+                stores.extend((vm, False) for vm in self._shard_reader(base).read())
+        return [(vm, is_global) for vm, is_global in stores if len(vm)]
+
+    def _shard_reader(self, base: str) -> NotesLogReader:
+        reader = self._shard_readers.get(base)
+        if reader is None:
+            reader = NotesLogReader(base, sandbox=self.sandbox, fallback_embed=self._embed_missing)
+            self._shard_readers[base] = reader
+            while len(self._shard_readers) > STORE_CACHE_MAX:
+                self._shard_readers.popitem(last=False)
+        else:
+            self._shard_readers.move_to_end(base)
+        return reader
+
+    @staticmethod
+    def _masked(stores: List[Tuple[VectorMatrix, bool]], filters: Dict[str, Any]) -> List[Any]:
+        """
+        (store, record mask) pairs; stores with no matching record are dropped before scoring.
+        In global stores a patient/session filter also keeps records that have none (the
+        psych metadata belongs to no patient).
+        """
+        out = []
+        for vm, is_global in stores:
+            f = filters
+            if is_global:
+                f = dict(filters)
+                for field in ("patient_id", "session"):
+                    wanted = f.get(field)
+                    if wanted is not None and wanted != "":
+                        f[field] = list(wanted if isinstance(wanted, (list, tuple, set)) else [wanted]) + [""]
+            mask = vm.filter_mask(**f)
+            if mask is None or mask.any():
+                out.append((vm, mask))
         return out
 
-    # ---- IO helpers ----
-    def _sbx_read(self, path: str) -> Optional[str]:
-        if not self.sandbox:
-            return _read_json_local(path)
-        try:
-            blob = self.sandbox.files.read(path)
-            return blob.decode() if isinstance(blob, (bytes, bytearray)) else str(blob)
-        except Exception:
-            return None
+    @staticmethod
+    def _model_info(stores: List[Tuple[VectorMatrix, bool]], embedder) -> Optional[str]:
+        store_models: set = set()
+        for vm, _ in stores:
+            store_models |= vm.models()
+        if store_models and (getattr(embedder, "name", None) not in store_models):
+            return f"Query embedder {getattr(embedder, 'name', '?')} differs from store models {sorted(store_models)}; scores may be less comparable."
+        return None
+
+    def _load_vector_store(self, base_path: str) -> VectorMatrix:
+        # cached across calls; reloaded only when the store's files (or sandbox version stamp) change
+        return get_store_cache().get(base_path, sandbox=self.sandbox, fallback_embed=self._embed_missing)
+
+    @property
+    def embedder(self):
+        return self._embedder or get_shared_embedder()
 
-    def _load_store(self, path: str) -> List[Dict[str, Any]]:
-        raw = self._sbx_read(path)
-        if not raw:
-            return []
+    def _path(self, rel: str) -> str:
+        return os.path.join(self.root, rel) if self.root else rel
+
+    def _embed_missing(self, text: str) -> List[float]:
+        # records stored without a vector are embedded once, when their store (or log generation) loads
         try:
-            data = json.loads(raw)
-            if isinstance(data, list):
-                return data
-            # Some stores might be a dict wrapper later; handle gracefully
-            if isinstance(data, dict) and "items" in data:
-                return data["items"]
+            return self.embedder.embed(text)
         except Exception:
-            pass
-        return []
+            return _dummy_embed(text)
+
+
+class SearchMetadataBatch(SearchMetadataChunks):
+    name = "search_metadata_batch"
+    description = (
+        "Run several searches at once (e.g. distortions, attachment styles, defense mechanisms). "
+        "Queries are embedded in one call and scored together; returns one result list per query."
+    )
+
+    inputs = {
+        "queries": {  # allow None, we'll guard against it in code
+            "type": "array",
+            "description": "List of search texts",
+            "default": None,
+            "nullable": True
+        },
+        # same filters as the single-query tool; vector scoring only (no query / mode / nprobe)
+        **{k: v for k, v in SearchMetadataChunks.inputs.items() if k not in ("query", "mode", "nprobe")},
+        "top_k": {**SearchMetadataChunks.inputs["top_k"], "description": "Number of hits per query"},
+        "min_score": {**SearchMetadataChunks.inputs["min_score"], "description": "Cosine similarity threshold 0..1"},
+    }
 
+    output_type = "object"
 
+    def forward(
+            self,
+            queries: Optional[List[str]] = None,
+            top_k: int = 5,
+            kind: str = "metadata",
+            include_notes: bool = True,
+            min_score: float = 0.0,
+            include_content: bool = False,
+            preview_chars: int = 240,
+            source: Optional[str] = None,
+            doc_id: Optional[str] = None,
+            patient_id: Optional[str] = None,
+            session: Optional[str] = None,
+            chunk_min: Optional[int] = None,
+            chunk_max: Optional[int] = None,
+            mmr_lambda: float = 1.0,
+    ):
+        if isinstance(queries, str):
+            queries = [queries]
+        queries = [str(q) for q in (queries or []) if q is not None and str(q).strip()]
+        if not queries:
+            return {"results": [], "info": "Empty query list."}
+
+        kind = (kind or "metadata").lower()
+        if kind not in SUPPORTED_KINDS:
+            kind = "metadata"
 
+        shard_pid, patient_filter = self._scope(patient_id)
+        stores = self._collect_stores(kind, include_notes, shard_pid, session)
+        if not stores:
+            return _with_indexing_info({"results": [{"query": q, "results": []} for q in queries],
+                                        "info": "No stores found or empty."})
 
+        # one batched embedder call (memo hits skipped), then one matrix-matrix product per store
+        embedder = self.embedder
+        qvs = embed_queries(queries, embedder)
+        info = self._model_info(stores, embedder)
 
+        k = max(1, int(top_k))
+        filters = dict(source=source, doc_id=doc_id, patient_id=patient_filter, session=session,
+                       chunk_min=chunk_min, chunk_max=chunk_max)
+        lam = 1.0 if mmr_lambda is None else float(mmr_lambda)
+        depth = k if lam >= 1.0 else max(4 * k, 20)
+        per_store = [(vm, vm.search_batch(qvs, depth, min_score, mask=mask)) for vm, mask in self._masked(stores, filters)]
+        out_results = []
+        for j, q in enumerate(queries):
+            hits = merge_hits_mmr([(vm, batch[j]) for vm, batch in per_store], k, lam)
+            out_results.append({
+                "query": q,
+                "results": [_format_hit(rec, score, include_content, preview_chars) for rec, score in hits],
+            })
+        out = {"results": out_results}
+        if info: out["info"] = info
+        return _with_indexing_info(out)
@@ -1,13 +1,27 @@
 from __future__ import annotations
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 from smolagents import Tool
+import base64
+import csv
+import hashlib
+import io
+import math
 import os
-import sqlite3
 import json
+import re
+import time
 from src.utils.export_writer import ExportWriter
+from src.utils.sqlite_helpers import (BULK_BATCH_SIZE, QUERY_TIMEOUT_S, QueryTimeout,
+                                     get_sqlite_manager, query_deadline)
 from src.utils.session_paths import session_templates
 from src.utils import config as C
 
+QUERY_PAGE_ROWS = 50    # rows per page when the caller gives no limit
+QUERY_MAX_ROWS = 500    # hard cap per call, whatever `limit` says
+# results of these can change without a write, so they are never served from the cache
+_VOLATILE_SQL = re.compile(r"\b(random|randomblob|changes|last_insert_rowid)\s*\(|'now'|\bcurrent_(date|time|timestamp)\b",
+                           re.IGNORECASE)
+
 # Existing single-qa tool retained for convenience
 class WriteQAtoSQLite(Tool):
     name = "write_qa_to_sqlite"
@@ -65,37 +79,19 @@ class WriteQAtoSQLite(Tool):
                     "message": f"missing_fields: {', '.join(missing)}"}
 
         try:
-            conn = sqlite3.connect(self.db_path)
-            cur = conn.cursor()
-            cur.execute("""
-                        CREATE TABLE IF NOT EXISTS qa_pairs (
-                                                                patient_id   TEXT NOT NULL,
-                                                                session_type TEXT NOT NULL,
-                                                                session_date TEXT NOT NULL,
-                                                                turn_id      INTEGER NOT NULL,
-                                                                speaker      TEXT,
-                                                                text_raw     TEXT,
-                                                                text_clean   TEXT,
-                                                                PRIMARY KEY (patient_id, session_type, session_date, turn_id)
-                            )
-                        """)
+            # shared writer connection; PRAGMAs and schema migrations are applied on first connect
+            db = get_sqlite_manager(self.db_path)
             # For single QA, map to a single "turn_id" row as needed (optional)
-            cur.execute(
+            db.write(lambda conn: conn.execute(
                 "INSERT INTO qa_pairs (patient_id, session_type, session_date, turn_id, speaker, text_raw, text_clean) VALUES (?, ?, ?, ?, ?, ?, ?) "
                 "ON CONFLICT(patient_id, session_type, session_date, turn_id) DO UPDATE SET "
                 "speaker=excluded.speaker, text_raw=excluded.text_raw, text_clean=excluded.text_clean",
                 (patient_id, C.SESSION_TYPE, session_date, 1, "Client", question, answer)
-            )
-            conn.commit()
+            ))
             rows = 1
-            conn.close()
             return {"ok": True, "db_path": self.db_path, "rows_affected": rows,
                     "message": f"Upserted QA for {patient_id} @ {session_date}"}
         except Exception as e:
-            try:
-                conn.close()
-            except Exception:
-                pass
             return {"ok": False, "db_path": self.db_path, "rows_affected": 0,
                     "message": f"sqlite_error: {e}"}
 
@@ -106,6 +102,8 @@ class UpsertDFCleanToSQLite(Tool):
     Schema/PK enforced:
       - Columns: patient_id, session_type, session_date, turn_id, speaker, text_raw, text_clean
       - PRIMARY KEY (patient_id, session_type, session_date, turn_id)
+    Rows are parsed lazily and written with executemany in BULK_BATCH_SIZE batches inside a
+    single transaction, so memory stays flat in the input size; the result reports rows/s.
     """
     name = "upsert_df_clean_to_sqlite"
     description = "Upsert df_clean rows into the session SQLite database."
@@ -152,28 +150,33 @@ class UpsertDFCleanToSQLite(Tool):
             self.db_path = info["db_path"]
             self.paths = info["paths"]
 
-    def _rows_from_csv(self, csv_text: str) -> Tuple[List[str], List[List[Any]]]:
-        import pandas as pd
-        from io import StringIO
-        df = pd.read_csv(StringIO(csv_text))
-        expected = ["session_date","session_type","turn_id","speaker","text_raw","text_clean"]
-        missing = [c for c in expected if c not in df.columns]
+    expected_columns = ["session_date", "session_type", "turn_id", "speaker", "text_raw", "text_clean"]
+
+    @staticmethod
+    def _cell(v: Any) -> Any:
+        # empty CSV cells / NaN from DataFrame.to_dict land as NULL, as with the old DataFrame path
+        if v is None or v == "" or (isinstance(v, float) and math.isnan(v)):
+            return None
+        return v
+
+    def _rows_from_csv(self, csv_text: str) -> Tuple[List[str], Iterator[List[Any]]]:
+        """Header check up front, then rows parsed lazily (no DataFrame copy of the input)."""
+        reader = csv.reader(io.StringIO(csv_text))
+        header = [h.strip() for h in next(reader, [])]
+        missing = [c for c in self.expected_columns if c not in header]
         if missing:
             raise ValueError(f"missing_required_columns: {missing}")
-        cols = expected
-        rows = df[cols].values.tolist()
-        return cols, rows
-
-    def _rows_from_records(self, records: List[Dict[str, Any]]) -> Tuple[List[str], List[List[Any]]]:
-        import pandas as pd
-        df = pd.DataFrame.from_records(records or [])
-        expected = ["session_date","session_type","turn_id","speaker","text_raw","text_clean"]
-        missing = [c for c in expected if c not in df.columns]
+        idx = [header.index(c) for c in self.expected_columns]
+        rows = ([self._cell(r[i]) if i < len(r) else None for i in idx] for r in reader if r)
+        return self.expected_columns, rows
+
+    def _rows_from_records(self, records: List[Dict[str, Any]]) -> Tuple[List[str], Iterator[List[Any]]]:
+        cols = set().union(*(r.keys() for r in records)) if records else set()
+        missing = [c for c in self.expected_columns if c not in cols]
         if missing:
             raise ValueError(f"missing_required_columns: {missing}")
-        cols = expected
-        rows = df[cols].values.tolist()
-        return cols, rows
+        rows = ([self._cell(r.get(c)) for c in self.expected_columns] for r in records)
+        return self.expected_columns, rows
 
     def forward(
             self,
@@ -198,26 +201,10 @@ class UpsertDFCleanToSQLite(Tool):
         except Exception as e:
             return {"ok": False, "error": f"input_parse_error: {e}"}
 
-        if not rows:
-            return {"ok": True, "db_path": self.db_path, "upserts": 0, "message": "no_rows"}
 
         # Upsert into the host-mirror DB (safe from the host Python process)
         try:
-            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-            conn = sqlite3.connect(self.db_path)
-            cur = conn.cursor()
-            cur.execute("""
-                        CREATE TABLE IF NOT EXISTS qa_pairs (
-                                                                patient_id   TEXT NOT NULL,
-                                                                session_type TEXT NOT NULL,
-                                                                session_date TEXT NOT NULL,
-                                                                turn_id      INTEGER NOT NULL,
-                                                                speaker      TEXT,
-                                                                text_raw     TEXT,
-                                                                text_clean   TEXT,
-                                                                PRIMARY KEY (patient_id, session_type, session_date, turn_id)
-                            )
-                        """)
+            db = get_sqlite_manager(self.db_path)
             # Prepare upsert
             sql = (
                 "INSERT INTO qa_pairs (patient_id, session_type, session_date, turn_id, speaker, text_raw, text_clean) "
@@ -225,18 +212,19 @@ class UpsertDFCleanToSQLite(Tool):
                 "ON CONFLICT(patient_id, session_type, session_date, turn_id) DO UPDATE SET "
                 "speaker=excluded.speaker, text_raw=excluded.text_raw, text_clean=excluded.text_clean"
             )
-            count = 0
-            for r in rows:
-                # r order: session_date, session_type, turn_id, speaker, text_raw, text_clean
-                sd, st, tid, spk, raw, clean = r
-                cur.execute(sql, (pid, stype or st, sdate or sd, int(tid), spk, raw, clean))
-                count += 1
-            conn.commit()
-            conn.close()
+            # r order: session_date, session_type, turn_id, speaker, text_raw, text_clean
+            params = ((pid, stype or st, sdate or sd, int(float(tid)), spk, raw, clean)
+                      for sd, st, tid, spk, raw, clean in rows)
+            t0 = time.perf_counter()
+            count = db.bulk_write(sql, params, batch_size=BULK_BATCH_SIZE)
+            elapsed = time.perf_counter() - t0
+            if not count:
+                return {"ok": True, "db_path": self.db_path, "upserts": 0, "message": "no_rows"}
 
             # Optional: mirror the updated DB into the sandbox so the file is visible at /workspace/exports/therapy.db
             try:
                 if self.sandbox and "sandbox" in getattr(self, "paths", {}):
+                    db.checkpoint()  # WAL → main file, so the copy has every committed row
                     with open(self.db_path, "rb") as f:
                         blob = f.read()
                     sbx_path = self.paths.get("sandbox")
@@ -251,22 +239,34 @@ class UpsertDFCleanToSQLite(Tool):
                 # Mirroring errors are non-fatal
                 pass
 
-            return {"ok": True, "db_path": self.db_path, "upserts": count, "message": f"upserted {count} rows"}
+            rate = count / elapsed if elapsed > 0 else float(count)
+            return {"ok": True, "db_path": self.db_path, "upserts": count,
+                    "elapsed_s": round(elapsed, 4), "rows_per_sec": round(rate, 1),
+                    "message": f"upserted {count} rows ({rate:,.0f} rows/s)"}
         except Exception as e:
-            try:
-                conn.close()
-            except Exception:
-                pass
             return {"ok": False, "db_path": self.db_path, "upserts": 0, "message": f"sqlite_error: {e}"}
 
 class QuerySQLite(Tool):
+    """
+    Read-only queries with bounded output. The statement runs as written (column names are
+    kept) and is stepped lazily: `offset` rows are skipped, then one page is pulled with
+    fetchmany, so SQLite stops after the page; never more than QUERY_MAX_ROWS are returned. When more rows
+    exist the result carries an opaque `next_cursor`; pass it back with the same sql/params
+    to get the next page. Every call runs under a wall-clock deadline (query_deadline).
+    SELECT pages are cached per database (SQLiteManager.results), keyed by normalised sql,
+    params, page bounds and PRAGMA data_version: repeats are free until the next commit.
+    """
     name = "query_sqlite"
-    description = "Run a read-only SQL query (SELECT/PRAGMA) on the session's therapy.db and return rows."
+    description = ("Run a read-only SQL query (SELECT/PRAGMA) on the session's therapy.db and return rows. "
+                   "Results are paged: if `next_cursor` is set, call again with the same sql/params and "
+                   "cursor=next_cursor for more rows.")
 
     inputs = {
         "sql": {"type": "string", "description": "SQL (SELECT/PRAGMA only).", "nullable": True},
         "params": {"type": "array", "description": "Optional parameter list.", "nullable": True},
-        "limit": {"type": "integer", "description": "Max rows to return.", "nullable": True}
+        "limit": {"type": "integer", "description": f"Max rows per page (default {QUERY_PAGE_ROWS}, capped at {QUERY_MAX_ROWS}).", "nullable": True},
+        "cursor": {"type": "string", "description": "next_cursor from a previous call with the same sql/params.", "nullable": True},
+        "timeout_s": {"type": "number", "description": f"Query time limit in seconds (default {QUERY_TIMEOUT_S:g}).", "nullable": True}
     }
 
     output_schema = {
@@ -277,6 +277,9 @@ class QuerySQLite(Tool):
             "rowcount": {"type": "integer"},
             "columns": {"type": "array", "items": {"type": "string"}},
             "rows": {"type": "array", "items": {"type": "array"}},
+            "next_cursor": {"type": "string", "nullable": True},
+            "elapsed_s": {"type": "number"},
+            "cache": {"type": "object"},
             "message": {"type": "string"}
         },
         "required": ["ok", "db_path", "rowcount", "columns", "rows", "message"]
@@ -294,35 +297,98 @@ class QuerySQLite(Tool):
             info = exporter.write_sql(filename="therapy.db")
             self.db_path = info["db_path"]
 
+    @staticmethod
+    def _fingerprint(sql: str, params: List[Any]) -> str:
+        key = json.dumps([" ".join(sql.split()), params], default=str)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def _encode_cursor(fp: str, offset: int) -> str:
+        raw = json.dumps({"q": fp, "o": offset}).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(token: str, fp: str) -> int:
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+            offset = int(data["o"])
+        except Exception:
+            raise ValueError("invalid_cursor")
+        if data.get("q") != fp or offset < 0:
+            raise ValueError("cursor_does_not_match_query (pass the same sql/params)")
+        return offset
+
+    def _error(self, message: str) -> Dict[str, Any]:
+        return {"ok": False, "db_path": self.db_path, "rowcount": 0,
+                "columns": [], "rows": [], "next_cursor": None, "message": message}
+
     def forward(self,
                 sql: Optional[str] = None,
                 params: Optional[List[Any]] = None,
-                limit: Optional[int] = None) -> Dict[str, Any]:
+                limit: Optional[int] = None,
+                cursor: Optional[str] = None,
+                timeout_s: Optional[float] = None) -> Dict[str, Any]:
         if not sql:
-            return {"ok": False, "db_path": self.db_path, "rowcount": 0,
-                    "columns": [], "rows": [], "message": "missing_required_argument: sql"}
+            return self._error("missing_required_argument: sql")
 
         s = sql.strip().lower()
         if not (s.startswith("select") or s.startswith("pragma")):
-            return {"ok": False, "db_path": self.db_path, "rowcount": 0,
-                    "columns": [], "rows": [],
-                    "message": "only_read_only_statements_allowed (SELECT/PRAGMA)"}
+            return self._error("only_read_only_statements_allowed (SELECT/PRAGMA)")
+
+        params = list(params or [])
+        page = QUERY_PAGE_ROWS if not isinstance(limit, int) or limit <= 0 else min(limit, QUERY_MAX_ROWS)
+        fp = self._fingerprint(sql, params)
+        try:
+            offset = self._decode_cursor(cursor, fp) if cursor else 0
+        except ValueError as e:
+            return self._error(str(e))
+
+        # Run the statement as written (a subquery wrapper would rename duplicate columns and
+        # break on a trailing -- comment); rows are produced lazily, so stepping past `offset`
+        # and fetching page + 1 (to tell whether there is more) is all SQLite computes.
+        def _query(conn):
+            with query_deadline(conn, timeout_s if timeout_s is not None else QUERY_TIMEOUT_S):
+                cur = conn.execute(sql.strip(), tuple(params))
+                cols = [d[0] for d in (cur.description or [])]
+                remaining = offset
+                while remaining > 0:
+                    got = cur.fetchmany(min(remaining, QUERY_MAX_ROWS))
+                    if not got:
+                        break
+                    remaining -= len(got)
+                rows: List[Any] = []
+                while len(rows) <= page:
+                    batch = cur.fetchmany(page + 1 - len(rows))
+                    if not batch:
+                        break
+                    rows.extend(batch)
+                cur.close()
+                return rows, cols
 
+        t0 = time.perf_counter()
+        cacheable = s.startswith("select") and not _VOLATILE_SQL.search(sql)
+        hit = False
         try:
-            conn = sqlite3.connect(self.db_path)
-            cur = conn.cursor()
-            cur.execute(sql, tuple(params or []))
-            rows = cur.fetchall()
-            if isinstance(limit, int) and limit > 0:
-                rows = rows[:limit]
-            cols = [d[0] for d in (cur.description or [])]
-            conn.close()
-            return {"ok": True, "db_path": self.db_path, "rowcount": len(rows),
-                    "columns": cols, "rows": rows, "message": "ok"}
+            db = get_sqlite_manager(self.db_path)
+            key = (fp, page, offset, db.data_version()) if cacheable else None
+            cached = db.results.get(key) if cacheable else None
+            if cached is not None:
+                rows, cols = cached
+                hit = True
+            else:
+                # pooled read-only connection: a stray write statement fails instead of committing
+                rows, cols = db.read(_query)
+                if cacheable:
+                    db.results.put(key, (rows, cols))
+        except QueryTimeout as e:
+            return self._error(f"query_timeout: {e}; narrow the query (WHERE / aggregate) or raise timeout_s")
         except Exception as e:
-            try:
-                conn.close()
-            except Exception:
-                pass
-            return {"ok": False, "db_path": self.db_path, "rowcount": 0,
-                    "columns": [], "rows": [], "message": f"sqlite_error: {e}"}
\ No newline at end of file
+            return self._error(f"sqlite_error: {e}")
+        more = len(rows) > page
+        rows = rows[:page]
+        next_cursor = self._encode_cursor(fp, offset + len(rows)) if more else None
+        return {"ok": True, "db_path": self.db_path, "rowcount": len(rows),
+                "columns": cols, "rows": rows, "next_cursor": next_cursor,
+                "elapsed_s": round(time.perf_counter() - t0, 4),
+                "cache": {"hit": hit, **db.results.stats()},
+                "message": "ok (more rows: pass next_cursor)" if more else "ok"}